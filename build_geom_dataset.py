@@ -1,173 +1,315 @@
 import msgpack
 import os
+import json
+import shutil
+import struct
+import hashlib
+import queue
+import threading
+import multiprocessing
+from collections import deque
 import numpy as np
 import torch
-from torch.utils.data import BatchSampler, DataLoader, Dataset, SequentialSampler
+from torch.utils.data import BatchSampler, DataLoader, Dataset, Sampler, SequentialSampler
+from collections.abc import Sequence
 import argparse
 from qm9.data import collate as qm9_collate
 from global_registry import PARAM_REGISTRY
+import columnar_dataset
+import utils
+
+
+# fixed-size .npy header of extract_conformers' output, rewritten in place with the final shape
+NPY_HEADER_SIZE = 128
+
+
+def npy_header(n_rows, n_cols, dtype=np.float64):
+    """.npy (format 1.0) header of a C-ordered [n_rows, n_cols] array, padded to NPY_HEADER_SIZE bytes."""
+    header = f"{{'descr': '{np.dtype(dtype).str}', 'fortran_order': False, 'shape': ({n_rows}, {n_cols}), }}"
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+def iter_msgpack_chunks(path, start=0):
+    """(raw bytes, end position) of the top-level msgpack objects of path from byte position start, not decoded."""
+    with open(path, 'rb') as stream, open(path, 'rb') as f:
+        stream.seek(start)
+        unpacker = msgpack.Unpacker(stream)
+        position = start
+        while True:
+            try:
+                unpacker.skip()
+            except msgpack.OutOfData:
+                return
+            end = start + unpacker.tell()
+            f.seek(position)
+            yield f.read(end - position), end
+            position = end
+
+
+def process_drugs_chunk(drugs_1k, conformations, remove_h):
+    """
+    Decodes one msgpack chunk (1k molecules) and keeps the lowest-energy conformers of each molecule:
+    [(smiles, [(coords [n, 4] (atomic_num, x, y, z), boltzmann_weight), ..]), ..]
+    """
+    if isinstance(drugs_1k, bytes):
+        drugs_1k = msgpack.unpackb(drugs_1k)
+    molecules = []
+    for smiles, all_info in drugs_1k.items():
+        conformers = all_info['conformers']
+        # Get the energy of each conformer. Keep only the lowest values
+        all_energies = np.array([conformer['totalenergy'] for conformer in conformers])
+        lowest_energies = np.argsort(all_energies)[:conformations]
+        kept = []
+        for id in lowest_energies:
+            conformer = conformers[id]
+            coords = np.array(conformer['xyz']).astype(float)        # n x 4   [atomic_num, x, y, z]
+            if remove_h:
+                mask = coords[:, 0] != 1.0    # hydrogen's atomic_num = 1
+                coords = coords[mask]
+            kept.append((coords, conformer.get('boltzmannweight', 1.)))
+        molecules.append((smiles, kept))
+    return molecules
+
+
+def map_drugs_chunks(chunks, conformations, remove_h, num_workers=0):
+    """process_drugs_chunk over (raw chunk, end position) pairs, in order, with at most 2 * num_workers chunks in flight."""
+    if num_workers == 0:
+        for raw, position in chunks:
+            yield process_drugs_chunk(raw, conformations, remove_h), position
+        return
+    with multiprocessing.Pool(num_workers) as pool:
+        pending = deque()
+        for raw, position in chunks:
+            pending.append((pool.apply_async(process_drugs_chunk, (raw, conformations, remove_h)), position))
+            if len(pending) >= 2 * num_workers:
+                result, position = pending.popleft()
+                yield result.get(), position
+        while pending:
+            result, position = pending.popleft()
+            yield result.get(), position
 
 
 def extract_conformers(args):
+    """
+    Streams the GEOM msgpack into {save_file}.npy chunk by chunk: rows are appended to the file and the .npy
+    header is written last, so memory stays bounded by a few chunks. Progress is checkpointed after every
+    chunk ({save_file}_extract_progress.json) and a rerun resumes from the last checkpoint.
+    args.num_workers > 0 decodes and filters the chunks in a process pool.
+    """
     drugs_file = os.path.join(args.data_dir, args.data_file)
     save_file = f"geom_drugs_{'no_h_' if args.remove_h else ''}{args.conformations}"
     smiles_list_file = 'geom_drugs_smiles.txt'
     number_atoms_file = f"geom_drugs_n_{'no_h_' if args.remove_h else ''}{args.conformations}"
 
-    unpacker = msgpack.Unpacker(open(drugs_file, "rb"))
-
-    all_smiles = []
-    all_number_atoms = []
-    dataset_conformers = []
-    mol_id = 0
-    for i, drugs_1k in enumerate(unpacker):
+    progress_file = os.path.join(args.data_dir, f"{save_file}_extract_progress.json")
+    # conformations, and per conformer (mol_id): no. atoms, molecule (SMILES line) index and
+    # GEOM Boltzmann weight (see ConformerSampler), SMILES lines
+    paths = {'data': os.path.join(args.data_dir, f"{save_file}.npy")}
+    for name in ['n_atoms', 'smiles_index', 'boltzmann_weight', 'smiles']:
+        paths[name] = os.path.join(args.data_dir, f"{save_file}_extract_{name}.part")
+
+    if os.path.exists(progress_file):
+        with open(progress_file, 'r') as f:
+            progress = json.load(f)
+        print(f"Resuming after file {progress['n_chunks'] - 1} ({progress['n_conformers']} conformers)")
+    else:
+        progress = {'n_chunks': 0, 'position': 0, 'n_conformers': 0, 'n_smiles': 0,
+                    'sizes': {'data': NPY_HEADER_SIZE, 'n_atoms': 0, 'smiles_index': 0, 'boltzmann_weight': 0, 'smiles': 0}}
+        with open(paths['data'], 'wb') as f:
+            f.write(npy_header(0, 5))
+    # drop anything written after the last checkpoint
+    files = {}
+    for name, path in paths.items():
+        files[name] = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        files[name].truncate(progress['sizes'][name])
+        files[name].seek(progress['sizes'][name])
+
+    mol_id, n_smiles = progress['n_conformers'], progress['n_smiles']
+    chunks = iter_msgpack_chunks(drugs_file, progress['position'])
+    for i, (molecules, position) in enumerate(map_drugs_chunks(chunks, args.conformations, args.remove_h, args.num_workers),
+                                              start=progress['n_chunks']):
         print(f"Unpacking file {i}...")
-        for smiles, all_info in drugs_1k.items():
-            all_smiles.append(smiles)
-            conformers = all_info['conformers']
-            # Get the energy of each conformer. Keep only the lowest values
-            all_energies = []
-            for conformer in conformers:
-                all_energies.append(conformer['totalenergy'])
-            all_energies = np.array(all_energies)
-            argsort = np.argsort(all_energies)
-            lowest_energies = argsort[:args.conformations]
-            for id in lowest_energies:
-                conformer = conformers[id]
-                coords = np.array(conformer['xyz']).astype(float)        # n x 4   [atomic_num, x, y, z]
-                if args.remove_h:
-                    mask = coords[:, 0] != 1.0    # hydrogen's atomic_num = 1
-                    coords = coords[mask]
+        rows, n_atoms, smiles_index, boltzmann_weights = [], [], [], []
+        for smiles, conformers in molecules:
+            files['smiles'].write(f"{smiles}\n".encode())
+            for coords, boltzmann_weight in conformers:
                 n = coords.shape[0]
-                all_number_atoms.append(n)
-                mol_id_arr = mol_id * np.ones((n, 1), dtype=float)
-                id_coords = np.hstack((mol_id_arr, coords))
-
-                dataset_conformers.append(id_coords)
+                rows.append(np.hstack((mol_id * np.ones((n, 1), dtype=float), coords)))
+                n_atoms.append(n)
+                smiles_index.append(n_smiles)
+                boltzmann_weights.append(boltzmann_weight)
                 mol_id += 1
+            n_smiles += 1
+        if len(rows) > 0:
+            files['data'].write(np.vstack(rows).astype('<f8').tobytes())
+        files['n_atoms'].write(np.array(n_atoms, dtype='<i8').tobytes())
+        files['smiles_index'].write(np.array(smiles_index, dtype='<i8').tobytes())
+        files['boltzmann_weight'].write(np.array(boltzmann_weights, dtype='<f8').tobytes())
+
+        # checkpoint
+        for f in files.values():
+            f.flush()
+        progress = {'n_chunks': i + 1, 'position': position, 'n_conformers': mol_id, 'n_smiles': n_smiles,
+                    'sizes': {name: f.tell() for name, f in files.items()}}
+        with open(f"{progress_file}.tmp", 'w') as f:
+            json.dump(progress, f)
+        os.replace(f"{progress_file}.tmp", progress_file)
+
+    n_rows = (progress['sizes']['data'] - NPY_HEADER_SIZE) // (5 * 8)
+    files['data'].seek(0)
+    files['data'].write(npy_header(n_rows, 5))
+    for f in files.values():
+        f.close()
 
     print("Total number of conformers saved", mol_id)
-    all_number_atoms = np.array(all_number_atoms)
-    dataset = np.vstack(dataset_conformers)
-
-    print("Total number of atoms in the dataset", dataset.shape[0])
-    print("Average number of atoms per molecule", dataset.shape[0] / mol_id)
+    print("Total number of atoms in the dataset", n_rows)
+    print("Average number of atoms per molecule", n_rows / mol_id)
 
-    # Save conformations
-    np.save(os.path.join(args.data_dir, save_file), dataset)
     # Save SMILES
-    with open(os.path.join(args.data_dir, smiles_list_file), 'w') as f:
-        for s in all_smiles:
-            f.write(s)
-            f.write('\n')
-
+    os.replace(paths['smiles'], os.path.join(args.data_dir, smiles_list_file))
     # Save number of atoms per conformation
-    np.save(os.path.join(args.data_dir, number_atoms_file), all_number_atoms)
+    np.save(os.path.join(args.data_dir, number_atoms_file), np.fromfile(paths['n_atoms'], dtype='<i8'))
+    # Save the molecule of each conformation
+    np.savez(os.path.join(args.data_dir, f"{save_file}_conformer_groups.npz"),
+             smiles_index=np.fromfile(paths['smiles_index'], dtype='<i8'),
+             boltzmann_weight=np.fromfile(paths['boltzmann_weight'], dtype='<f8'))
+    for name in ['n_atoms', 'smiles_index', 'boltzmann_weight']:
+        os.remove(paths[name])
+    os.remove(progress_file)
     print("Dataset processed.")
 
 
 
-def get_mol_id(tensor):
-    flattened_array = np.array(tensor).flatten()
-    assert np.all(flattened_array == flattened_array[0])
-    return int(flattened_array[0])
+class ArrayMolecules(Sequence):
+    """
+    Index view of the molecules of a legacy [n_atoms, 5] (mol_id, atomic_num, x, y, z) array:
+    item i is the [n_atoms, 4] block data[offsets[j]:offsets[j+1], 1:] of molecule j = index[i], as
+    np.split would give it. Indexing with a slice / index array (take) returns another view, nothing is copied.
+    name: key of data in the .npz file (None for a .npy file), see save_split_cache.
+    """
+    def __init__(self, data, offsets=None, index=None, name=None):
+        if offsets is None:
+            mol_id = data[:, 0].astype(int)
+            split_indices = np.nonzero(mol_id[:-1] - mol_id[1:])[0] + 1
+            offsets = np.concatenate([[0], split_indices, [len(mol_id)]]).astype(np.int64)
+        self.data = data
+        self.offsets = offsets
+        self.index = np.arange(len(offsets) - 1) if index is None else np.asarray(index, dtype=np.int64)
+        self.name = name
 
+    def __len__(self):
+        return len(self.index)
 
-def process_splitted_pair_data(all_data, filter_size=None, filter_pocket_size=None, return_mol_id=False):
-    ligand_data_train, pocket_data_train = all_data['ligand_train'], all_data['pocket_train']
-    ligand_data_test, pocket_data_test = all_data['ligand_test'], all_data['pocket_test']
-    ligand_data_val, pocket_data_val = all_data['ligand_val'], all_data['pocket_val']
-    
-    # ligand
-    ligand_mol_id_train = ligand_data_train[:, 0].astype(int)
-    ligands_train = ligand_data_train[:, 1:]
-    ligand_split_indices_train = np.nonzero(ligand_mol_id_train[:-1] - ligand_mol_id_train[1:])[0] + 1
-    ligand_data_list_train = np.split(ligands_train, ligand_split_indices_train)
-    ligand_train_ids = np.split(ligand_mol_id_train, ligand_split_indices_train)
-    
-    ligand_mol_id_test = ligand_data_test[:, 0].astype(int)
-    ligands_test = ligand_data_test[:, 1:]
-    ligand_split_indices_test = np.nonzero(ligand_mol_id_test[:-1] - ligand_mol_id_test[1:])[0] + 1
-    ligand_data_list_test = np.split(ligands_test, ligand_split_indices_test)
-    ligand_test_ids = np.split(ligand_mol_id_test, ligand_split_indices_test)
-    
-    ligand_mol_id_val = ligand_data_val[:, 0].astype(int)
-    ligands_val = ligand_data_val[:, 1:]
-    ligand_split_indices_val = np.nonzero(ligand_mol_id_val[:-1] - ligand_mol_id_val[1:])[0] + 1
-    ligand_data_list_val = np.split(ligands_val, ligand_split_indices_val)
-    ligand_val_ids = np.split(ligand_mol_id_val, ligand_split_indices_val)
-
-    # pocket
-    pocket_mol_id_train = pocket_data_train[:, 0].astype(int)
-    pockets_train = pocket_data_train[:, 1:]
-    pocket_split_indices_train = np.nonzero(pocket_mol_id_train[:-1] - pocket_mol_id_train[1:])[0] + 1
-    pocket_data_list_train = np.split(pockets_train, pocket_split_indices_train)
-    pocket_train_ids = np.split(pocket_mol_id_train, pocket_split_indices_train)
-    
-    pocket_mol_id_test = pocket_data_test[:, 0].astype(int)
-    pockets_test = pocket_data_test[:, 1:]
-    pocket_split_indices_test = np.nonzero(pocket_mol_id_test[:-1] - pocket_mol_id_test[1:])[0] + 1
-    pocket_data_list_test = np.split(pockets_test, pocket_split_indices_test)
-    pocket_test_ids = np.split(pocket_mol_id_test, pocket_split_indices_test)
-
-    pocket_mol_id_val = pocket_data_val[:, 0].astype(int)
-    pockets_val = pocket_data_val[:, 1:]
-    pocket_split_indices_val = np.nonzero(pocket_mol_id_val[:-1] - pocket_mol_id_val[1:])[0] + 1
-    pocket_data_list_val = np.split(pockets_val, pocket_split_indices_val)
-    pocket_val_ids = np.split(pocket_mol_id_val, pocket_split_indices_val)
-
-    train_ids, test_ids, val_ids = [], [], []
-    # Keep only molecules <= filter_size
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.take(np.arange(len(self.index))[idx])
+        if isinstance(idx, (list, np.ndarray)):
+            return self.take(idx)
+        i = self.index[idx]
+        return self.data[self.offsets[i]:self.offsets[i + 1], 1:]
+
+    def take(self, indices):
+        return ArrayMolecules(self.data, self.offsets, self.index[np.asarray(indices, dtype=np.int64)], self.name)
+
+    @property
+    def lengths(self):
+        return (self.offsets[1:] - self.offsets[:-1])[self.index]
+
+    @property
+    def mol_ids(self):
+        return self.data[self.offsets[:-1], 0].astype(int)[self.index]
+
+
+class InterleavedMolecules(Sequence):
+    """
+    Index view over several molecule sequences: item i is sources[source[i]][index[i]],
+    e.g. [lg0, pkt0, lg1, pkt1, ..] for vae_data_mode 'all'. take() / slicing return views.
+    """
+    def __init__(self, sources, source, index):
+        self.sources = sources
+        self.source = np.asarray(source, dtype=np.int64)
+        self.index = np.asarray(index, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.take(np.arange(len(self.index))[idx])
+        if isinstance(idx, (list, np.ndarray)):
+            return self.take(idx)
+        return self.sources[self.source[idx]][self.index[idx]]
+
+    def take(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        return InterleavedMolecules(self.sources, self.source[indices], self.index[indices])
+
+    @property
+    def lengths(self):
+        lengths = np.zeros(len(self.index), dtype=np.int64)
+        for s, molecules in enumerate(self.sources):
+            mask = self.source == s
+            lengths[mask] = np.asarray(molecule_lengths(molecules))[self.index[mask]]
+        return lengths
+
+
+def split_molecules(data, name=None):
+    """Per-molecule index view (zero-copy) and mol ids of a [n_atoms, 5] array (.npz key name), or of a columnar store."""
+    if isinstance(data, columnar_dataset.ColumnarMolecules):
+        return data, data.mol_ids
+    molecules = ArrayMolecules(data, name=name)
+    return molecules, molecules.mol_ids
+
+
+def take_molecules(data_list, indices):
+    if hasattr(data_list, 'take'):
+        return data_list.take(indices)
+    return [data_list[i] for i in indices]
+
+
+def molecule_lengths(data_list):
+    if hasattr(data_list, 'lengths'):
+        return data_list.lengths
+    return [s.shape[0] for s in data_list]
+
+
+def filter_pair_data(ligand_data_list, pocket_data_list, ligand_ids, pocket_ids, filter_size=None,
+                     filter_pocket_size=None, split=None):
+    """
+    Keeps the ligand-pocket pairs with ligand <= filter_size and pocket <= filter_pocket_size atoms
+    (all pairs unless both are set), with one boolean mask over the molecule lengths.
+    Returns the ligand / pocket views and pair ids (np.ndarray) of the kept pairs.
+    """
+    prefix = '' if split is None else f'[{split} split] '
+    assert len(ligand_data_list) == len(pocket_data_list), f'{prefix}Invalid Ligand-Pocket pairs'
+    ligand_ids, pocket_ids = np.asarray(ligand_ids), np.asarray(pocket_ids)
     if filter_size is not None and filter_pocket_size is not None:
-        
-        assert len(list(ligand_data_list_train)) == len(list(pocket_data_list_train))
-        assert len(list(ligand_data_list_test)) == len(list(pocket_data_list_test))
-        assert len(list(ligand_data_list_val)) == len(list(pocket_data_list_val))
-        
-        tmp_ligand_data_list, tmp_pocket_data_list = [], []
-        for i in range(len(list(ligand_data_list_train))):
-            if (ligand_data_list_train[i].shape[0] <= filter_size) and (pocket_data_list_train[i].shape[0] <= filter_pocket_size):
-                tmp_ligand_data_list.append(ligand_data_list_train[i])
-                tmp_pocket_data_list.append(pocket_data_list_train[i])
-                assert get_mol_id(ligand_train_ids[i]) == get_mol_id(pocket_train_ids[i])
-                train_ids.append(get_mol_id(ligand_train_ids[i]))
-        
-        ligand_data_list_train = tmp_ligand_data_list
-        pocket_data_list_train = tmp_pocket_data_list
-        assert len(ligand_data_list_train) > 0, '[train split] No molecules left after filter.'
-
-        tmp_ligand_data_list, tmp_pocket_data_list = [], []
-        for i in range(len(list(ligand_data_list_test))):
-            if (ligand_data_list_test[i].shape[0] <= filter_size) and (pocket_data_list_test[i].shape[0] <= filter_pocket_size):
-                tmp_ligand_data_list.append(ligand_data_list_test[i])
-                tmp_pocket_data_list.append(pocket_data_list_test[i])
-                assert get_mol_id(ligand_test_ids[i]) == get_mol_id(pocket_test_ids[i])
-                test_ids.append(get_mol_id(ligand_test_ids[i]))
-        
-        ligand_data_list_test = tmp_ligand_data_list
-        pocket_data_list_test = tmp_pocket_data_list
-        assert len(ligand_data_list_test) > 0, '[test split] No molecules left after filter.'
-
-        tmp_ligand_data_list, tmp_pocket_data_list = [], []
-        for i in range(len(list(ligand_data_list_val))):
-            if (ligand_data_list_val[i].shape[0] <= filter_size) and (pocket_data_list_val[i].shape[0] <= filter_pocket_size):
-                tmp_ligand_data_list.append(ligand_data_list_val[i])
-                tmp_pocket_data_list.append(pocket_data_list_val[i])
-                assert get_mol_id(ligand_val_ids[i]) == get_mol_id(pocket_val_ids[i])
-                val_ids.append(get_mol_id(ligand_val_ids[i]))
-        
-        ligand_data_list_val = tmp_ligand_data_list
-        pocket_data_list_val = tmp_pocket_data_list
-        assert len(ligand_data_list_val) > 0, '[val split] No molecules left after filter.'
-
-    assert len(list(ligand_data_list_train)) == len(list(pocket_data_list_train)), '[train split] Invalid Ligand-Pocket pairs'
-    assert len(list(ligand_data_list_test)) == len(list(pocket_data_list_test)), '[test split] Invalid Ligand-Pocket pairs'
-    assert len(list(ligand_data_list_val)) == len(list(pocket_data_list_val)), '[val split] Invalid Ligand-Pocket pairs'
-    
+        keep = np.nonzero((np.asarray(molecule_lengths(ligand_data_list)) <= filter_size) &
+                          (np.asarray(molecule_lengths(pocket_data_list)) <= filter_pocket_size))[0]
+        ligand_data_list, pocket_data_list = take_molecules(ligand_data_list, keep), take_molecules(pocket_data_list, keep)
+        ligand_ids, pocket_ids = ligand_ids[keep], pocket_ids[keep]
+        assert np.array_equal(ligand_ids, pocket_ids), f'{prefix}Ligand-Pocket mol ids do not match'
+        assert len(keep) > 0, f'{prefix}No molecules left after filter.'
+    return ligand_data_list, pocket_data_list, ligand_ids
+
+
+def process_splitted_pair_data(all_data, filter_size=None, filter_pocket_size=None, return_mol_id=False):
+    splits = {}
+    for split in ['train', 'test', 'val']:
+        ligand_data_list, ligand_ids = split_molecules(all_data[f'ligand_{split}'], f'ligand_{split}')
+        pocket_data_list, pocket_ids = split_molecules(all_data[f'pocket_{split}'], f'pocket_{split}')
+        splits[split] = filter_pair_data(ligand_data_list, pocket_data_list, ligand_ids, pocket_ids,
+                                         filter_size, filter_pocket_size, split)
+
+    (ligand_data_list_train, pocket_data_list_train, train_ids), \
+        (ligand_data_list_test, pocket_data_list_test, test_ids), \
+            (ligand_data_list_val, pocket_data_list_val, val_ids) = splits['train'], splits['test'], splits['val']
+
     if return_mol_id:
         return ligand_data_list_train, ligand_data_list_test, ligand_data_list_val, \
             pocket_data_list_train, pocket_data_list_test, pocket_data_list_val, \
-                train_ids, test_ids, val_ids
+                train_ids.tolist(), test_ids.tolist(), val_ids.tolist()
     else:
         return ligand_data_list_train, ligand_data_list_test, ligand_data_list_val, \
             pocket_data_list_train, pocket_data_list_test, pocket_data_list_val
@@ -177,39 +319,10 @@ def process_splitted_pair_data(all_data, filter_size=None, filter_pocket_size=No
 
 def process_unsplitted_pair_data(all_data, filter_size=None, filter_pocket_size=None, permutation_file_path=None,
                             conformation_file=None, base_path=None, return_mol_id=False):
-    ligand_data, pocket_data = all_data['ligand'], all_data['pocket']
-    
-    # ligand
-    ligand_mol_id = ligand_data[:, 0].astype(int)
-    ligands = ligand_data[:, 1:]
-    ligand_split_indices = np.nonzero(ligand_mol_id[:-1] - ligand_mol_id[1:])[0] + 1
-    ligand_data_list = np.split(ligands, ligand_split_indices)
-    ligand_ids = np.split(ligand_mol_id, ligand_split_indices)
-    
-    # pocket
-    pocket_mol_id = pocket_data[:, 0].astype(int)
-    pockets = pocket_data[:, 1:]
-    pocket_split_indices = np.nonzero(pocket_mol_id[:-1] - pocket_mol_id[1:])[0] + 1
-    pocket_data_list = np.split(pockets, pocket_split_indices)
-    pocket_ids = np.split(pocket_mol_id, pocket_split_indices)
-    
-    ids = []
-    # Keep only molecules <= filter_size
-    if filter_size is not None and filter_pocket_size is not None:
-        
-        assert len(list(ligand_data_list)) == len(list(pocket_data_list))
-        
-        tmp_ligand_data_list, tmp_pocket_data_list = [], []
-        for i in range(len(list(ligand_data_list))):
-            if (ligand_data_list[i].shape[0] <= filter_size) and (pocket_data_list[i].shape[0] <= filter_pocket_size):
-                tmp_ligand_data_list.append(ligand_data_list[i])
-                tmp_pocket_data_list.append(pocket_data_list[i])
-                assert get_mol_id(ligand_ids[i]) == get_mol_id(pocket_ids[i])
-                ids.append(get_mol_id(ligand_ids[i]))
-        
-        ligand_data_list = tmp_ligand_data_list
-        pocket_data_list = tmp_pocket_data_list
-        assert len(ligand_data_list) > 0, 'No molecules left after filter.'
+    ligand_data_list, ligand_ids = split_molecules(all_data['ligand'], 'ligand')
+    pocket_data_list, pocket_ids = split_molecules(all_data['pocket'], 'pocket')
+    ligand_data_list, pocket_data_list, ids = filter_pair_data(ligand_data_list, pocket_data_list, ligand_ids, pocket_ids,
+                                                               filter_size, filter_pocket_size)
     
     # permutation
     if permutation_file_path is not None:
@@ -223,7 +336,6 @@ def process_unsplitted_pair_data(all_data, filter_size=None, filter_pocket_size=
             file_name += f"_PKT{filter_pocket_size}"
         default_permutation_file_path = os.path.join(base_path, f'{file_name}_permutation.npy')
         # CAREFUL! Only for first time run:
-        assert len(list(ligand_data_list)) == len(list(pocket_data_list)), 'Invalid Ligand-Pocket pairs'
         perm = np.random.permutation(len(ligand_data_list)).astype('int32')
         print('Warning, currently taking a random permutation for '
             'train/val/test partitions, this needs to be fixed for'
@@ -231,45 +343,227 @@ def process_unsplitted_pair_data(all_data, filter_size=None, filter_pocket_size=
         assert not os.path.exists(default_permutation_file_path)
         np.save(default_permutation_file_path, perm)
     
-    assert len(list(ligand_data_list)) == len(list(pocket_data_list)), 'Invalid Ligand-Pocket pairs'
-    assert len(list(ligand_data_list)) == len(list(perm)), 'Invalid permutation file! Did you change [filter_size] and/or [filter_pocket_size]?'
+    assert len(ligand_data_list) == len(perm), 'Invalid permutation file! Did you change [filter_size] and/or [filter_pocket_size]?'
     
-    ligand_data_list = [ligand_data_list[i] for i in perm]
-    pocket_data_list = [pocket_data_list[i] for i in perm]
-    ids = [ids[i] for i in perm]
+    ligand_data_list = take_molecules(ligand_data_list, perm)
+    pocket_data_list = take_molecules(pocket_data_list, perm)
+    ids = ids[perm]
 
     if return_mol_id:
+        return ligand_data_list, pocket_data_list, ids.tolist()
+    else:
         return ligand_data_list, pocket_data_list
+
+
+def select_vae_data(ligand_data_list, pocket_data_list, vae_data_mode):
+    """
+    VAE training items for vae_data_mode: ligands, pockets, or both interleaved as [lg, pkt, lg, pkt, ..]
+    ('all', so that the VAE sees the same amount of ligands and pockets), as index views.
+    """
+    if vae_data_mode == 'ligand':
+        return ligand_data_list
+    elif vae_data_mode == 'pocket':
+        return pocket_data_list
+    elif vae_data_mode == 'all':
+        n = len(ligand_data_list)
+        return InterleavedMolecules([ligand_data_list, pocket_data_list], np.tile([0, 1], n), np.repeat(np.arange(n), 2))
+    else:
+        raise NotImplementedError()
+
+
+
+
+# bump when the processed split layout changes, invalidates existing split caches
+SPLIT_CACHE_VERSION = 1
+
+
+def _file_sha256(file_path, chunk_size=1 << 24):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def data_fingerprint(path):
+    """
+    sha256 of the full content of a file, or of every file of a (columnar) directory.
+    The per-file hashes are stored in the sidecar {path}.sha256.json, keyed by (size, mtime_ns):
+    a file is only read again when it changed, so multi-GB files are hashed once.
+    """
+    path = os.path.normpath(path)
+    files = [path] if os.path.isfile(path) else sorted(
+        os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    sidecar_path = f"{path}.sha256.json"
+    try:
+        with open(sidecar_path, 'r') as f:
+            sidecar = json.load(f)
+    except (OSError, ValueError):
+        sidecar = {}
+
+    sha, hashes, changed = hashlib.sha256(), {}, False
+    for file_path in files:
+        name, stat = os.path.relpath(file_path, path), os.stat(file_path)
+        entry = sidecar.get(name)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry, changed = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': _file_sha256(file_path)}, True
+        hashes[name] = entry
+        sha.update(f"{name}:{entry['size']}:{entry['sha256']}".encode())
+
+    if changed or hashes.keys() != sidecar.keys():
+        tmp_path = f"{sidecar_path}.tmp{os.getpid()}"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(hashes, f)
+            os.replace(tmp_path, sidecar_path)
+        except OSError:  # read-only data directory: the hashes are recomputed next time
+            pass
+    return sha.hexdigest()
+
+
+def split_cache_key(conformation_file, permutation_file_path, **params):
+    """Cache key of a processed split: data file content, permutation file content and split parameters."""
+    key = dict(params, version=SPLIT_CACHE_VERSION, data=data_fingerprint(conformation_file),
+               permutation=None if permutation_file_path is None else data_fingerprint(permutation_file_path))
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def split_data_key(conformation_file, val_proportion=0.1, test_proportion=0.1, filter_size=None,
+                   permutation_file_path=None, training_mode=None, filter_pocket_size=None,
+                   data_splitted=False, return_ids=False):
+    """split_cache_key of a load_split_data call, and the split parameters it covers."""
+    params = dict(filter_size=filter_size, filter_pocket_size=filter_pocket_size, training_mode=training_mode,
+                  vae_data_mode=PARAM_REGISTRY.get('vae_data_mode') if training_mode == 'VAE' else None,
+                  data_splitted=data_splitted, val_proportion=val_proportion, test_proportion=test_proportion,
+                  return_ids=return_ids)
+    return split_cache_key(conformation_file, permutation_file_path, **params), params
+
+
+def _view_state(view, prefix, arrays, conformation_file):
+    # index arrays of a molecule view (or of pair ids) go to arrays, its structure to the manifest
+    if isinstance(view, dict):
+        return {'kind': 'dict', 'items': {key: _view_state(value, f'{prefix}_{key}', arrays, conformation_file)
+                                          for key, value in view.items()}}
+    if isinstance(view, ArrayMolecules):
+        offsets_key = f"offsets_{view.name or 'data'}"
+        arrays[offsets_key], arrays[f'{prefix}_index'] = view.offsets, view.index
+        return {'kind': 'array', 'name': view.name, 'offsets': offsets_key, 'index': f'{prefix}_index'}
+    if isinstance(view, columnar_dataset.ColumnarMolecules):
+        arrays[f'{prefix}_index'] = view.index
+        if view.pair_ids is not None:
+            arrays[f'{prefix}_mol_ids'] = view.pair_ids
+        return {'kind': 'columnar', 'path': os.path.relpath(view.path, conformation_file), 'index': f'{prefix}_index',
+                'mol_ids': None if view.pair_ids is None else f'{prefix}_mol_ids'}
+    if isinstance(view, InterleavedMolecules):
+        arrays[f'{prefix}_source'], arrays[f'{prefix}_index'] = view.source, view.index
+        return {'kind': 'interleaved', 'source': f'{prefix}_source', 'index': f'{prefix}_index',
+                'sources': [_view_state(molecules, f'{prefix}_{i}', arrays, conformation_file)
+                            for i, molecules in enumerate(view.sources)]}
+    arrays[prefix] = np.asarray(view, dtype=np.int64)  # pair ids
+    return {'kind': 'ids', 'array': prefix}
+
+
+def _load_source(path, conformation_file, name):
+    # a .npy data file is memory-mapped. np.load of a .npz member decompresses it in full, so the member
+    # is extracted once as a plain .npy into the split cache (sources/{name}.npy) and memory-mapped from there
+    if name is None:
+        return np.load(conformation_file, mmap_mode='r')
+    source_path = os.path.join(path, 'sources', f'{name}.npy')
+    if not os.path.exists(source_path):
+        os.makedirs(os.path.dirname(source_path), exist_ok=True)
+        tmp_path = f"{source_path}.tmp{os.getpid()}.npy"
+        with np.load(conformation_file) as data:
+            np.save(tmp_path, data[name])
+        os.replace(tmp_path, source_path)
+    return np.load(source_path, mmap_mode='r')
+
+
+def _load_view(state, arrays, conformation_file, sources, path):
+    kind = state['kind']
+    if kind == 'dict':
+        return {key: _load_view(value, arrays, conformation_file, sources, path) for key, value in state['items'].items()}
+    if kind == 'array':
+        name = state['name']
+        if name not in sources:
+            sources[name] = _load_source(path, conformation_file, name)
+        return ArrayMolecules(sources[name], arrays[state['offsets']], arrays[state['index']], name)
+    if kind == 'columnar':
+        mol_ids = None if state['mol_ids'] is None else arrays[state['mol_ids']]
+        return columnar_dataset.ColumnarMolecules(os.path.normpath(os.path.join(conformation_file, state['path'])),
+                                                  arrays[state['index']], mol_ids=mol_ids)
+    if kind == 'interleaved':
+        return InterleavedMolecules([_load_view(source, arrays, conformation_file, sources, path) for source in state['sources']],
+                                    arrays[state['source']], arrays[state['index']])
+    return arrays[state['array']].tolist()
+
+
+def save_split_cache(path, conformation_file, splits, params):
+    """
+    Writes the (train, val, test) output of load_split_data as index arrays (.npy) + manifest.json
+    in the directory path. The molecule data itself is not copied, see load_split_cache.
+    """
+    arrays = {}
+    manifest = {'params': params,
+                'splits': [_view_state(split, name, arrays, conformation_file) for name, split in zip(['train', 'val', 'test'], splits)]}
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    for key, array in arrays.items():
+        np.save(os.path.join(tmp_path, f'{key}.npy'), array)
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    if os.path.exists(path):  # written concurrently by another run
+        shutil.rmtree(tmp_path)
     else:
-        return ligand_data_list, pocket_data_list, ids
+        os.replace(tmp_path, path)
+    print(f">> Saved split cache {path}")
 
 
+def load_split_cache(path, conformation_file):
+    """(train, val, test) of a split cache, index arrays and data memory-mapped, views over the data file."""
+    with open(os.path.join(path, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+    arrays = {file_name[:-len('.npy')]: np.load(os.path.join(path, file_name), mmap_mode='r')
+              for file_name in os.listdir(path) if file_name.endswith('.npy')}
+    sources = {}
+    splits = tuple(_load_view(state, arrays, conformation_file, sources, path) for state in manifest['splits'])
+    print(f">> Using split cache {path}")
+    return splits
 
 
 def load_split_data(conformation_file, val_proportion=0.1, test_proportion=0.1,
                     filter_size=None, permutation_file_path=None, 
                     dataset_name=None, training_mode=None, filter_pocket_size=None,
-                    data_splitted=False, return_ids=False):
+                    data_splitted=False, return_ids=False, split_cache_dir=None):
     from pathlib import Path
     path = Path(conformation_file)
     base_path = path.parent.absolute()
     # if dataset_name is None:
     #     dataset_name = 'geom'
 
+    # processed split cache (split_cache_dir), only for reproducible splits (no fresh random permutation)
+    cache_path = None
+    if split_cache_dir is not None and (data_splitted or permutation_file_path is not None):
+        cache_key, cache_params = split_data_key(conformation_file, val_proportion, test_proportion, filter_size,
+                                                 permutation_file_path, training_mode, filter_pocket_size,
+                                                 data_splitted, return_ids)
+        cache_path = os.path.join(split_cache_dir, cache_key)
+        if os.path.exists(os.path.join(cache_path, 'manifest.json')):
+            return load_split_cache(cache_path, conformation_file)
+
     # base_path = os.path.dirname(conformation_file)
-    all_data = np.load(conformation_file)  # 2d array: num_atoms x 5
+    if columnar_dataset.is_columnar(conformation_file):
+        # memory-mapped columnar store(s), see columnar_dataset.py
+        all_data = columnar_dataset.load_columnar(conformation_file)
+    else:
+        all_data = np.load(conformation_file)  # 2d array: num_atoms x 5
 
     if training_mode is None:
         # original code (for geom & other eval & sampling scripts)
-        mol_id = all_data[:, 0].astype(int)
-        conformers = all_data[:, 1:]
-        split_indices = np.nonzero(mol_id[:-1] - mol_id[1:])[0] + 1
-        data_list = np.split(conformers, split_indices)
+        data_list, _ = split_molecules(all_data)
 
         # Keep only molecules <= filter_size
         if filter_size is not None:
-            data_list = [molecule for molecule in data_list
-                        if molecule.shape[0] <= filter_size]
+            data_list = take_molecules(data_list, np.nonzero(np.asarray(molecule_lengths(data_list)) <= filter_size)[0])
             assert len(data_list) > 0, 'No molecules left after filter.'
 
         if permutation_file_path is not None:
@@ -285,7 +579,7 @@ def load_split_data(conformation_file, val_proportion=0.1, test_proportion=0.1,
             assert not os.path.exists(default_permutation_file_path)
             np.save(default_permutation_file_path, perm)
             
-        data_list = [data_list[i] for i in perm]
+        data_list = take_molecules(data_list, perm)
 
         num_mol = len(data_list)
         val_index = int(num_mol * val_proportion)
@@ -307,20 +601,9 @@ def load_split_data(conformation_file, val_proportion=0.1, test_proportion=0.1,
                                                      base_path
                                                  )
             
-            # combine both ligand+pocket together manually with [lg, pkt, lg, pkt, ..] ordering to ensure VAE sees same amount of both ligand and pockets
-            all_data = []
             vae_data_mode = PARAM_REGISTRY.get('vae_data_mode')
             print(f">> load_split_data: [VAE] loading with data mode: {vae_data_mode}")
-            for i in range(len(list(ligand_data_list))):
-                if vae_data_mode == 'ligand':
-                    all_data.append(ligand_data_list[i])
-                elif vae_data_mode == 'pocket':
-                    all_data.append(pocket_data_list[i])
-                elif vae_data_mode == 'all':
-                    all_data.append(ligand_data_list[i])
-                    all_data.append(pocket_data_list[i])
-                else:
-                    raise NotImplementedError()
+            all_data = select_vae_data(ligand_data_list, pocket_data_list, vae_data_mode)
 
             # split
             num_mol = len(all_data)
@@ -334,44 +617,11 @@ def load_split_data(conformation_file, val_proportion=0.1, test_proportion=0.1,
                 pocket_data_list_train, pocket_data_list_test, pocket_data_list_val \
                     = process_splitted_pair_data(all_data, filter_size, filter_pocket_size)
             
-            # combine both ligand+pocket together manually with [lg, pkt, lg, pkt, ..] ordering to ensure VAE sees same amount of both ligand and pockets
-            all_data_train = []
-            all_data_test = []
-            all_data_val = []
             vae_data_mode = PARAM_REGISTRY.get('vae_data_mode')
             print(f">> load_split_data: [VAE] loading with data mode: {vae_data_mode}")
-            for i in range(len(list(ligand_data_list_train))):
-                if vae_data_mode == 'ligand':
-                    all_data_train.append(ligand_data_list_train[i])
-                elif vae_data_mode == 'pocket':
-                    all_data_train.append(pocket_data_list_train[i])
-                elif vae_data_mode == 'all':
-                    all_data_train.append(ligand_data_list_train[i])
-                    all_data_train.append(pocket_data_list_train[i])
-                else:
-                    raise NotImplementedError()
-
-            for i in range(len(list(ligand_data_list_test))):
-                if vae_data_mode == 'ligand':
-                    all_data_test.append(ligand_data_list_test[i])
-                elif vae_data_mode == 'pocket':
-                    all_data_test.append(pocket_data_list_test[i])
-                elif vae_data_mode == 'all':
-                    all_data_test.append(ligand_data_list_test[i])
-                    all_data_test.append(pocket_data_list_test[i])
-                else:
-                    raise NotImplementedError()
-
-            for i in range(len(list(ligand_data_list_val))):
-                if vae_data_mode == 'ligand':
-                    all_data_val.append(ligand_data_list_val[i])
-                elif vae_data_mode == 'pocket':
-                    all_data_val.append(pocket_data_list_val[i])
-                elif vae_data_mode == 'all':
-                    all_data_val.append(ligand_data_list_val[i])
-                    all_data_val.append(pocket_data_list_val[i])
-                else:
-                    raise NotImplementedError()
+            all_data_train = select_vae_data(ligand_data_list_train, pocket_data_list_train, vae_data_mode)
+            all_data_test = select_vae_data(ligand_data_list_test, pocket_data_list_test, vae_data_mode)
+            all_data_val = select_vae_data(ligand_data_list_val, pocket_data_list_val, vae_data_mode)
 
             print(f">> Data Splits (train | test | val):  {len(all_data_train)} : {len(all_data_test)} : {len(all_data_val)}")
             val_data, test_data, train_data = all_data_val, all_data_test, all_data_train
@@ -403,31 +653,21 @@ def load_split_data(conformation_file, val_proportion=0.1, test_proportion=0.1,
 
     elif training_mode == 'ControlNet':
         if not data_splitted:
-            if return_ids:
-                ligand_data_list, pocket_data_list, ids = process_unsplitted_pair_data(
-                                                        all_data, 
-                                                        filter_size, 
-                                                        filter_pocket_size, 
-                                                        permutation_file_path, 
-                                                        conformation_file, 
-                                                        base_path,
-                                                        return_mol_id=True
-                                                    )
-            else:
-                ligand_data_list, pocket_data_list = process_unsplitted_pair_data(
-                                                        all_data, 
-                                                        filter_size, 
-                                                        filter_pocket_size, 
-                                                        permutation_file_path, 
-                                                        conformation_file, 
-                                                        base_path
-                                                    )
+            ligand_data_list, pocket_data_list, ids = process_unsplitted_pair_data(
+                                                    all_data, 
+                                                    filter_size, 
+                                                    filter_pocket_size, 
+                                                    permutation_file_path, 
+                                                    conformation_file, 
+                                                    base_path,
+                                                    return_mol_id=True
+                                                )
 
             # split
             num_mol = len(ligand_data_list)
             val_index = int(num_mol * val_proportion)
             test_index = val_index + int(num_mol * test_proportion)
-            print(f">> Data Splits: len(data_list):{len(all_data)},  [val_index, test_index]:{[val_index, test_index]}")
+            print(f">> Data Splits: len(data_list):{len(ligand_data_list)},  [val_index, test_index]:{[val_index, test_index]}")
             ligand_val_data, ligand_test_data, ligand_train_data = ligand_data_list[:val_index], ligand_data_list[val_index:test_index], ligand_data_list[test_index:]
             pocket_val_data, pocket_test_data, pocket_train_data = pocket_data_list[:val_index], pocket_data_list[val_index:test_index], pocket_data_list[test_index:]
             ids_val,         ids_test,         ids_train         = ids[:val_index],              ids[val_index:test_index],              ids[test_index:]
@@ -460,6 +700,10 @@ def load_split_data(conformation_file, val_proportion=0.1, test_proportion=0.1,
         val_data['ids'] = ids_val
         test_data['ids'] = ids_test
 
+    if cache_path is not None:
+        os.makedirs(split_cache_dir, exist_ok=True)
+        save_split_cache(cache_path, conformation_file, (train_data, val_data, test_data), cache_params)
+
     return train_data, val_data, test_data
 
 
@@ -475,12 +719,15 @@ class GeomDrugsDataset(Dataset):
         self.transform = transform
         self.pocket_transform = pocket_transform
         self.training_mode = training_mode
+        # optional latent_cache.LatentCache (in data_list order), adds sample['latent']
+        self.latent_cache = None
 
         if (training_mode is None) or (training_mode == 'VAE') or (training_mode == 'LDM'):
             # Sort the data list by size
-            lengths = [s.shape[0] for s in data_list]
+            lengths = molecule_lengths(data_list)
             argsort = np.argsort(lengths)               # Sort by decreasing size
-            self.data_list = [data_list[i] for i in argsort]
+            self.data_list = take_molecules(data_list, argsort)
+            self.data_order = argsort                   # index into the given data_list
             # Store indices where the size changes (will be access in other methods)
             self.split_indices = np.unique(np.sort(lengths), return_index=True)[1][1:]
 
@@ -489,7 +736,7 @@ class GeomDrugsDataset(Dataset):
             pocket_data_list = data_list['pocket']
 
             # sort according to ligand size
-            lengths = [s.shape[0] for s in ligand_data_list]
+            lengths = molecule_lengths(ligand_data_list)
             argsort = np.argsort(lengths)
             # self.data_list = [ligand_data_list[i] for i in argsort]
             # self.data_list_pocket = [pocket_data_list[i] for i in argsort]
@@ -497,12 +744,25 @@ class GeomDrugsDataset(Dataset):
             assert len(ligand_data_list) == len(pocket_data_list), f"Invalid data pairs encountered! ligand={len(ligand_data_list)} pocket={len(pocket_data_list)}"
             self.data_list = ligand_data_list
             self.data_list_pocket = pocket_data_list
+            # pair ids (load_split_data(return_ids=True)), keys of the optional pocket latent cache
+            self.ids = data_list.get('ids', None)
+            self.pocket_latent_cache = None
 
             self.split_indices = np.unique(np.sort(lengths), return_index=True)[1][1:]
 
     def __len__(self):
         return len(self.data_list)
 
+    def molecule_lengths(self):
+        """No. atoms per item: ligand (or molecule) lengths, pocket lengths (ControlNet) or None."""
+        if self.training_mode == 'ControlNet':
+            return np.asarray(molecule_lengths(self.data_list)), np.asarray(molecule_lengths(self.data_list_pocket))
+        return np.asarray(molecule_lengths(self.data_list)), None
+
+    def molecule_ids(self):
+        """mol ids of the items (conformer ids for GEOM), see load_conformer_groups."""
+        return np.asarray(self.data_list.mol_ids)
+
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
@@ -511,6 +771,8 @@ class GeomDrugsDataset(Dataset):
             sample = self.data_list[idx]
             if self.transform:
                 sample = self.transform(sample)
+            if self.latent_cache is not None:
+                sample['latent'] = self.latent_cache[self.data_order[idx]]
 
         elif self.training_mode == 'ControlNet':
             sample_ligand, sample_pocket = self.data_list[idx], self.data_list_pocket[idx]
@@ -518,6 +780,8 @@ class GeomDrugsDataset(Dataset):
                 sample_ligand, sample_pocket = self.transform(sample_ligand), self.pocket_transform(sample_pocket)
             elif self.transform and not self.pocket_transform:
                 sample_ligand, sample_pocket = self.transform(sample_ligand), self.transform(sample_pocket)
+            if self.pocket_latent_cache is not None:
+                sample_pocket['latent'] = self.pocket_latent_cache.by_id(self.ids[idx])
             sample = dict()
             sample['ligand'] = sample_ligand
             sample['pocket'] = sample_pocket
@@ -554,6 +818,187 @@ class GeomDrugsDataset(Dataset):
 #         return count
 
 
+class BucketBatchSampler(Sampler):
+    """
+    Random batches of similarly sized molecules, to cut the zero padding of the dense n^2 edge tensors.
+    Each epoch the shuffled indices are cut into buckets of batch_size * bucket_size_multiplier items,
+    every bucket is sorted by (jittered) size and cut into batches, and the order of all batches is shuffled.
+    jitter adds uniform(0, jitter) atoms to the sort key, so molecules a few atoms apart share batches
+    differently every epoch (jitter <= 1 only breaks ties between equal sizes).
+    Size is the ligand (molecule) size, or the (pocket, ligand) size pair for ligand-pocket batches.
+    shuffle=False gives deterministic batches over the fully size-sorted dataset.
+    index_sampler (optional, shuffle only): draws the indices of each epoch instead, e.g. ConformerSampler.
+    """
+    def __init__(self, lengths, batch_size, drop_last=False, shuffle=True, pocket_lengths=None,
+                 bucket_size_multiplier=50, jitter=3., index_sampler=None):
+        self.lengths = np.asarray(lengths)
+        self.pocket_lengths = None if pocket_lengths is None else np.asarray(pocket_lengths)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.jitter = jitter
+        self.index_sampler = index_sampler
+
+    def _sort(self, indices, rng):
+        ligand_key = self.lengths[indices].astype(np.float64)
+        if self.shuffle and self.jitter > 0:
+            ligand_key = ligand_key + rng.uniform(0, self.jitter, size=len(indices))
+        if self.pocket_lengths is None:
+            return indices[np.argsort(ligand_key, kind='stable')]
+        pocket_key = self.pocket_lengths[indices].astype(np.float64)
+        if self.shuffle and self.jitter > 0:
+            pocket_key = pocket_key + rng.uniform(0, self.jitter, size=len(indices))
+        # pockets dominate the padded edges, sort by pocket size first
+        return indices[np.lexsort((ligand_key, pocket_key))]
+
+    def _cut(self, bucket):
+        return [bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+
+    def _epoch_batches(self):
+        n = len(self.lengths)
+        if not self.shuffle:
+            return self._cut(self._sort(np.arange(n), None))
+        # seeded from torch, like RandomSampler, so that torch.manual_seed controls the epochs
+        rng = np.random.RandomState(int(torch.randint(0, 2 ** 31 - 1, ()).item()))
+        indices = rng.permutation(n) if self.index_sampler is None else self.index_sampler.epoch_indices(rng)
+        if self.drop_last:
+            indices = indices[:(len(indices) // self.batch_size) * self.batch_size]
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            batches.extend(self._cut(self._sort(indices[start:start + self.bucket_size], rng)))
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def __iter__(self):
+        for batch in self._epoch_batches():
+            if self.drop_last and len(batch) < self.batch_size:
+                continue
+            yield batch.tolist()
+
+    def __len__(self):
+        n = len(self.lengths) if self.index_sampler is None else len(self.index_sampler)
+        if self.drop_last:
+            return n // self.batch_size
+        return (n + self.batch_size - 1) // self.batch_size
+
+
+class ConformerSampler(Sampler):
+    """
+    Epochs of at most conformers_per_molecule conformers per molecule instead of every conformer
+    (extract_conformers keeps up to 30 per molecule, each a dataset item). Each epoch draws
+    min(k, n_conformers) distinct conformers per molecule, uniformly or proportionally to weights
+    (e.g. Boltzmann weights), in random order.
+    groups: [n_items] molecule (SMILES) index of each dataset item, see load_conformer_groups.
+    """
+    def __init__(self, groups, conformers_per_molecule=1, weights=None):
+        groups = np.asarray(groups)
+        self.order = np.argsort(groups, kind='stable')  # items grouped by molecule
+        self.groups = groups[self.order]
+        _, group_start, group_size = np.unique(self.groups, return_index=True, return_counts=True)
+        self.group_start = np.repeat(group_start, group_size)
+        self.conformers_per_molecule = conformers_per_molecule
+        self.weights = None if weights is None else np.asarray(weights, dtype=np.float64)[self.order]
+        self.n_items = int(np.minimum(group_size, conformers_per_molecule).sum())
+
+    def epoch_indices(self, rng):
+        # weighted sampling without replacement (Efraimidis-Spirakis): the k largest log(u) / w of each molecule
+        key = np.log(rng.uniform(size=len(self.order)))
+        if self.weights is not None:
+            with np.errstate(divide='ignore'):
+                key = key / self.weights
+        sorted_items = np.lexsort((-key, self.groups))
+        rank = np.arange(len(sorted_items)) - self.group_start
+        chosen = self.order[sorted_items[rank < self.conformers_per_molecule]]
+        return chosen[rng.permutation(len(chosen))]
+
+    def __iter__(self):
+        # seeded from torch, like RandomSampler
+        rng = np.random.RandomState(int(torch.randint(0, 2 ** 31 - 1, ()).item()))
+        return iter(self.epoch_indices(rng).tolist())
+
+    def __len__(self):
+        return self.n_items
+
+
+def default_conformer_groups_file(data_file):
+    """
+    The {save_file}_conformer_groups.npz that extract_conformers writes next to {save_file}.npy.
+    Other data files (e.g. a columnar dataset directory) have no such sibling, they need an explicit path.
+    """
+    if os.path.isdir(data_file) or not data_file.endswith('.npy'):
+        raise ValueError(f"No default conformer groups file for {data_file}, set conformer_groups_file to the "
+                         f"{{save_file}}_conformer_groups.npz written by extract_conformers.")
+    return f"{data_file[:-len('.npy')]}_conformer_groups.npz"
+
+
+def load_conformer_groups(path, mol_ids, weighting=None):
+    """
+    Molecule (SMILES) index and sampling weight of each dataset item, from its conformer mol id and
+    the {save_file}_conformer_groups.npz written by extract_conformers.
+    weighting: None (uniform) | 'boltzmann' (GEOM Boltzmann weights)
+    """
+    conformer_groups = np.load(path)
+    mol_ids = np.asarray(mol_ids)
+    if weighting is None:
+        weights = None
+    elif weighting == 'boltzmann':
+        weights = conformer_groups['boltzmann_weight'][mol_ids]
+    else:
+        raise NotImplementedError()
+    return conformer_groups['smiles_index'][mol_ids], weights
+
+
+def pack_edge_budget(order, lengths, max_edges, pocket_lengths=None, max_batch_size=None):
+    """
+    Cuts order (indices, ideally sorted by size) into consecutive batches whose padded dense edge count
+    bs * (n_max^2 [+ n_pkt_max^2 + n_max * n_pkt_max]) stays within max_edges, with at most max_batch_size items.
+    A molecule above the budget on its own gets a batch of its own.
+    """
+    batches, batch = [], []
+    n_max, n_pkt_max = 0, 0
+    for idx in order:
+        n, n_pkt = int(lengths[idx]), (0 if pocket_lengths is None else int(pocket_lengths[idx]))
+        new_n_max, new_n_pkt_max = max(n_max, n), max(n_pkt_max, n_pkt)
+        cost = (len(batch) + 1) * (new_n_max ** 2 + new_n_pkt_max ** 2 + new_n_max * new_n_pkt_max)
+        if len(batch) > 0 and (cost > max_edges or (max_batch_size is not None and len(batch) >= max_batch_size)):
+            batches.append(np.asarray(batch))
+            batch, new_n_max, new_n_pkt_max = [], n, n_pkt
+        batch.append(idx)
+        n_max, n_pkt_max = new_n_max, new_n_pkt_max
+    if len(batch) > 0:
+        batches.append(np.asarray(batch))
+    return batches
+
+
+class EdgeBudgetBatchSampler(BucketBatchSampler):
+    """
+    Length-bucketed batches of variable size, filled until the padded edge budget max_edges
+    (see pack_edge_budget) is reached instead of a fixed batch_size, which only caps the no. molecules.
+    Every molecule is used each epoch (no drop_last). The no. batches of an epoch is known once
+    the epoch is drawn: len() draws the next epoch, which the following iteration then uses.
+    """
+    def __init__(self, lengths, max_edges, max_batch_size, shuffle=True, pocket_lengths=None,
+                 bucket_size_multiplier=50, jitter=3., index_sampler=None):
+        super().__init__(lengths, max_batch_size, drop_last=False, shuffle=shuffle, pocket_lengths=pocket_lengths,
+                         bucket_size_multiplier=bucket_size_multiplier, jitter=jitter, index_sampler=index_sampler)
+        self.max_edges = max_edges
+        self._next_batches = None
+
+    def _cut(self, bucket):
+        return pack_edge_budget(bucket, self.lengths, self.max_edges, self.pocket_lengths, self.batch_size)
+
+    def __iter__(self):
+        batches = self._next_batches if self._next_batches is not None else self._epoch_batches()
+        self._next_batches = None
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self._next_batches is None:
+            self._next_batches = self._epoch_batches()
+        return len(self._next_batches)
+
+
 def collate_fn(batch):
     # zero padding done here
     batch = {prop: qm9_collate.batch_stack([mol[prop] for mol in batch])
@@ -628,8 +1073,134 @@ def collate_fn_controlnet(batch):
 
 
 
+def center_and_rotate_batch(batch, rotate):
+    """
+    In place, vectorized over a collated batch: removes the masked mean of the positions and, if rotate,
+    applies one random rotation per molecule, shared with the positions of its cached latent ('latent').
+    """
+    x = batch['positions']
+    node_mask = batch['atom_mask'].unsqueeze(2).to(x.dtype)
+    x = (x - (x * node_mask).sum(1, keepdim=True) / node_mask.sum(1, keepdim=True)) * node_mask
+    if rotate:
+        R_T = utils.random_rotation_matrix(x.size(0), x.device, x.dtype).transpose(1, 2)
+        x = torch.matmul(x, R_T)
+        if 'latent' in batch:
+            latent = batch['latent']
+            batch['latent'] = torch.cat([torch.matmul(latent[:, :, :3], R_T.to(latent.dtype)), latent[:, :, 3:]], dim=2)
+    batch['positions'] = x
+
+
+class AugmentingCollate(object):
+    """
+    collate_fn / collate_fn_controlnet followed by center_and_rotate_batch, so that DataLoader
+    workers hand out centered (and rotated) batches. Ligands and pockets are centered and rotated
+    independently, as in train_epoch_controlnet.
+    """
+    def __init__(self, collate, rotate):
+        self.collate = collate
+        self.rotate = rotate
+
+    def __call__(self, batch):
+        batch = self.collate(batch)
+        for mol_batch in ([batch['ligand'], batch['pocket']] if 'ligand' in batch else [batch]):
+            center_and_rotate_batch(mol_batch, self.rotate)
+        return batch
+
+
+class DevicePrefetcher(object):
+    """
+    Iterates loader in a background thread that copies each batch to device (non_blocking, on a
+    side CUDA stream), up to depth batches ahead of the training step. Pair with pin_memory.
+    len() and the batches (nested dicts of tensors) are the loader's.
+    """
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _apply(self, batch, fn):
+        if isinstance(batch, dict):
+            return {key: self._apply(value, fn) for key, value in batch.items()}
+        return fn(batch) if isinstance(batch, torch.Tensor) else batch
+
+    @staticmethod
+    def _put(batches, item, stop):
+        # blocks while the queue is full, gives up once the consumer stopped
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, batches, stream, stop):
+        try:
+            for batch in self.loader:
+                if stream is None:
+                    batch, copied = self._apply(batch, lambda t: t.to(self.device)), None
+                else:
+                    with torch.cuda.stream(stream):
+                        batch = self._apply(batch, lambda t: t.to(self.device, non_blocking=True))
+                        copied = torch.cuda.Event()
+                        copied.record(stream)
+                if not self._put(batches, (batch, copied), stop):
+                    return
+        except Exception as e:
+            self._put(batches, (e, None), stop)
+            return
+        self._put(batches, (None, None), stop)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stream, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch, copied = batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                if copied is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(copied)
+                    # allocated on the side stream, used on the current one
+                    self._apply(batch, lambda t: t.record_stream(current_stream))
+                yield batch
+        finally:
+            # early stop (break / exception / generator close): release the producer and drop its prefetched batches
+            stop.set()
+            while thread.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+
 class GeomDrugsDataLoader(DataLoader):
-    def __init__(self, sequential, dataset, batch_size, shuffle, drop_last=False, training_mode=None):
+    def __init__(self, sequential, dataset, batch_size, shuffle, drop_last=False, training_mode=None,
+                 bucket_batches=False, bucket_size_multiplier=50, bucket_jitter=3., edge_budget=None,
+                 num_workers=0, pin_memory=False, prefetch_factor=2, fused_augmentation=False, data_augmentation=False,
+                 conformers_per_molecule=None, conformer_groups=None, conformer_weights=None):
+
+        collate = collate_fn_controlnet if training_mode == 'ControlNet' else collate_fn
+        if fused_augmentation:
+            # centering (+ rotation) done per batch in the workers, see AugmentingCollate
+            collate = AugmentingCollate(collate, rotate=data_augmentation)
+        loader_kwargs = dict(collate_fn=collate, num_workers=num_workers, pin_memory=pin_memory)
+        if num_workers > 0:
+            loader_kwargs.update(prefetch_factor=prefetch_factor, persistent_workers=True)
+        # [GEOM] shuffled epochs of at most conformers_per_molecule conformers per molecule, see ConformerSampler
+        conformer_sampler = None
+        if shuffle and (conformers_per_molecule is not None):
+            conformer_sampler = ConformerSampler(conformer_groups, conformers_per_molecule, conformer_weights)
 
         if sequential:
             raise NotImplementedError()
@@ -642,13 +1213,30 @@ class GeomDrugsDataLoader(DataLoader):
             #                                    dataset.split_indices)
             # super().__init__(dataset, batch_sampler=batch_sampler)
 
+        elif bucket_batches or (edge_budget is not None):
+            # Batches of similarly sized molecules (ligand-pocket pairs), padded to the largest one.
+            lengths, pocket_lengths = dataset.molecule_lengths()
+            if edge_budget is not None:
+                # variable batch sizes (at most batch_size) within the padded edge budget
+                batch_sampler = EdgeBudgetBatchSampler(lengths, edge_budget, batch_size, shuffle=shuffle,
+                                                       pocket_lengths=pocket_lengths,
+                                                       bucket_size_multiplier=bucket_size_multiplier, jitter=bucket_jitter,
+                                                       index_sampler=conformer_sampler)
+            else:
+                batch_sampler = BucketBatchSampler(lengths, batch_size, drop_last=drop_last, shuffle=shuffle,
+                                                   pocket_lengths=pocket_lengths,
+                                                   bucket_size_multiplier=bucket_size_multiplier, jitter=bucket_jitter,
+                                                   index_sampler=conformer_sampler)
+            super().__init__(dataset, batch_sampler=batch_sampler, **loader_kwargs)
+
+        elif conformer_sampler is not None:
+            super().__init__(dataset, batch_size, sampler=conformer_sampler, drop_last=drop_last, **loader_kwargs)
+
         else:
             # Dataloader goes through data randomly and pads the molecules to
             # the largest molecule size.
-            if (training_mode is None) or (training_mode == 'VAE') or (training_mode == 'LDM'):
-                super().__init__(dataset, batch_size, shuffle=shuffle, collate_fn=collate_fn, drop_last=drop_last)
-            elif training_mode == 'ControlNet':
-                super().__init__(dataset, batch_size, shuffle=shuffle, collate_fn=collate_fn_controlnet, drop_last=drop_last)
+            if (training_mode is None) or (training_mode == 'VAE') or (training_mode == 'LDM') or (training_mode == 'ControlNet'):
+                super().__init__(dataset, batch_size, shuffle=shuffle, drop_last=drop_last, **loader_kwargs)
 
 
 
@@ -662,19 +1250,23 @@ class GeomDrugsTransform(object):
     def __call__(self, data):
         n = data.shape[0]
         new_data = {}
-        new_data['positions'] = torch.from_numpy(data[:, -3:])
-        atom_types = torch.from_numpy(data[:, 0].astype(int)[:, None])
+        if isinstance(data, columnar_dataset.Molecule):
+            # copies the molecule's rows out of the read-only memmaps
+            new_data['positions'] = torch.from_numpy(np.array(data.coords))
+            atom_types = torch.from_numpy(data.atom_types.astype(int)[:, None])
+        else:
+            # a copy: the rows may come from a read-only memmap (split cache)
+            new_data['positions'] = torch.from_numpy(np.array(data[:, -3:]))
+            atom_types = torch.from_numpy(data[:, 0].astype(int)[:, None])
         one_hot = atom_types == self.atomic_number_list
         new_data['one_hot'] = one_hot
+        # CPU tensors (DataLoader workers, pinned memory), moved to the device in the training loop
         if self.include_charges:
-            # ~!to ~!mp
-            new_data['charges'] = torch.zeros(n, 1, device=self.device)
+            new_data['charges'] = torch.zeros(n, 1)
         else:
-            # ~!to ~!mp
-            new_data['charges'] = torch.zeros(0, device=self.device)
-        
-        # ~!to ~!mp
-        new_data['atom_mask'] = torch.ones(n, device=self.device)
+            new_data['charges'] = torch.zeros(0)
+
+        new_data['atom_mask'] = torch.ones(n)
 
         if self.sequential:
             raise NotImplementedError()
@@ -694,6 +1286,7 @@ if __name__ == '__main__':
     parser.add_argument("--remove_h", action='store_true', help="Remove hydrogens from the dataset.")
     parser.add_argument("--data_dir", type=str, default='data/geom/')
     parser.add_argument("--data_file", type=str, default="drugs_crude.msgpack")
+    parser.add_argument("--num_workers", type=int, default=0, help="Processes decoding msgpack chunks (0: in-process).")
     args = parser.parse_args()
     extract_conformers(args)
     print("DONE.")
@@ -0,0 +1,237 @@
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+from collections.abc import Sequence
+
+
+# rows converted per chunk, bounds the converter's RAM independently of the dataset size
+CONVERT_CHUNK_SIZE = 1 << 20
+# deduplicated pair datasets: unique pockets store and per-key pair tables ({key}_pairs.npy)
+UNIQUE_POCKETS_KEY = 'pockets'
+PAIR_TABLE_SUFFIX = '_pairs.npy'
+
+
+class Molecule(object):
+    """
+    Zero-copy view of one molecule of a ColumnarMolecules store, in place of the legacy [n_atoms, 4]
+    (atomic_num, x, y, z) per-molecule array. Only .shape / len() (molecule_lengths, latent_cache) and
+    np.asarray() (a new array) are supported, no array indexing: the data pipeline reads .atom_types
+    and .coords directly (build_geom_dataset.GeomDrugsTransform).
+    """
+    __slots__ = ('atom_types', 'coords', 'mol_id')
+
+    def __init__(self, atom_types, coords, mol_id):
+        self.atom_types = atom_types  # [n_atoms] uint8 (int8 for CA-only amino acid codes)
+        self.coords = coords          # [n_atoms, 3] float32
+        self.mol_id = mol_id
+
+    @property
+    def shape(self):
+        return (self.coords.shape[0], 4)
+
+    def __len__(self):
+        return self.coords.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        # the columns are stored apart, the [n_atoms, 4] array is always a new one (NumPy 2 copy=False cannot hold)
+        if copy is False:
+            raise ValueError("Molecule is stored column-wise, np.asarray(molecule, copy=False) would need a copy.")
+        array = np.concatenate([self.atom_types[:, None].astype(np.float32), self.coords], axis=1)
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+
+class ColumnarMolecules(Sequence):
+    """
+    Memory-mapped columnar molecule store, one directory holding
+        coords.npy [n_atoms, 3] float32, atom_types.npy [n_atoms] uint8 / int8,
+        offsets.npy [n_molecules + 1] int64, mol_ids.npy [n_molecules] int64, meta.json
+    molecule i being rows offsets[i]:offsets[i+1]. Indexing with a slice / index array
+    (take) returns another ColumnarMolecules over the same memmaps, nothing is copied.
+    mol_ids: per-index ids overriding the stored ones (pair ids of deduplicated pockets).
+    """
+    def __init__(self, path, index=None, columns=None, mol_ids=None):
+        self.path = path
+        if columns is None:
+            columns = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in ['coords', 'atom_types']}
+            columns.update({name: np.load(os.path.join(path, f'{name}.npy')) for name in ['offsets', 'mol_ids']})
+        self.columns = columns
+        self.coords, self.atom_types, self.offsets = columns['coords'], columns['atom_types'], columns['offsets']
+        self.index = np.arange(len(columns['mol_ids'])) if index is None else np.asarray(index, dtype=np.int64)
+        self.pair_ids = None if mol_ids is None else np.asarray(mol_ids, dtype=np.int64)
+
+    # memmaps are reopened instead of pickled (spawned DataLoader workers)
+    def __getstate__(self):
+        return {'path': self.path, 'index': self.index, 'mol_ids': self.pair_ids}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['index'], mol_ids=state['mol_ids'])
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.take(np.arange(len(self.index))[idx])
+        if isinstance(idx, (list, np.ndarray)):
+            return self.take(idx)
+        i = self.index[idx]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        mol_id = self.columns['mol_ids'][i] if self.pair_ids is None else self.pair_ids[idx]
+        return Molecule(self.atom_types[start:end], self.coords[start:end], int(mol_id))
+
+    def take(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        mol_ids = None if self.pair_ids is None else self.pair_ids[indices]
+        return ColumnarMolecules(self.path, self.index[indices], self.columns, mol_ids)
+
+    @property
+    def lengths(self):
+        return (self.offsets[1:] - self.offsets[:-1])[self.index]
+
+    @property
+    def mol_ids(self):
+        if self.pair_ids is not None:
+            return self.pair_ids
+        return self.columns['mol_ids'][self.index]
+
+
+def is_columnar(path):
+    return os.path.isdir(path)
+
+
+def load_columnar(path):
+    """
+    A converted .npy file is a single store, a converted .npz file a directory of stores
+    (one per array key, accessed like the np.load'ed npz: data['ligand_train']).
+    Deduplicated pockets (see write_pair_dataset) are resolved through their pair tables,
+    data['pocket_train'][i] being the pocket of pair i.
+    """
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        return ColumnarMolecules(path)
+    data = {key: ColumnarMolecules(os.path.join(path, key)) for key in sorted(os.listdir(path))
+            if os.path.exists(os.path.join(path, key, 'meta.json'))}
+    pockets = data.pop(UNIQUE_POCKETS_KEY, None)
+    for file_name in sorted(os.listdir(path)):
+        if file_name.endswith(PAIR_TABLE_SUFFIX):
+            pairs = np.load(os.path.join(path, file_name))  # [n_pairs, 2]: pair id, unique pocket index
+            data[file_name[:-len(PAIR_TABLE_SUFFIX)]] = ColumnarMolecules(pockets.path, pairs[:, 1], pockets.columns, pairs[:, 0])
+    return data
+
+
+def write_store(path, offsets, mol_ids, atom_types, coords, chunk_size=CONVERT_CHUNK_SIZE):
+    """
+    Writes a ColumnarMolecules store. atom_types [n_atoms] and coords [n_atoms, 3] may be any
+    array-likes (memmaps, strided views of a legacy array), they are copied chunk by chunk.
+    """
+    os.makedirs(path, exist_ok=True)
+    n_atoms = len(coords)
+
+    # atomic numbers fit uint8, CA-only pockets use negative amino acid codes (int8)
+    type_min, type_max = 0, 0
+    for start in range(0, n_atoms, chunk_size):
+        chunk = np.asarray(atom_types[start:start + chunk_size])
+        assert np.all(chunk == np.round(chunk)), "Non-integer atom types"
+        type_min, type_max = min(type_min, chunk.min()), max(type_max, chunk.max())
+    type_dtype = np.uint8 if type_min >= 0 else np.int8
+    assert np.iinfo(type_dtype).min <= type_min and type_max <= np.iinfo(type_dtype).max
+
+    for name, source, dtype, shape in [('atom_types', atom_types, type_dtype, (n_atoms,)),
+                                       ('coords', coords, np.float32, (n_atoms, 3))]:
+        column = np.lib.format.open_memmap(os.path.join(path, f'{name}.npy'), mode='w+', dtype=dtype, shape=shape)
+        for start in range(0, n_atoms, chunk_size):
+            column[start:start + chunk_size] = source[start:start + chunk_size]
+        column.flush()
+        del column
+
+    np.save(os.path.join(path, 'offsets.npy'), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(path, 'mol_ids.npy'), np.asarray(mol_ids, dtype=np.int64))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'n_molecules': len(mol_ids), 'n_atoms': int(n_atoms), 'atom_types_dtype': np.dtype(type_dtype).name}, f)
+    print(f">> Wrote {path}: {len(mol_ids)} molecules, {n_atoms} atoms")
+
+
+def write_columnar(data, path, chunk_size=CONVERT_CHUNK_SIZE):
+    """Writes a legacy [n_atoms, 5] (mol_id, atomic_num, x, y, z) array as a ColumnarMolecules store."""
+    n_atoms = data.shape[0]
+
+    mol_id = np.asarray(data[:, 0]).astype(np.int64)
+    split_indices = np.nonzero(mol_id[:-1] - mol_id[1:])[0] + 1
+    offsets = np.concatenate([[0], split_indices, [n_atoms]]).astype(np.int64)
+    mol_ids = mol_id[offsets[:-1]]
+    del mol_id
+
+    write_store(path, offsets, mol_ids, data[:, 1], data[:, -3:], chunk_size)
+
+
+def write_pair_dataset(all_data, path, chunk_size=CONVERT_CHUNK_SIZE):
+    """
+    Writes ligand / pocket pair arrays (the npz keys: ligand[_split], pocket[_split]) with every
+    unique pocket stored once. Pairs sharing a receptor and cutoff pocket (identical atoms) point
+    to the same row of the 'pockets' store through the {pocket_key}_pairs.npy tables.
+    The unique pockets are appended to raw .part columns as they are found, one pocket array
+    in memory at a time, and copied into the store chunk by chunk.
+    """
+    os.makedirs(path, exist_ok=True)
+    pocket_keys = [key for key in all_data if key.startswith('pocket')]
+    for key in all_data:
+        if key in pocket_keys:
+            continue
+        write_columnar(all_data[key], os.path.join(path, key), chunk_size)
+
+    store = os.path.join(path, UNIQUE_POCKETS_KEY)
+    os.makedirs(store, exist_ok=True)
+    parts = {name: os.path.join(store, f'{name}.part') for name in ['atom_types', 'coords']}
+    pocket_index, pocket_lengths = {}, []
+    with open(parts['atom_types'], 'wb') as types_file, open(parts['coords'], 'wb') as coords_file:
+        for key in pocket_keys:
+            data = np.asarray(all_data[key])
+            mol_id = data[:, 0].astype(np.int64)
+            offsets = np.concatenate([[0], np.nonzero(mol_id[:-1] - mol_id[1:])[0] + 1, [len(data)]])
+            pairs = np.zeros((len(offsets) - 1, 2), dtype=np.int64)
+            for i in range(len(pairs)):
+                rows = data[offsets[i]:offsets[i + 1], 1:].astype(np.float32)
+                digest = hashlib.sha1(rows.tobytes()).hexdigest()
+                if digest not in pocket_index:
+                    pocket_index[digest] = len(pocket_lengths)
+                    pocket_lengths.append(len(rows))
+                    types_file.write(rows[:, 0].astype('<f4').tobytes())
+                    coords_file.write(np.ascontiguousarray(rows[:, 1:], dtype='<f4').tobytes())
+                pairs[i] = mol_id[offsets[i]], pocket_index[digest]
+            np.save(os.path.join(path, f'{key}{PAIR_TABLE_SUFFIX}'), pairs)
+            print(f">> {key}: {len(pairs)} pairs, {len(pocket_lengths)} unique pockets so far")
+            del data, mol_id
+
+    # the unique pockets' mol ids are their pocket ids (int64, exact past 2^24 pockets)
+    n_atoms = int(np.sum(pocket_lengths))
+    write_store(store, np.concatenate([[0], np.cumsum(pocket_lengths)]), np.arange(len(pocket_lengths)),
+                np.memmap(parts['atom_types'], dtype='<f4', mode='r', shape=(n_atoms,)),
+                np.memmap(parts['coords'], dtype='<f4', mode='r', shape=(n_atoms, 3)), chunk_size)
+    for part in parts.values():
+        os.remove(part)
+
+
+def convert(input_file, output_dir, dedup_pockets=False):
+    """Converts a legacy .npy (GEOM) or .npz (ligand / pocket pairs) dataset file."""
+    if input_file.endswith('.npz'):
+        all_data = np.load(input_file)
+        if dedup_pockets:
+            write_pair_dataset(all_data, output_dir)
+            return
+        for key in all_data.files:
+            write_columnar(all_data[key], os.path.join(output_dir, key))
+    else:
+        write_columnar(np.load(input_file, mmap_mode='r'), output_dir)
+
+
+
+if __name__ == '__main__':
+    # python columnar_dataset.py --input data/geom/geom_drugs_30.npy --output data/geom/geom_drugs_30_columnar
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, required=True, help="Legacy .npy / .npz dataset file.")
+    parser.add_argument("--output", type=str, required=True, help="Output directory, pass it as data_file.")
+    parser.add_argument("--dedup_pockets", action='store_true', help="[.npz] Store each unique pocket once, with pair tables.")
+    args = parser.parse_args()
+    convert(args.input, args.output, args.dedup_pockets)
+    print("DONE.")
@@ -10,6 +10,10 @@ from Bio.PDB.Polypeptide import is_aa
 
 from constants import get_periodictable_list
 
+import sys
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+import columnar_dataset
+
 
 
 def read_label_file(csv_path):
@@ -157,6 +161,7 @@ if __name__ == '__main__':
     parser.add_argument('--ca_only', action='store_true')
     parser.add_argument('--no_H', action='store_true')
     parser.add_argument('--determine_distance_by_ca', action='store_true')  # wrong method, do not use
+    parser.add_argument('--save_columnar', action='store_true')  # deduplicated pockets, see columnar_dataset.py
     args = parser.parse_args()
     
     # python -W ignore 01_build_bindingmoad_dataset.py --raw_moad_basedir /Users/gohyixian/Documents/Documents/3.2_FYP_1/data/BindingMOAD --dist_cutoff 10.0 --max_occurences 50 --no_H --ca_only --save_dir /Users/gohyixian/Documents/GitHub/FYP/GeoLDM-edit/data/d_20240623_BindingMOAD_LG_PKT --save_dataset_name d_20240623_BindingMOAD_LG_PKT
@@ -286,7 +291,11 @@ if __name__ == '__main__':
         os.makedirs(args.save_dir)
     save_file = f"{args.save_dataset_name}__{args.dist_cutoff}A__MaxOcc{args.max_occurences}{'__CA_Only' if args.ca_only else ''}{'__no_H' if args.no_H else ''}.npz"
     
-    np.savez(os.path.join(args.save_dir, save_file), ligand=ligand_dataset, pocket=pocket_dataset)
+    if args.save_columnar:
+        # pass the directory as data_file, each unique pocket stored once
+        columnar_dataset.write_pair_dataset(dict(ligand=ligand_dataset, pocket=pocket_dataset), os.path.join(args.save_dir, save_file[:-len('.npz')]))
+    else:
+        np.savez(os.path.join(args.save_dir, save_file), ligand=ligand_dataset, pocket=pocket_dataset)
     
     print()
     print(f"[LG] Total Atom Num  : {ligand_dataset.shape[0]}", )
@@ -15,6 +15,10 @@ from Bio.PDB.Polypeptide import is_aa
 
 from constants import get_periodictable_list
 
+import sys
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+import columnar_dataset
+
 
 def process_ligand_and_pocket(pdbfile, sdffile, dist_cutoff, ca_only, no_H, mol_id, determine_distance_by_ca=False):
     pdb_struct = PDBParser(QUIET=True).get_structure('', pdbfile)
@@ -86,6 +90,7 @@ if __name__ == '__main__':
     parser.add_argument('--ca_only', action='store_true')
     parser.add_argument('--no_H', action='store_true')
     parser.add_argument('--determine_distance_by_ca', action='store_true')  # wrong method, do not use
+    parser.add_argument('--save_columnar', action='store_true')  # deduplicated pockets, see columnar_dataset.py
     args = parser.parse_args()
 
     # python 01_build_crossdocked_dataset.py --raw_crossd_basedir /Users/gohyixian/Documents/Documents/3.2_FYP_1/data/CrossDocked --dist_cutoff 10.0 --no_H --ca_only --save_dir /Users/gohyixian/Documents/GitHub/FYP/GeoLDM-edit/data/d_20240623_CrossDocked_LG_PKT --save_dataset_name d_20240623_CrossDocked_LG_PKT
@@ -228,9 +233,7 @@ if __name__ == '__main__':
         os.makedirs(args.save_dir)
     save_file = f"{args.save_dataset_name}__{args.dist_cutoff}A{'__CA_Only' if args.ca_only else ''}{'__no_H' if args.no_H else ''}.npz"
     
-    np.savez(
-        os.path.join(args.save_dir, save_file), 
-        
+    all_data = dict(
         ligand_train=ligand_dataset['train'], 
         ligand_test=ligand_dataset['test'], 
         ligand_val=ligand_dataset['val'], 
@@ -239,6 +242,11 @@ if __name__ == '__main__':
         pocket_test=pocket_dataset['test'], 
         pocket_val=pocket_dataset['val'], 
     )
+    if args.save_columnar:
+        # pass the directory as data_file, each unique pocket stored once
+        columnar_dataset.write_pair_dataset(all_data, os.path.join(args.save_dir, save_file[:-len('.npz')]))
+    else:
+        np.savez(os.path.join(args.save_dir, save_file), **all_data)
     
     ligand_total_num_atoms = ligand_dataset['train'].shape[0] + ligand_dataset['test'].shape[0] + ligand_dataset['val'].shape[0]
     pocket_total_num_atoms = pocket_dataset['train'].shape[0] + pocket_dataset['test'].shape[0] + pocket_dataset['val'].shape[0]
@@ -282,7 +282,13 @@ def analyze_and_save_controlnet(
                         nodesxsample=nodesxsample, 
                         context=None, 
                         fix_noise=False, 
-                        pocket_dict_list=pocket_dict_list
+                        pocket_dict_list=pocket_dict_list,
+                        pocket_ids=pocket_id_lists[batch_id:batch_id + current_batch_size],
+                        num_sampling_steps=args.num_sampling_steps,
+                        eta=args.sampling_eta,
+                        solver=args.sampling_solver,
+                        solver_order=args.sampling_solver_order,
+                        n_buckets=args.sampling_n_buckets
                     )
 
                 molecules['one_hot'].append(one_hot.detach().cpu())
@@ -372,6 +378,11 @@ def init_model_and_sample(
     sample_num_atoms_per_ligand: bool = True,
     delta_num_atoms_per_ligand: int = 5,
     specific_num_atoms_per_ligand: int = 30,
+    num_sampling_steps: int = None,
+    sampling_eta: float = None,
+    sampling_solver: str = 'ddim',
+    sampling_solver_order: int = 2,
+    sampling_n_buckets: int = 1,
     compute_qvina: bool = True,
     qvina_connectivity_thres: float = 1.,
     qvina_size: int = 20,
@@ -402,6 +413,10 @@ def init_model_and_sample(
             }
         )
 
+        # configs saved before the factorized edge MLP keep the concatenated first layer they were trained with
+        if not hasattr(args, 'factorized_edge_mlp'):
+            args.factorized_edge_mlp = False
+
         # Set random seed
         torch.manual_seed(model_seed)
         random.seed(model_seed)
@@ -425,6 +440,12 @@ def init_model_and_sample(
 
         # Add missing configs with default values
         args = utils.add_missing_configs_controlnet(args, args.dtype, ligand_dataset_info, pocket_dataset_info, ignore_mixed_precision=True)
+        if num_sampling_steps is not None:
+            args.num_sampling_steps = num_sampling_steps
+        args.sampling_eta = sampling_eta
+        args.sampling_solver = sampling_solver
+        args.sampling_solver_order = sampling_solver_order
+        args.sampling_n_buckets = sampling_n_buckets
 
         # Create params global registry for easy access
         PARAM_REGISTRY.update_from_config(args)
@@ -528,9 +549,10 @@ def init_model_and_sample(
             pocket_data = pocket_data_list[i]
             pocket_filename = pocket_filename_list[i]
 
+            # apply pocket transform once, the same pocket is shared by all its samples,
+            # sample_controlnet() encodes it once per batch through its pocket id (file name)
+            transformed_pocket_data = pocket_transform(pocket_data)
             for _ in range(num_ligands_per_pocket):
-                # apply pocket transform
-                transformed_pocket_data = pocket_transform(pocket_data)
                 processed_pocket_id.append(pocket_filename)
                 processed_pocket_data_list.append(transformed_pocket_data)
         
@@ -626,6 +648,11 @@ def init_model_and_sample(
         print_multi(f"Sample No. Atoms per Ligand   : {sample_num_atoms_per_ligand}")
         print_multi(f"Delta No. Atoms per Ligand    : {delta_num_atoms_per_ligand}")
         print_multi(f"No. Atoms per Ligand          : {specific_num_atoms_per_ligand}")
+        print_multi(f"No. Sampling Steps            : {args.num_sampling_steps if args.num_sampling_steps is not None else 'T'}")
+        print_multi(f"Sampling Eta                  : {args.sampling_eta}")
+        print_multi(f"Sampling Solver               : {args.sampling_solver}")
+        print_multi(f"Sampling Solver Order         : {args.sampling_solver_order}")
+        print_multi(f"Sampling Size Buckets         : {args.sampling_n_buckets}")
         print_multi(f"")
         print_multi(f"Perform Docking Analysis      : {compute_qvina}")
         print_multi(f"Molecule Fragment Size        : {qvina_connectivity_thres}")
@@ -3,7 +3,8 @@ import torch
 import math
 from torch.utils.checkpoint import checkpoint
 from global_registry import PARAM_REGISTRY
-from egnn.egnn_new import low_vram_forward, unsorted_segment_sum, SinusoidsEmbeddingNew
+from egnn.egnn_new import low_vram_forward, unsorted_segment_sum, factorized_edge_linear, project_edge_linear, \
+    gather_edge_linear, tiled_segment_sum, segment_lengths, SinusoidsEmbeddingNew
 
 
 def zero_module(module: nn.Module):
@@ -69,15 +70,22 @@ class GCL(nn.Module):
                 nn.Sigmoid())
             # TODO: implement softmax here
 
-    def edge_model(self, source, target, edge_attr, joint_edge_mask):
+    def edge_model(self, source, target, edge_attr, joint_edge_mask, edge_index=None):
         # h1[n1]=source, h2[n2]=target
-        if edge_attr is None:  # Unused.
-            out = torch.cat([source, target], dim=1)  # torch.Size([bs*27*27, 256+256])
+        # with edge_index: source=h1, target=h2, first edge_mlp layer factorized per node
+        if edge_index is not None:
+            n1, n2 = edge_index
+            mij = self.edge_mlp[1:](factorized_edge_linear(self.edge_mlp[0], source, target, n1, n2, edge_attr))
         else:
-            out = torch.cat([source, target, edge_attr], dim=1)
-        mij = self.edge_mlp(out)
-        # mij = low_vram_forward(self.edge_mlp, out)
-
+            if edge_attr is None:  # Unused.
+                out = torch.cat([source, target], dim=1)  # torch.Size([bs*27*27, 256+256])
+            else:
+                out = torch.cat([source, target, edge_attr], dim=1)
+            mij = self.edge_mlp(out)
+            # mij = low_vram_forward(self.edge_mlp, out)
+        return self.edge_gate(mij, joint_edge_mask), mij
+
+    def edge_gate(self, mij, joint_edge_mask):
         if self.attention:
             att_val = self.att_mlp(mij)
             # att_val = low_vram_forward(self.att_mlp, mij)
@@ -88,15 +96,36 @@ class GCL(nn.Module):
 
         if joint_edge_mask is not None:
             out = out * joint_edge_mask
-        return out, mij
+        return out
+
+    def tiled_edge_aggregate(self, h1, h2, edge_index, edge_attr, joint_edge_mask, edge_tile_size):
+        # edge_model + unsorted_segment_sum over tiles of edge_tile_size edges
+        n1, n2 = edge_index
+        source_proj, target_proj = project_edge_linear(self.edge_mlp[0], h1, h2)
 
-    def node_model(self, x, edge_index, edge_attr, node_attr):
+        def message_fn(start, end):
+            tile_attr = edge_attr[start:end] if edge_attr is not None else None
+            tile_mask = joint_edge_mask[start:end] if joint_edge_mask is not None else None
+            mij = self.edge_mlp[1:](gather_edge_linear(self.edge_mlp[0], source_proj, target_proj,
+                                                       n1[start:end], n2[start:end], tile_attr))
+            return self.edge_gate(mij, tile_mask)
+
+        return tiled_segment_sum(message_fn, n1, num_segments=h1.size(0), tile_size=edge_tile_size,
+                                 normalization_factor=self.normalization_factor,
+                                 aggregation_method=self.aggregation_method,
+                                 lengths=segment_lengths(edge_index)[0])
+
+    def node_model(self, x, edge_index, edge_attr, node_attr, agg=None):
         n1, n2 = edge_index
         # edge_attr: [bs*27*27, 256]
         # aggregate: sum / normalization_factor=1
-        agg = unsorted_segment_sum(edge_attr, n1, num_segments=x.size(0),
-                                   normalization_factor=self.normalization_factor,  # 1
-                                   aggregation_method=self.aggregation_method)      # sum
+        # agg: already aggregated edge messages (tiled mode), edge_attr unused
+        if agg is None:
+            lengths, degree = segment_lengths(edge_index)
+            agg = unsorted_segment_sum(edge_attr, n1, num_segments=x.size(0),
+                                       normalization_factor=self.normalization_factor,  # 1
+                                       aggregation_method=self.aggregation_method,      # sum
+                                       lengths=lengths, degree=degree)
         if node_attr is not None: # None
             agg = torch.cat([x, agg, node_attr], dim=1)
         else:
@@ -106,7 +135,8 @@ class GCL(nn.Module):
         
         return out, agg
 
-    def forward(self, h1, h2, edge_index, edge_attr=None, node_attr=None, node_mask_1=None, joint_edge_mask=None):
+    def forward(self, h1, h2, edge_index, edge_attr=None, node_attr=None, node_mask_1=None, joint_edge_mask=None,
+                edge_tile_size=None):
         n1, n2 = edge_index
         # node_attr = None
         # bs=64, n_nodes=27
@@ -114,7 +144,17 @@ class GCL(nn.Module):
         # print(">>", h.shape,       row.shape,          col.shape,          h[row].shape,            h[col].shape,            edge_attr.shape,       edge_mask.shape)
         # >> torch.Size([1728, 256]) torch.Size([46656]) torch.Size([46656]) torch.Size([46656, 256]) torch.Size([46656, 256]) torch.Size([46656, 2]) torch.Size([46656, 1])
         #                64x27                   64x27x27                                64x27x27
-        edge_feat, mij = self.edge_model(h1[n1], h2[n2], edge_attr, joint_edge_mask)
+        if edge_tile_size:
+            # per-edge messages (mij) are never materialised
+            agg = self.tiled_edge_aggregate(h1, h2, edge_index, edge_attr, joint_edge_mask, edge_tile_size)
+            h1, agg = self.node_model(h1, edge_index, None, node_attr, agg=agg)
+            if node_mask_1 is not None:
+                h1 = h1 * node_mask_1
+            return h1, None
+        if PARAM_REGISTRY.get('factorized_edge_mlp', True):
+            edge_feat, mij = self.edge_model(h1, h2, edge_attr, joint_edge_mask, edge_index=edge_index)
+        else:
+            edge_feat, mij = self.edge_model(h1[n1], h2[n2], edge_attr, joint_edge_mask)
         h1, agg = self.node_model(h1, edge_index, edge_feat, node_attr)
         if node_mask_1 is not None:
             h1 = h1 * node_mask_1
@@ -139,26 +179,51 @@ class EquivariantUpdate(nn.Module):
         self.normalization_factor = normalization_factor
         self.aggregation_method = aggregation_method
 
-    def coord_model(self, h1, h2, coord1, coord2, edge_index, coord_diff, edge_attr, joint_edge_mask):
-        n1, n2 = edge_index
-        input_tensor = torch.cat([h1[n1], h2[n2], edge_attr], dim=1)
+    def coord_trans(self, coord_out, coord_diff, joint_edge_mask):
         if self.tanh:  # true
-            trans = coord_diff * torch.tanh(self.coord_mlp(input_tensor)) * self.coords_range
-            # trans = coord_diff * torch.tanh(low_vram_forward(self.coord_mlp, input_tensor)) * self.coords_range
-            
+            trans = coord_diff * torch.tanh(coord_out) * self.coords_range
         else:
-            trans = coord_diff * self.coord_mlp(input_tensor)
-            # trans = coord_diff * low_vram_forward(self.coord_mlp, input_tensor)
+            trans = coord_diff * coord_out
         if joint_edge_mask is not None:
             trans = trans * joint_edge_mask
+        return trans
+
+    def coord_model(self, h1, h2, coord1, coord2, edge_index, coord_diff, edge_attr, joint_edge_mask, edge_tile_size=None):
+        n1, n2 = edge_index
+        if edge_tile_size:
+            source_proj, target_proj = project_edge_linear(self.coord_mlp[0], h1, h2)
+
+            def message_fn(start, end):
+                tile_attr = edge_attr[start:end] if edge_attr is not None else None
+                tile_mask = joint_edge_mask[start:end] if joint_edge_mask is not None else None
+                coord_out = self.coord_mlp[1:](gather_edge_linear(self.coord_mlp[0], source_proj, target_proj,
+                                                                  n1[start:end], n2[start:end], tile_attr))
+                return self.coord_trans(coord_out, coord_diff[start:end], tile_mask)
+
+            agg = tiled_segment_sum(message_fn, n1, num_segments=coord1.size(0), tile_size=edge_tile_size,
+                                    normalization_factor=self.normalization_factor,
+                                    aggregation_method=self.aggregation_method,
+                                    lengths=segment_lengths(edge_index)[0])
+            return coord1 + agg
+
+        if PARAM_REGISTRY.get('factorized_edge_mlp', True):
+            coord_out = self.coord_mlp[1:](factorized_edge_linear(self.coord_mlp[0], h1, h2, n1, n2, edge_attr))
+        else:
+            input_tensor = torch.cat([h1[n1], h2[n2], edge_attr], dim=1)
+            coord_out = self.coord_mlp(input_tensor)
+            # coord_out = low_vram_forward(self.coord_mlp, input_tensor)
+        trans = self.coord_trans(coord_out, coord_diff, joint_edge_mask)
+        lengths, degree = segment_lengths(edge_index)
         agg = unsorted_segment_sum(trans, n1, num_segments=coord1.size(0),
                                    normalization_factor=self.normalization_factor,
-                                   aggregation_method=self.aggregation_method)
+                                   aggregation_method=self.aggregation_method,
+                                   lengths=lengths, degree=degree)
         coord1 = coord1 + agg
         return coord1
 
-    def forward(self, h1, h2, coord1, coord2, edge_index, coord_diff, edge_attr=None, node_mask_1=None, joint_edge_mask=None):
-        coord1 = self.coord_model(h1, h2, coord1, coord2, edge_index, coord_diff, edge_attr, joint_edge_mask)
+    def forward(self, h1, h2, coord1, coord2, edge_index, coord_diff, edge_attr=None, node_mask_1=None, joint_edge_mask=None,
+                edge_tile_size=None):
+        coord1 = self.coord_model(h1, h2, coord1, coord2, edge_index, coord_diff, edge_attr, joint_edge_mask, edge_tile_size)
         if node_mask_1 is not None:
             coord1 = coord1 * node_mask_1
         return coord1
@@ -197,9 +262,12 @@ class FusionBlock(nn.Module):
         if self.sin_embedding is not None:
             distances = self.sin_embedding(distances)
         edge_attr = torch.cat([distances, edge_attr], dim=1)
+        # tiled message passing: peak memory scales with edge_tile_size instead of bs*n1*n2
+        edge_tile_size = PARAM_REGISTRY.get('edge_tile_size', None)
         for i in range(0, self.n_layers):
-            h1, _ = self._modules["gcl_%d" % i](h1, h2, edge_index, edge_attr, node_attr=None, node_mask_1=node_mask_1, joint_edge_mask=joint_edge_mask)
-        x1 = self._modules["gcl_equiv"](h1, h2, x1, x2, edge_index, coord_diff, edge_attr, node_mask_1, joint_edge_mask)
+            h1, _ = self._modules["gcl_%d" % i](h1, h2, edge_index, edge_attr, node_attr=None, node_mask_1=node_mask_1, joint_edge_mask=joint_edge_mask,
+                                                edge_tile_size=edge_tile_size)
+        x1 = self._modules["gcl_equiv"](h1, h2, x1, x2, edge_index, coord_diff, edge_attr, node_mask_1, joint_edge_mask, edge_tile_size)
 
         # Important, the bias of the last linear might be non-zero
         if node_mask_1 is not None:
@@ -1,6 +1,7 @@
 from torch import nn
 import torch
 import math
+from collections import OrderedDict
 from torch.utils.checkpoint import checkpoint
 from global_registry import PARAM_REGISTRY
 
@@ -38,6 +39,102 @@ def low_vram_forward(layer, tensor):
     return tensor
 
 
+def factorized_edge_linear(linear, source, target, row, col, edge_attr=None):
+    """Computes linear(torch.cat([source[row], target[col], edge_attr], dim=1))
+       without materialising the concatenated [E, nf_source+nf_target+d] tensor.
+       The source / target slices of the weight are applied once per node and
+       the results gathered per edge, so only the edge_attr slice runs per edge.
+       Uses the layer's own parameters, checkpoints load unchanged.
+
+    Args:
+        linear (nn.Linear): First layer of an edge MLP.
+        source (torch.Tensor): Node features gathered by row, [N_source, nf_source].
+        target (torch.Tensor): Node features gathered by col, [N_target, nf_target].
+        row (torch.Tensor): Edge source indices, [E].
+        col (torch.Tensor): Edge target indices, [E].
+        edge_attr (torch.Tensor, optional): Edge features, [E, d].
+
+    Returns:
+        torch.Tensor: [E, out_features]
+    """
+    source_proj, target_proj = project_edge_linear(linear, source, target)
+    return gather_edge_linear(linear, source_proj, target_proj, row, col, edge_attr)
+
+
+def project_edge_linear(linear, source, target):
+    """Per-node half of factorized_edge_linear, the bias is folded into the
+       source projection. Computed once and reused across edge tiles.
+
+    Returns:
+        tuple(torch.Tensor, torch.Tensor): [N_source, out_features], [N_target, out_features]
+    """
+    nf_source, nf_target = source.size(1), target.size(1)
+    weight = linear.weight
+    source_proj = torch.nn.functional.linear(source, weight[:, :nf_source], linear.bias)
+    target_proj = torch.nn.functional.linear(target, weight[:, nf_source:nf_source + nf_target])
+    return source_proj, target_proj
+
+
+def gather_edge_linear(linear, source_proj, target_proj, row, col, edge_attr=None):
+    """Per-edge half of factorized_edge_linear, edge_attr occupies the trailing
+       input columns of the layer.
+
+    Returns:
+        torch.Tensor: [E, out_features]
+    """
+    out = source_proj[row] + target_proj[col]
+    if edge_attr is not None:
+        weight = linear.weight
+        out = out + torch.nn.functional.linear(edge_attr, weight[:, weight.size(1) - edge_attr.size(1):])
+    return out
+
+
+def tiled_segment_sum(message_fn, segment_ids, num_segments, tile_size, normalization_factor, aggregation_method: str,
+                      lengths=None):
+    """Streaming counterpart of unsorted_segment_sum. Edge messages are computed
+       by message_fn(start, end) for one tile of edges at a time and accumulated
+       straight into the node-level result, so the full [E, d] message tensor is
+       never materialised. When autograd is on, each tile is recomputed in the
+       backward pass (checkpointed) so activations also scale with tile_size.
+
+    Args:
+        message_fn (callable): (start, end) -> messages of edges [start:end), [end-start, d].
+        segment_ids (torch.Tensor): Destination node of each edge, [E].
+        num_segments (int): Number of nodes.
+        tile_size (int): Number of edges per tile.
+        normalization_factor (float): Divisor for 'sum' aggregation.
+        aggregation_method (str): 'sum' or 'mean'.
+        lengths (torch.Tensor, optional): Edges per segment (EdgeIndex.lengths), for 'mean'.
+
+    Returns:
+        torch.Tensor: [num_segments, d]
+    """
+    result = None
+    n_edges = segment_ids.size(0)
+    if n_edges == 0:
+        # no edges (e.g. an empty radius graph): an empty message only gives the width and dtype
+        empty = message_fn(0, 0)
+        result = empty.new_zeros((num_segments, empty.size(1)))
+    for start in range(0, n_edges, tile_size):
+        end = min(start + tile_size, n_edges)
+        if torch.is_grad_enabled():
+            data = checkpoint(message_fn, start, end, use_reentrant=False)
+        else:
+            data = message_fn(start, end)
+        if result is None:
+            result = data.new_zeros((num_segments, data.size(1)))
+        result.index_add_(0, segment_ids[start:end].to(data.device), data)
+    if aggregation_method == 'sum':
+        result = result / normalization_factor
+
+    if aggregation_method == 'mean':
+        if lengths is None:
+            lengths = torch.bincount(segment_ids.to(result.device), minlength=num_segments)
+        norm = lengths.to(result.device).clamp(min=1)
+        result = result / norm.unsqueeze(1).to(result.dtype)
+    return result
+
+
 def checkpoint_equiv_block(inputs):
     """Wrapper function for Equivariant block checkpointing, used
        in EGNN.forward().
@@ -78,15 +175,22 @@ class GCL(nn.Module):
                 nn.Linear(hidden_nf, 1),   # 256, 1
                 nn.Sigmoid())
 
-    def edge_model(self, source, target, edge_attr, edge_mask):
+    def edge_model(self, source, target, edge_attr, edge_mask, edge_index=None):
         # h[row]=source, h[col]=target
-        if edge_attr is None:  # Unused.
-            out = torch.cat([source, target], dim=1)  # torch.Size([bs*27*27, 256+256])
+        # with edge_index: source=h, target=h, first edge_mlp layer factorized per node
+        if edge_index is not None:
+            row, col = edge_index
+            mij = self.edge_mlp[1:](factorized_edge_linear(self.edge_mlp[0], source, target, row, col, edge_attr))
         else:
-            out = torch.cat([source, target, edge_attr], dim=1)
-        mij = self.edge_mlp(out)
-        # mij = low_vram_forward(self.edge_mlp, out)
+            if edge_attr is None:  # Unused.
+                out = torch.cat([source, target], dim=1)  # torch.Size([bs*27*27, 256+256])
+            else:
+                out = torch.cat([source, target, edge_attr], dim=1)
+            mij = self.edge_mlp(out)
+            # mij = low_vram_forward(self.edge_mlp, out)
+        return self.edge_gate(mij, edge_mask), mij
 
+    def edge_gate(self, mij, edge_mask):
         if self.attention:
             att_val = self.att_mlp(mij)
             # att_val = low_vram_forward(self.att_mlp, mij)
@@ -97,15 +201,36 @@ class GCL(nn.Module):
 
         if edge_mask is not None:
             out = out * edge_mask
-        return out, mij
+        return out
+
+    def tiled_edge_aggregate(self, h, edge_index, edge_attr, edge_mask, edge_tile_size):
+        # edge_model + unsorted_segment_sum over tiles of edge_tile_size edges
+        row, col = edge_index
+        source_proj, target_proj = project_edge_linear(self.edge_mlp[0], h, h)
+
+        def message_fn(start, end):
+            tile_attr = edge_attr[start:end] if edge_attr is not None else None
+            tile_mask = edge_mask[start:end] if edge_mask is not None else None
+            mij = self.edge_mlp[1:](gather_edge_linear(self.edge_mlp[0], source_proj, target_proj,
+                                                       row[start:end], col[start:end], tile_attr))
+            return self.edge_gate(mij, tile_mask)
+
+        return tiled_segment_sum(message_fn, row, num_segments=h.size(0), tile_size=edge_tile_size,
+                                 normalization_factor=self.normalization_factor,
+                                 aggregation_method=self.aggregation_method,
+                                 lengths=segment_lengths(edge_index)[0])
 
-    def node_model(self, x, edge_index, edge_attr, node_attr):
+    def node_model(self, x, edge_index, edge_attr, node_attr, agg=None):
         row, col = edge_index
         # edge_attr: [bs*27*27, 256]
         # aggregate: sum / normalization_factor=1
-        agg = unsorted_segment_sum(edge_attr, row, num_segments=x.size(0),
-                                   normalization_factor=self.normalization_factor,  # 1
-                                   aggregation_method=self.aggregation_method)      # sum
+        # agg: already aggregated edge messages (tiled mode), edge_attr unused
+        if agg is None:
+            lengths, degree = segment_lengths(edge_index)
+            agg = unsorted_segment_sum(edge_attr, row, num_segments=x.size(0),
+                                       normalization_factor=self.normalization_factor,  # 1
+                                       aggregation_method=self.aggregation_method,      # sum
+                                       lengths=lengths, degree=degree)
         if node_attr is not None: # None
             agg = torch.cat([x, agg, node_attr], dim=1)
         else:
@@ -115,7 +240,7 @@ class GCL(nn.Module):
         
         return out, agg
 
-    def forward(self, h, edge_index, edge_attr=None, node_attr=None, node_mask=None, edge_mask=None):
+    def forward(self, h, edge_index, edge_attr=None, node_attr=None, node_mask=None, edge_mask=None, edge_tile_size=None):
         row, col = edge_index
         # node_attr = None
         # bs=64, n_nodes=27
@@ -123,7 +248,17 @@ class GCL(nn.Module):
         # print(">>", h.shape,       row.shape,          col.shape,          h[row].shape,            h[col].shape,            edge_attr.shape,       edge_mask.shape)
         # >> torch.Size([1728, 256]) torch.Size([46656]) torch.Size([46656]) torch.Size([46656, 256]) torch.Size([46656, 256]) torch.Size([46656, 2]) torch.Size([46656, 1])
         #                64x27                   64x27x27                                64x27x27
-        edge_feat, mij = self.edge_model(h[row], h[col], edge_attr, edge_mask)
+        if edge_tile_size:
+            # per-edge messages (mij) are never materialised
+            agg = self.tiled_edge_aggregate(h, edge_index, edge_attr, edge_mask, edge_tile_size)
+            h, agg = self.node_model(h, edge_index, None, node_attr, agg=agg)
+            if node_mask is not None:
+                h = h * node_mask
+            return h, None
+        if PARAM_REGISTRY.get('factorized_edge_mlp', True):
+            edge_feat, mij = self.edge_model(h, h, edge_attr, edge_mask, edge_index=edge_index)
+        else:
+            edge_feat, mij = self.edge_model(h[row], h[col], edge_attr, edge_mask)
         h, agg = self.node_model(h, edge_index, edge_feat, node_attr)
         if node_mask is not None:
             h = h * node_mask
@@ -148,26 +283,50 @@ class EquivariantUpdate(nn.Module):
         self.normalization_factor = normalization_factor
         self.aggregation_method = aggregation_method
 
-    def coord_model(self, h, coord, edge_index, coord_diff, edge_attr, edge_mask):
-        row, col = edge_index
-        input_tensor = torch.cat([h[row], h[col], edge_attr], dim=1)
+    def coord_trans(self, coord_out, coord_diff, edge_mask):
         if self.tanh:  # true
-            trans = coord_diff * torch.tanh(self.coord_mlp(input_tensor)) * self.coords_range
-            # trans = coord_diff * torch.tanh(low_vram_forward(self.coord_mlp, input_tensor)) * self.coords_range
-            
+            trans = coord_diff * torch.tanh(coord_out) * self.coords_range
         else:
-            trans = coord_diff * self.coord_mlp(input_tensor)
-            # trans = coord_diff * low_vram_forward(self.coord_mlp, input_tensor)
+            trans = coord_diff * coord_out
         if edge_mask is not None:
             trans = trans * edge_mask
+        return trans
+
+    def coord_model(self, h, coord, edge_index, coord_diff, edge_attr, edge_mask, edge_tile_size=None):
+        row, col = edge_index
+        if edge_tile_size:
+            source_proj, target_proj = project_edge_linear(self.coord_mlp[0], h, h)
+
+            def message_fn(start, end):
+                tile_attr = edge_attr[start:end] if edge_attr is not None else None
+                tile_mask = edge_mask[start:end] if edge_mask is not None else None
+                coord_out = self.coord_mlp[1:](gather_edge_linear(self.coord_mlp[0], source_proj, target_proj,
+                                                                  row[start:end], col[start:end], tile_attr))
+                return self.coord_trans(coord_out, coord_diff[start:end], tile_mask)
+
+            agg = tiled_segment_sum(message_fn, row, num_segments=coord.size(0), tile_size=edge_tile_size,
+                                    normalization_factor=self.normalization_factor,
+                                    aggregation_method=self.aggregation_method,
+                                    lengths=segment_lengths(edge_index)[0])
+            return coord + agg
+
+        if PARAM_REGISTRY.get('factorized_edge_mlp', True):
+            coord_out = self.coord_mlp[1:](factorized_edge_linear(self.coord_mlp[0], h, h, row, col, edge_attr))
+        else:
+            input_tensor = torch.cat([h[row], h[col], edge_attr], dim=1)
+            coord_out = self.coord_mlp(input_tensor)
+            # coord_out = low_vram_forward(self.coord_mlp, input_tensor)
+        trans = self.coord_trans(coord_out, coord_diff, edge_mask)
+        lengths, degree = segment_lengths(edge_index)
         agg = unsorted_segment_sum(trans, row, num_segments=coord.size(0),
                                    normalization_factor=self.normalization_factor,
-                                   aggregation_method=self.aggregation_method)
+                                   aggregation_method=self.aggregation_method,
+                                   lengths=lengths, degree=degree)
         coord = coord + agg
         return coord
 
-    def forward(self, h, coord, edge_index, coord_diff, edge_attr=None, node_mask=None, edge_mask=None):
-        coord = self.coord_model(h, coord, edge_index, coord_diff, edge_attr, edge_mask)
+    def forward(self, h, coord, edge_index, coord_diff, edge_attr=None, node_mask=None, edge_mask=None, edge_tile_size=None):
+        coord = self.coord_model(h, coord, edge_index, coord_diff, edge_attr, edge_mask, edge_tile_size)
         if node_mask is not None:
             coord = coord * node_mask
         return coord
@@ -205,9 +364,12 @@ class EquivariantBlock(nn.Module):
         if self.sin_embedding is not None:
             distances = self.sin_embedding(distances)
         edge_attr = torch.cat([distances, edge_attr], dim=1)
+        # tiled message passing: peak memory scales with edge_tile_size instead of bs*n*n
+        edge_tile_size = PARAM_REGISTRY.get('edge_tile_size', None)
         for i in range(0, self.n_layers):
-            h, _ = self._modules["gcl_%d" % i](h, edge_index, edge_attr=edge_attr, node_mask=node_mask, edge_mask=edge_mask)
-        x = self._modules["gcl_equiv"](h, x, edge_index, coord_diff, edge_attr, node_mask, edge_mask)
+            h, _ = self._modules["gcl_%d" % i](h, edge_index, edge_attr=edge_attr, node_mask=node_mask, edge_mask=edge_mask,
+                                               edge_tile_size=edge_tile_size)
+        x = self._modules["gcl_equiv"](h, x, edge_index, coord_diff, edge_attr, node_mask, edge_mask, edge_tile_size)
         # Important, the bias of the last linear might be non-zero
         if node_mask is not None:
             h = h * node_mask
@@ -356,6 +518,211 @@ def coord2diff(x, edge_index, norm_constant=1):
     return radial, coord_diff
 
 
+class EdgeIndex(list):
+    """[row, col] edge index (unpacks like the plain list) with the CSR layout of row:
+       lengths [num_nodes_1], the number of edges of each source node, and degree, their
+       common value for dense graphs (else None). row must be non-decreasing, which
+       get_edge_index, pack_edges and get_neighbor_edge_index guarantee, so the
+       aggregations reduce contiguous segments instead of scattering.
+    """
+    def __init__(self, row, col, lengths, degree=None):
+        super().__init__([row, col])
+        self.lengths = lengths
+        self.degree = degree
+
+
+def segment_lengths(edge_index):
+    """(lengths, degree) of an EdgeIndex, (None, None) for a plain [row, col] list."""
+    if isinstance(edge_index, EdgeIndex):
+        return edge_index.lengths, edge_index.degree
+    return None, None
+
+
+class EdgeIndexCache:
+    """LRU cache of dense edge indices keyed by (n_nodes_1, n_nodes_2, batch_size, device),
+       bounded by the total bytes held (PARAM_REGISTRY 'edge_index_cache_max_bytes').
+       The most recent entry is always kept, even if it exceeds the cap on its own.
+    """
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()
+        self._n_bytes = 0
+
+    def get(self, n_nodes_1, n_nodes_2, batch_size, device):
+        key = (n_nodes_1, n_nodes_2, batch_size, torch.device(device))
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        # example: n_nodes_1=n_nodes_2=5, batch_size=2 (molecule 1: nodes 0-4, molecule 2: nodes 5-9)
+        #  row: [0, 0, 0, 0, 0, 1, 1, 1, 1, 1, ... 4,     5, 5, 5, 5, 5, 6, ... 9]
+        #  col: [0, 1, 2, 3, 4, 0, 1, 2, 3, 4, ... 4,     5, 6, 7, 8, 9, 5, ... 9]
+        #        <----------->  node-0-vs-all              <----------->  node-5-vs-all
+        offsets = torch.arange(batch_size, device=device).view(batch_size, 1, 1)
+        rows = offsets * n_nodes_1 + torch.arange(n_nodes_1, device=device).view(1, n_nodes_1, 1)
+        cols = offsets * n_nodes_2 + torch.arange(n_nodes_2, device=device).view(1, 1, n_nodes_2)
+        shape = (batch_size, n_nodes_1, n_nodes_2)
+        # every source node has n_nodes_2 edges, known from the shape without counting
+        edges = EdgeIndex(rows.expand(shape).reshape(-1), cols.expand(shape).reshape(-1),
+                          torch.full((batch_size * n_nodes_1,), n_nodes_2, dtype=torch.long, device=device), n_nodes_2)
+
+        self._cache[key] = edges
+        self._n_bytes += sum(e.numel() * e.element_size() for e in [*edges, edges.lengths])
+        max_bytes = PARAM_REGISTRY.get('edge_index_cache_max_bytes', self.max_bytes)
+        while self._n_bytes > max_bytes and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self._n_bytes -= sum(e.numel() * e.element_size() for e in [*evicted, evicted.lengths])
+        return edges
+
+
+EDGE_INDEX_CACHE = EdgeIndexCache()
+
+
+def get_edge_index(n_nodes_1, n_nodes_2, batch_size, device):
+    """Fully connected [row, col] edge index between batch_size graphs of n_nodes_1
+       source and n_nodes_2 target nodes (n_nodes_1 == n_nodes_2 for a single graph,
+       self-loops included and removed by edge_mask), laid out row-major as
+       [bs, n_nodes_1, n_nodes_2]. Shared by every model, cached per device.
+    """
+    return EDGE_INDEX_CACHE.get(n_nodes_1, n_nodes_2, batch_size, device)
+
+
+def pack_nodes(node_mask):
+    """Packed (ragged) layout of a flattened padded batch: only real nodes are kept.
+
+    Args:
+        node_mask (torch.Tensor): [bs*n_nodes, 1]
+
+    Returns:
+        node_index (torch.Tensor): Flat padded index of each real node, [N_real].
+        packed_id (torch.Tensor): Packed index of each padded node (-1 for padding), [bs*n_nodes].
+    """
+    node_mask = node_mask.view(-1) > 0
+    node_index = node_mask.nonzero(as_tuple=True)[0]
+    packed_id = torch.cumsum(node_mask.long(), dim=0) - 1
+    return node_index, packed_id
+
+
+def pack_edges(edge_mask, n_nodes_1, n_nodes_2, packed_1=None, packed_2=None):
+    """Edge list of only the valid pairs in edge_mask, in packed node indices.
+       edge_mask is laid out as the dense [bs, n_nodes_1, n_nodes_2] adjacency
+       (see get_adj_matrix), so self-loops and padding removed by the mask never
+       reach the EGNN.
+
+    Args:
+        edge_mask (torch.Tensor): [bs*n_nodes_1*n_nodes_2, 1]
+        n_nodes_1 (int): Padded number of source nodes per graph.
+        n_nodes_2 (int): Padded number of target nodes per graph.
+        packed_1 (tuple, optional): pack_nodes() of the source nodes.
+        packed_2 (tuple, optional): pack_nodes() of the target nodes.
+            None keeps the flattened padded node indices (sparse edges over padded nodes).
+
+    Returns:
+        EdgeIndex: [row, col] over packed nodes, with the edge count of every source node.
+    """
+    valid = edge_mask.view(-1, n_nodes_2) > 0     # [bs*n_nodes_1, n_nodes_2]
+    lengths = valid.sum(dim=1)
+    edge_index = valid.view(-1).nonzero(as_tuple=True)[0]
+    row = edge_index // n_nodes_2     # batch_idx * n_nodes_1 + i
+    col = (edge_index // (n_nodes_1 * n_nodes_2)) * n_nodes_2 + edge_index % n_nodes_2    # batch_idx * n_nodes_2 + j
+    if packed_1 is not None:
+        node_index_1, packed_id_1 = packed_1
+        row = packed_id_1[row]
+        lengths = lengths[node_index_1]
+    if packed_2 is not None:
+        col = packed_2[1][col]
+    return EdgeIndex(row, col, lengths)
+
+
+def get_packed_edge_index(node_mask_1, node_mask_2, batch_size, exclude_self=False):
+    """Fully connected edge index between the real nodes of each graph, in packed node indices
+       (pack_nodes order), enumerated from the per-graph node counts instead of a dense edge mask.
+       Equals pack_edges on the node_mask_1 x node_mask_2 edge mask (without its diagonal if exclude_self).
+
+    Args:
+        node_mask_1 (torch.Tensor): Source node mask, [bs*n_nodes_1, 1].
+        node_mask_2 (torch.Tensor): Target node mask, [bs*n_nodes_2, 1].
+        batch_size (int): bs.
+        exclude_self (bool): Drop the self-loops (source and target nodes are the same graph).
+
+    Returns:
+        EdgeIndex: [row, col] over packed nodes.
+    """
+    counts_1 = (node_mask_1.view(batch_size, -1) > 0).sum(dim=1)
+    counts_2 = (node_mask_2.view(batch_size, -1) > 0).sum(dim=1)
+    starts_1, starts_2 = torch.cumsum(counts_1, 0) - counts_1, torch.cumsum(counts_2, 0) - counts_2
+    n_edges = counts_1 * counts_2
+    graph = torch.repeat_interleave(torch.arange(batch_size, device=n_edges.device), n_edges)
+    local = torch.arange(graph.numel(), device=graph.device) - (torch.cumsum(n_edges, 0) - n_edges)[graph]
+    row = starts_1[graph] + local // counts_2[graph]
+    col = starts_2[graph] + local % counts_2[graph]
+    lengths = torch.repeat_interleave(counts_2, counts_1)
+    if exclude_self:
+        keep = row != col
+        row, col, lengths = row[keep], col[keep], lengths - 1
+    return EdgeIndex(row, col, lengths)
+
+
+def get_neighbor_edge_index(x_1, x_2, node_mask_1, node_mask_2, batch_size, mode, k=None, radius=None,
+                            exclude_self=False, packed_1=None, packed_2=None):
+    """Sparse k-nearest-neighbour or radius graph between the real nodes of each graph, computed
+       from the current coordinates and emitted as an edge list directly: every real source node
+       keeps its k closest real target nodes, or all real target nodes within radius. Only these
+       edges reach the EGNN, there is no dense edge mask.
+
+    Args:
+        x_1 (torch.Tensor): Source coordinates, [bs*n_nodes_1, 3].
+        x_2 (torch.Tensor): Target coordinates, [bs*n_nodes_2, 3].
+        node_mask_1 (torch.Tensor): Source node mask, [bs*n_nodes_1, 1].
+        node_mask_2 (torch.Tensor): Target node mask, [bs*n_nodes_2, 1].
+        batch_size (int): bs.
+        mode (str): 'knn' | 'radius'
+        k (int, optional): Number of neighbours for 'knn'.
+        radius (float, optional): Cutoff for 'radius'.
+        exclude_self (bool): Drop the self-loops (source and target nodes are the same graph).
+        packed_1 (tuple, optional): pack_nodes() of the source nodes.
+        packed_2 (tuple, optional): pack_nodes() of the target nodes.
+            None keeps the flattened padded node indices.
+
+    Returns:
+        EdgeIndex: [row, col], rows non-decreasing.
+    """
+    n_nodes_1, n_nodes_2 = x_1.size(0) // batch_size, x_2.size(0) // batch_size
+    with torch.no_grad():
+        dist = torch.cdist(x_1.view(batch_size, n_nodes_1, -1).float(), x_2.view(batch_size, n_nodes_2, -1).float())
+        invalid = (node_mask_1.view(batch_size, n_nodes_1, 1) <= 0) | (node_mask_2.view(batch_size, 1, n_nodes_2) <= 0)
+        if exclude_self:
+            invalid = invalid | torch.eye(n_nodes_1, n_nodes_2, dtype=torch.bool, device=dist.device).unsqueeze(0)
+        dist = dist.masked_fill(invalid, float('inf'))
+        if mode == 'knn':
+            # k closest targets per source node, padding / excluded pairs sort last at inf
+            n_neighbors = min(int(k), n_nodes_2)
+            dist, nearest = dist.topk(n_neighbors, dim=2, largest=False)
+            keep = torch.isfinite(dist)
+            edge_index = keep.view(-1).nonzero(as_tuple=True)[0]
+            row = edge_index // n_neighbors     # batch_idx * n_nodes_1 + i
+            col = (row // n_nodes_1) * n_nodes_2 + nearest.view(-1)[edge_index]
+        elif mode == 'radius':
+            keep = dist <= float(radius)
+            edge_index = keep.view(-1).nonzero(as_tuple=True)[0]
+            row = edge_index // n_nodes_2
+            col = (edge_index // (n_nodes_1 * n_nodes_2)) * n_nodes_2 + edge_index % n_nodes_2
+        else:
+            raise ValueError(f"Unknown neighbour graph mode: {mode}")
+        lengths = keep.sum(dim=2).view(-1)
+        if packed_1 is not None:
+            row = packed_1[1][row]
+            lengths = lengths[packed_1[0]]
+        if packed_2 is not None:
+            col = packed_2[1][col]
+    return EdgeIndex(row, col, lengths)
+
+
+def unpack_nodes(data, node_index, num_nodes):
+    """Scatters packed node features back into the flattened padded layout (zeros on padding)."""
+    return data.new_zeros((num_nodes, data.size(1))).index_copy(0, node_index, data)
+
+
 # In summary, this function takes input data along with segment IDs and aggregates the data 
 # based on these segment IDs using either sum or mean aggregation methods. It's a useful 
 # operation for tasks such as grouping or pooling in neural network architectures.
@@ -381,17 +748,16 @@ def coord2diff(x, edge_index, norm_constant=1):
     # scattering: [1, 2+3, 0]   <-- 1 kept at position 0, while 2 3 scattered/moved to position 1, position 2 empty
     #           = [1, 5,   0]
     
-def unsorted_segment_sum(data, segment_ids, num_segments, normalization_factor, aggregation_method: str):
+def unsorted_segment_sum(data, segment_ids, num_segments, normalization_factor, aggregation_method: str,
+                         lengths=None, degree=None):
     # unsorted_segment_sum(edge_attr, row, num_segments=x.size(0),..)
     """Custom PyTorch op to replicate TensorFlow's `unsorted_segment_sum`.
         Normalization: 'sum' or 'mean'.
+        lengths, degree: CSR layout of non-decreasing segment_ids (see EdgeIndex / segment_lengths),
+        the segments are then reduced contiguously instead of scattered.
     """
     # num_segments: bs * num_nodes
     # data.size(1): 256
-    result_shape = (num_segments, data.size(1))
-    result = data.new_full(result_shape, 0)  # Init empty result tensor of shape result_shape, all with value 0, and same data type as data
-    #         say (100)       (100, 1)      (100, 256)
-    segment_ids = segment_ids.unsqueeze(-1).expand(-1, data.size(1))   # [bs*n_nodes*n_nodes, 256]
     segment_ids = segment_ids.to(data.device)
     # since here we have n_nodes=5, meaning each molecule has 5 atoms / 5 nodes
     #
@@ -404,13 +770,19 @@ def unsorted_segment_sum(data, segment_ids, num_segments, normalization_factor,
     #                           all possible node combinations in molecule 1                                   all possible node combinations in molecule 2
     #               <------------------------------------------------------------------------------------------------------------------------------------------------------>
     #                                                                        batch size = 2   (2 molecules per batch)
-    result.scatter_add_(0, segment_ids, data)      # runs on dim=0, collapes dim 0 from bs*n_nodes*n_nodes to bs*n_nodes
+    if degree is not None:   # dense graph: every node has n_nodes edges
+        result = data.view(num_segments, degree, data.size(1)).sum(dim=1)
+    elif lengths is not None:
+        result = torch.segment_reduce(data, 'sum', lengths=lengths.to(data.device), unsafe=True)
+    else:
+        # no [E, 256] expanded index, collapses dim 0 from bs*n_nodes*n_nodes to bs*n_nodes
+        result = data.new_zeros((num_segments, data.size(1))).index_add_(0, segment_ids, data)
     if aggregation_method == 'sum':
         result = result / normalization_factor
 
     if aggregation_method == 'mean':
-        norm = data.new_zeros(result.shape)
-        norm.scatter_add_(0, segment_ids, data.new_ones(data.shape))   # N, sum up number of elems, i.e.  (..sum..) / N  <--
-        norm[norm == 0] = 1  # 0 div error
+        if lengths is None:
+            lengths = torch.bincount(segment_ids, minlength=num_segments)
+        norm = lengths.to(result.device).clamp(min=1).unsqueeze(1).to(result.dtype)  # N, number of elems, i.e.  (..sum..) / N  <--, 0 div error
         result = result / norm
     return result
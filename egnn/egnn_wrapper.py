@@ -46,8 +46,22 @@ class ControlNet_Arch_Wrapper(nn.Module):
         self.noise_injection_normalization_factor = noise_injection_normalization_factor
 
 
+    def pocket_edge_attr(self, x2, edge_index_2):
+        """Pocket edge attributes, they only depend on the (clean) pocket coordinates."""
+        distances_2, _ = coord2diff(x2, edge_index_2)
+        if self.control_net.sin_embedding is not None:
+            distances_2 = self.control_net.sin_embedding(distances_2)
+        return distances_2
+
+
     def forward(self, h1, x1, h2, x2, node_mask_1=None, node_mask_2=None, edge_mask_1=None, edge_mask_2=None, 
-                edge_index_1=None, edge_index_2=None, joint_edge_index=None, joint_edge_mask=None):
+                edge_index_1=None, edge_index_2=None, joint_edge_index=None, joint_edge_mask=None,
+                fusion_edge_index=None, fusion_edge_mask=None, distances_2=None):
+        # fusion_edge_index / fusion_edge_mask: (sparse) ligand-pocket graph for the Fusion Blocks,
+        # defaults to the joint graph. The Initial Noise Injection always uses the joint graph.
+        # distances_2: precomputed pocket_edge_attr(x2, edge_index_2), constant over the sampling steps.
+        if fusion_edge_index is None:
+            fusion_edge_index, fusion_edge_mask = joint_edge_index, joint_edge_mask
 
         # === Embeddings & Edge Attrs ===
         # Ligands (h1,x1)
@@ -57,13 +71,12 @@ class ControlNet_Arch_Wrapper(nn.Module):
         h1 = self.diffusion_net.embedding(h1)
 
         # Pockets (h2,x2)
-        distances_2, _ = coord2diff(x2, edge_index_2)
-        if self.control_net.sin_embedding is not None:
-            distances_2 = self.control_net.sin_embedding(distances_2)
+        if distances_2 is None:
+            distances_2 = self.pocket_edge_attr(x2, edge_index_2)
         h2 = self.control_net.embedding(h2)
 
         # Fusion
-        distances_joint, _ = coord2diff_fusion(x1, x2, joint_edge_index)
+        distances_joint, _ = coord2diff_fusion(x1, x2, fusion_edge_index)
         if self.fusion_net.sin_embedding is not None:
             distances_joint = self.fusion_net.sin_embedding(distances_joint)
 
@@ -79,6 +92,7 @@ class ControlNet_Arch_Wrapper(nn.Module):
         noise_injected_h2 = (self.noise_injection_weights[0] * h1[n1]) + (self.noise_injection_weights[1] * h2[n2])
         noise_injected_x2 = (self.noise_injection_weights[0] * x1[n1]) + (self.noise_injection_weights[1] * x2[n2])  # embedded x, use 50/50 weights to maintain value range
 
+        # 'mean' averages over the padded ligand slots too, packed graphs reject it (see models.check_packed_aggregation)
         agg_h = unsorted_segment_sum(noise_injected_h2, n2, num_segments=h2_shape[0],
                                      normalization_factor=self.noise_injection_normalization_factor,  # 1. (unused)
                                      aggregation_method=self.noise_injection_aggregation_method)      # mean
@@ -119,16 +133,16 @@ class ControlNet_Arch_Wrapper(nn.Module):
             if use_ckpt and (ckpt_mode == 'sqrt') and ((i+1) % int(math.sqrt(self.n_layers)) == 0) and self.n_layers > 1:
                 print(f"            >>> EGNN [FusionBlock] fusion_e_block_{i} ... h2:{h2.shape}   x2:{x2.shape}   h1:{h1.shape}   x1:{x1.shape} ... CHECKPOINTING") if PARAM_REGISTRY.get('verbose')==True else None
                 fh, fx = checkpoint(checkpoint_fusion_block, 
-                                  (self.fusion_net._modules["fusion_e_block_%d" % i], h1, h2, x1, x2, joint_edge_index, node_mask_1, joint_edge_mask, distances_joint), 
+                                  (self.fusion_net._modules["fusion_e_block_%d" % i], h1, h2, x1, x2, fusion_edge_index, node_mask_1, fusion_edge_mask, distances_joint), 
                                   use_reentrant=False)
             elif use_ckpt and (ckpt_mode == 'all'):
                 print(f"            >>> EGNN [FusionBlock] fusion_e_block_{i} ... h2:{h2.shape}   x2:{x2.shape}   h1:{h1.shape}   x1:{x1.shape} ... CHECKPOINTING") if PARAM_REGISTRY.get('verbose')==True else None
                 fh, fx = checkpoint(checkpoint_fusion_block, 
-                                  (self.fusion_net._modules["fusion_e_block_%d" % i], h1, h2, x1, x2, joint_edge_index, node_mask_1, joint_edge_mask, distances_joint), 
+                                  (self.fusion_net._modules["fusion_e_block_%d" % i], h1, h2, x1, x2, fusion_edge_index, node_mask_1, fusion_edge_mask, distances_joint), 
                                   use_reentrant=False)
             else:
                 print(f"            >>> EGNN [FusionBlock] fusion_e_block_{i} ... h2:{h2.shape}   x2:{x2.shape}   h1:{h1.shape}   x1:{x1.shape}") if PARAM_REGISTRY.get('verbose')==True else None
-                fh, fx = self.fusion_net._modules["fusion_e_block_%d" % i](h1, h2, x1, x2, joint_edge_index, node_mask_1, joint_edge_mask, distances_joint)
+                fh, fx = self.fusion_net._modules["fusion_e_block_%d" % i](h1, h2, x1, x2, fusion_edge_index, node_mask_1, fusion_edge_mask, distances_joint)
 
 
             assert fh.shape == h1.shape, f"Different sizes! fh={fh.shape} h1={h1.shape}"
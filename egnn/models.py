@@ -1,13 +1,47 @@
 import torch
 import torch.nn as nn
-from egnn.egnn_new import EGNN, GNN, low_vram_forward
+from egnn.egnn_new import EGNN, GNN, low_vram_forward, get_edge_index, pack_nodes, pack_edges, unpack_nodes, \
+    get_packed_edge_index, get_neighbor_edge_index
 from egnn.egnn_fusion import EGNN_Fusion, zero_module
 from egnn.egnn_wrapper import ControlNet_Arch_Wrapper
-from equivariant_diffusion.utils import remove_mean, remove_mean_with_mask
+from equivariant_diffusion.utils import remove_mean, remove_mean_with_mask, checks_enabled
 import numpy as np
 from global_registry import PARAM_REGISTRY
 
 
+def packed_egnn_forward(egnn, h, x, node_mask, edge_mask, n_nodes):
+    """Runs egnn on the packed graph of a flattened padded batch: real nodes only,
+       and only the valid i!=j pairs of each molecule as edges. Outputs are
+       scattered back to the padded layout, so callers are unchanged.
+    """
+    packed = pack_nodes(node_mask)
+    node_index = packed[0]
+    edges = pack_edges(edge_mask, n_nodes, n_nodes, packed, packed)
+    h_final, x_final = egnn(h[node_index], x[node_index], edges, node_mask=None, edge_mask=None)
+    return unpack_nodes(h_final, node_index, h.size(0)), unpack_nodes(x_final, node_index, x.size(0))
+
+
+def check_packed_aggregation(aggregation_method, name='aggregation_method'):
+    """packed_graph only matches the dense networks for 'sum' aggregation: dense 'mean' divides
+       by the padded node count and averages in padded slots, which the packed graph drops.
+    """
+    if PARAM_REGISTRY.get('packed_graph', False) and aggregation_method == 'mean':
+        raise ValueError(f"packed_graph does not support {name}='mean', its results would differ from "
+                         f"the dense networks. Use {name}='sum' or disable packed_graph.")
+
+
+def check_neighbor_graph(name, mode, k=None, radius=None):
+    """Validates the {name}_edges neighbour graph settings, at model construction rather than
+       on the first forward pass.
+    """
+    if mode not in ('full', 'knn', 'radius'):
+        raise ValueError(f"Unknown {name}_edges '{mode}', expected 'full', 'knn' or 'radius'.")
+    if mode == 'knn' and (k is None or int(k) <= 0):
+        raise ValueError(f"{name}_edges='knn' needs a positive {name}_knn, got {k}.")
+    if mode == 'radius' and (radius is None or float(radius) <= 0):
+        raise ValueError(f"{name}_edges='radius' needs a positive {name}_radius (in model coordinates), got {radius}.")
+
+
 class EGNN_dynamics_QM9(nn.Module):
     def __init__(self, in_node_nf, context_node_nf,
                  n_dims, hidden_nf=64, device='cpu',
@@ -15,6 +49,7 @@ class EGNN_dynamics_QM9(nn.Module):
                  condition_time=True, tanh=False, mode='egnn_dynamics', norm_constant=0,
                  inv_sublayers=2, sin_embedding=False, normalization_factor=100, aggregation_method='sum'):
         super().__init__()
+        check_packed_aggregation(aggregation_method)
         self.mode = mode
         if mode == 'egnn_dynamics':
             self.egnn = EGNN(
@@ -44,7 +79,6 @@ class EGNN_dynamics_QM9(nn.Module):
         self.context_node_nf = context_node_nf
         self.device = device
         self.n_dims = n_dims
-        self._edges_dict = {}
         self.condition_time = condition_time
 
         # dictionary to store activations
@@ -84,8 +118,6 @@ class EGNN_dynamics_QM9(nn.Module):
         h_dims = dims - self.n_dims  # 4-3 = 1
         # 1
         edges = self.get_adj_matrix(n_nodes, bs, self.device)
-        # ~!to ~!mp
-        edges = [x.to(self.device) for x in edges]
         node_mask = node_mask.view(bs*n_nodes, 1)    # [1600, 1]
         edge_mask = edge_mask.view(bs*n_nodes*n_nodes, 1)  # [40000, 1]
         xh = xh.view(bs*n_nodes, -1).clone() * node_mask
@@ -126,7 +158,10 @@ class EGNN_dynamics_QM9(nn.Module):
             
             # ~!mp
             with torch.autocast(device_type=PARAM_REGISTRY.get('device_'), dtype=PARAM_REGISTRY.get('mixed_precision_autocast_dtype', alt=torch.float16), enabled=PARAM_REGISTRY.get('mixed_precision_training')):
-                h_final, x_final = self.egnn(h, x, edges, node_mask=node_mask, edge_mask=edge_mask)
+                if PARAM_REGISTRY.get('packed_graph', False):
+                    h_final, x_final = packed_egnn_forward(self.egnn, h, x, node_mask, edge_mask, n_nodes)
+                else:
+                    h_final, x_final = self.egnn(h, x, edges, node_mask=node_mask, edge_mask=edge_mask)
             h_final = h_final.float()
             x_final = x_final.float()
             
@@ -159,9 +194,11 @@ class EGNN_dynamics_QM9(nn.Module):
         vel = vel.view(bs, n_nodes, -1)
         # [64, 25, 3]
 
-        if torch.any(torch.isnan(vel)):
+        # the nan reset stays on under every checks policy, without a host sync, only the warning is gated
+        vel_nan = torch.isnan(vel).any()
+        if checks_enabled() and vel_nan:
             print('Warning: detected nan, resetting EGNN output to zero. (EGNN_dynamics_QM9)')
-            vel = torch.zeros_like(vel)
+        vel = torch.where(vel_nan, torch.zeros_like(vel), vel)
 
         if node_mask is None:
             vel = remove_mean(vel)
@@ -175,26 +212,7 @@ class EGNN_dynamics_QM9(nn.Module):
             return torch.cat([vel, h_final], dim=2)
 
     def get_adj_matrix(self, n_nodes, batch_size, device):
-        if n_nodes in self._edges_dict:
-            edges_dic_b = self._edges_dict[n_nodes]
-            if batch_size in edges_dic_b:
-                return edges_dic_b[batch_size]
-            else:
-                # get edges for a single sample
-                rows, cols = [], []
-                for batch_idx in range(batch_size):
-                    for i in range(n_nodes):
-                        for j in range(n_nodes):
-                            rows.append(i + batch_idx * n_nodes)
-                            cols.append(j + batch_idx * n_nodes)
-                # ~!to ~!mp
-                edges = [torch.LongTensor(rows).to(device),
-                         torch.LongTensor(cols).to(device)]
-                edges_dic_b[batch_size] = edges
-                return edges
-        else:
-            self._edges_dict[n_nodes] = {}
-            return self.get_adj_matrix(n_nodes, batch_size, device)
+        return get_edge_index(n_nodes, n_nodes, batch_size, device)
 
 
 class EGNN_encoder_QM9(nn.Module):
@@ -207,6 +225,7 @@ class EGNN_encoder_QM9(nn.Module):
         '''
         :param in_node_nf: Number of invariant features for input nodes.'''
         super().__init__()
+        check_packed_aggregation(aggregation_method)
 
         include_charges = int(include_charges)      # 1
         num_classes = in_node_nf - include_charges      # 6-1 = 5 [HCNOF]
@@ -253,7 +272,6 @@ class EGNN_encoder_QM9(nn.Module):
         self.context_node_nf = context_node_nf   # nf+?
         self.device = device
         self.n_dims = n_dims                     # 3
-        self._edges_dict = {}
         self.out_node_nf = out_node_nf           # 1
         # self.condition_time = condition_time
 
@@ -293,8 +311,6 @@ class EGNN_encoder_QM9(nn.Module):
         edges = self.get_adj_matrix(n_nodes, bs, self.device)   # [row[bs*n_nodes*n_nodes], col[bs*n_nodes*n_nodes]]
         
         # everything passed into the model is flattened, for example to shape [bs*29, 1], [bs*29, ?]
-        # ~!to ~!mp
-        edges = [x.to(self.device) for x in edges]   # row, col
         node_mask = node_mask.view(bs*n_nodes, 1)    # flatten
         edge_mask = edge_mask.view(bs*n_nodes*n_nodes, 1)    # flatten
         xh = xh.view(bs*n_nodes, -1).clone() * node_mask
@@ -319,7 +335,10 @@ class EGNN_encoder_QM9(nn.Module):
             print("[EGNN_encoder_QM9] min(h), max(h), min(x), max(x) :", torch.min(h).item(), torch.max(h).item(), torch.min(x).item(), torch.max(x).item())
             
             with torch.autocast(device_type=PARAM_REGISTRY.get('device_'), dtype=PARAM_REGISTRY.get('mixed_precision_autocast_dtype', alt=torch.float16), enabled=PARAM_REGISTRY.get('mixed_precision_training')):
-                h_final, x_final = self.egnn(h, x, edges, node_mask=node_mask, edge_mask=edge_mask)   # feed to model
+                if PARAM_REGISTRY.get('packed_graph', False):
+                    h_final, x_final = packed_egnn_forward(self.egnn, h, x, node_mask, edge_mask, n_nodes)
+                else:
+                    h_final, x_final = self.egnn(h, x, edges, node_mask=node_mask, edge_mask=edge_mask)   # feed to model
                 if torch.any(torch.isnan(h_final)):
                     print('Warning: detected nan in h_final (EQNN_encoder_QM9) *')
                 if torch.any(torch.isnan(x_final)):
@@ -398,72 +417,7 @@ class EGNN_encoder_QM9(nn.Module):
         return vel_mean, vel_std, h_mean, h_std
     
     def get_adj_matrix(self, n_nodes, batch_size, device):
-        if n_nodes in self._edges_dict:
-            edges_dic_b = self._edges_dict[n_nodes]     # {}
-            # cache
-            if batch_size in edges_dic_b:
-                return edges_dic_b[batch_size]
-            else:
-                # get edges for a single sample
-                rows, cols = [], []
-                # for this batch of molecules
-                for batch_idx in range(batch_size):    # [0-64]
-                    # for each molecule
-                    for i in range(n_nodes):           # 29
-                        for j in range(n_nodes):       # 29
-                            rows.append(i + batch_idx * n_nodes)    # [0-29) + (batch_idx * 29)
-                            cols.append(j + batch_idx * n_nodes)
-                            # originally:
-                            #    rows.apend(i)
-                            #    cols.append(j)
-                            # For row: however, since now we need a row  vector to store all [0-29] valued rows, 
-                            #          we add the term (batch_idx * n_nodes) to get the below. Why? because
-                            #          the molecules' nodes are concatenated together into a long list in the
-                            #          dataloader, hence need for the (batch_idx * n_nodes) to differentiate
-                            #          between which molecule is which.
-                            #
-                            #    [1,2,3,4...29, 30,31,32...39, 40,41,42...49]
-                            #     ^^^^^^^^^^^^  ^^^^^^^^^^^^^  ^^^^^^^^^^^^^
-                            #     molecule 1    molecule 2     molecule 3
-                            # For col: same as row
-                            
-                            
-                            # example: n_nodes=5, batch_size=2
-                            # since here we have n_nodes=5, meaning each molecule has 5 atoms / 5 nodes
-                            #
-                            #               Molecule 1: [0,1,2,3,4]                                                        Molecule 2: [5,6,7,8,9]
-                            #
-                            #  row: tensor([0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 2, 2, 2, 2, 2, 3, 3, 3, 3, 3, 4, 4, 4, 4, 4,     5, 5, 5, 5, 5, 6, 6, 6, 6, 6, 7, 7, 7, 7, 7, 8, 8, 8, 8, 8, 9, 9, 9, 9, 9]), 
-                            #  col: tensor([0, 1, 2, 3, 4, 0, 1, 2, 3, 4, 0, 1, 2, 3, 4, 0, 1, 2, 3, 4, 0, 1, 2, 3, 4,     5, 6, 7, 8, 9, 5, 6, 7, 8, 9, 5, 6, 7, 8, 9, 5, 6, 7, 8, 9, 5, 6, 7, 8, 9])]
-                            #               <----------->  <----------->  <----------->  <----------->  <----------->      <----------->  <----------->  <----------->  <----------->  <----------->  
-                            #               node-0-vs-all  node-1-vs-all  node-2-vs-all  node-3-vs-all  node-4-vs-all      node-0-vs-all  node-1-vs-all  node-2-vs-all  node-3-vs-all  node-4-vs-all
-                            #               <----------------------------------------------------------------------->      <----------------------------------------------------------------------->
-                            #                           all possible node combinations in molecule 1                                   all possible node combinations in molecule 2
-                            #               <------------------------------------------------------------------------------------------------------------------------------------------------------>
-                            #                                                                        batch size = 2   (2 molecules per batch)
-                            
-                            
-                            
-                            # later in EGNN model (..etc), used to index out h into h[row], h[col]:
-                            # self.edge_model(h[row], h[col], edge_attr, edge_mask)
-                            #
-                            # then concatenated together:
-                            # if edge_attr is None:  # Unused.
-                            #     out = torch.cat([source, target], dim=1)        # torch.Size([46656, 256+256])
-                            # else:
-                            #     out = torch.cat([source, target, edge_attr], dim=1)
-                                                
-                            # For each sample, it iterates over all possible pairs of nodes and generates 
-                            # edges between them. The edge lists are then stored as tensors representing 
-                            # the rows and columns of the adjacency matrix.
-                # ~!to ~!mp
-                edges = [torch.LongTensor(rows).to(device),
-                         torch.LongTensor(cols).to(device)]     # [row[bs*n_nodes*n_nodes], col[bs*n_nodes*n_nodes]]
-                edges_dic_b[batch_size] = edges
-                return edges
-        else:
-            self._edges_dict[n_nodes] = {}    # precomputed adj matrix for diff batch sizes
-            return self.get_adj_matrix(n_nodes, batch_size, device)
+        return get_edge_index(n_nodes, n_nodes, batch_size, device)
 
 
 class EGNN_decoder_QM9(nn.Module):
@@ -474,6 +428,7 @@ class EGNN_decoder_QM9(nn.Module):
                  inv_sublayers=2, sin_embedding=False, normalization_factor=100, aggregation_method='sum',
                  include_charges=True):
         super().__init__()
+        check_packed_aggregation(aggregation_method)
 
         include_charges = int(include_charges)        # 1
         num_classes = out_node_nf - include_charges   # 6-1 = 5 [HCNOF]
@@ -510,7 +465,6 @@ class EGNN_decoder_QM9(nn.Module):
         self.context_node_nf = context_node_nf # nf+?
         self.device = device
         self.n_dims = n_dims  # 3
-        self._edges_dict = {}
         # self.condition_time = condition_time
 
         # dictionary to store activations
@@ -552,8 +506,6 @@ class EGNN_decoder_QM9(nn.Module):
         # 4-3 = 1
         
         edges = self.get_adj_matrix(n_nodes, bs, self.device)
-        # ~!to ~!mp
-        edges = [x.to(self.device) for x in edges]
         node_mask = node_mask.view(bs*n_nodes, 1)
         edge_mask = edge_mask.view(bs*n_nodes*n_nodes, 1)
         xh = xh.view(bs*n_nodes, -1).clone() * node_mask
@@ -577,7 +529,10 @@ class EGNN_decoder_QM9(nn.Module):
             print(f"        >>> DECODER (B4) h:{torch.isnan(h).any()} x:{torch.isnan(x).any()}  node_mask:{torch.isnan(node_mask).any()}  edge_mask:{torch.isnan(edge_mask).any()}") if PARAM_REGISTRY.get('verbose')==True else None
             # ~!mp
             with torch.autocast(device_type=PARAM_REGISTRY.get('device_'), dtype=PARAM_REGISTRY.get('mixed_precision_autocast_dtype', alt=torch.float16), enabled=PARAM_REGISTRY.get('mixed_precision_training')):
-                h_final, x_final = self.egnn(h, x, edges, node_mask=node_mask, edge_mask=edge_mask)
+                if PARAM_REGISTRY.get('packed_graph', False):
+                    h_final, x_final = packed_egnn_forward(self.egnn, h, x, node_mask, edge_mask, n_nodes)
+                else:
+                    h_final, x_final = self.egnn(h, x, edges, node_mask=node_mask, edge_mask=edge_mask)
             h_final = h_final.float()
             x_final = x_final.float()
             
@@ -597,9 +552,10 @@ class EGNN_decoder_QM9(nn.Module):
         vel = vel.view(bs, n_nodes, -1)
         # [64, 27, 3]
 
-        if torch.any(torch.isnan(vel)):
+        vel_nan = torch.isnan(vel).any()
+        if checks_enabled() and vel_nan:
             print('Warning: detected nan, resetting EGNN output to zero. (EGNN_decoder_QM9)')
-            vel = torch.zeros_like(vel)
+        vel = torch.where(vel_nan, torch.zeros_like(vel), vel)
 
         if node_mask is None:
             vel = remove_mean(vel)
@@ -615,26 +571,7 @@ class EGNN_decoder_QM9(nn.Module):
         return vel, h_final
     
     def get_adj_matrix(self, n_nodes, batch_size, device):
-        if n_nodes in self._edges_dict:
-            edges_dic_b = self._edges_dict[n_nodes]
-            if batch_size in edges_dic_b:
-                return edges_dic_b[batch_size]
-            else:
-                # get edges for a single sample
-                rows, cols = [], []
-                for batch_idx in range(batch_size):
-                    for i in range(n_nodes):
-                        for j in range(n_nodes):
-                            rows.append(i + batch_idx * n_nodes)
-                            cols.append(j + batch_idx * n_nodes)
-                # ~!to ~!mp
-                edges = [torch.LongTensor(rows).to(device),
-                         torch.LongTensor(cols).to(device)]
-                edges_dic_b[batch_size] = edges
-                return edges
-        else:
-            self._edges_dict[n_nodes] = {}
-            return self.get_adj_matrix(n_nodes, batch_size, device)
+        return get_edge_index(n_nodes, n_nodes, batch_size, device)
 
 
 
@@ -648,6 +585,7 @@ class EGNN_dynamics_fusion(nn.Module):
                  inv_sublayers=2, sin_embedding=False, normalization_factor=100, aggregation_method='sum',
                  zero_weights=True):
         super().__init__()
+        check_packed_aggregation(aggregation_method)
         self.mode = mode
         if mode == 'egnn_dynamics':
             self.egnn_fusion = EGNN_Fusion(
@@ -681,7 +619,6 @@ class EGNN_dynamics_fusion(nn.Module):
         self.context_node_nf = context_node_nf
         self.device = device
         self.n_dims = n_dims
-        # self._edges_dict = {}
         self.condition_time = condition_time
 
         # dictionary to store activations
@@ -707,16 +644,7 @@ class EGNN_dynamics_fusion(nn.Module):
         raise NotImplementedError
 
     def get_adj_matrix(self, n_nodes_1, n_nodes_2, batch_size, device):
-        n1, n2 = [], []
-        for batch_idx in range(batch_size):
-            for i in range(n_nodes_1):
-                for j in range(n_nodes_2):
-                    n1.append(i + batch_idx * n_nodes_1)
-                    n2.append(j + batch_idx * n_nodes_2)
-        # ~!to ~!mp
-        edges = [torch.LongTensor(n1).to(device),
-                torch.LongTensor(n2).to(device)]
-        return edges
+        return get_edge_index(n_nodes_1, n_nodes_2, batch_size, device)
 
 
 
@@ -725,8 +653,10 @@ class ControlNet_Module_Wrapper(nn.Module):
     def __init__(self, diffusion_network, control_network, fusion_network, 
                  fusion_weights=[], fusion_mode='scaled_sum', device=None,
                  noise_injection_weights=[0.5, 0.5], noise_injection_aggregation_method='mean', noise_injection_normalization_factor=1.,
-                 time_noisy=False):
+                 time_noisy=False, pocket_edges='full', pocket_knn=None, pocket_radius=None,
+                 fusion_edges='full', fusion_knn=None, fusion_radius=None):
         super().__init__()
+        check_packed_aggregation(noise_injection_aggregation_method, 'noise_injection_aggregation_method')
 
         if not isinstance(diffusion_network, EGNN_dynamics_QM9):
             raise NotImplementedError()
@@ -774,6 +704,16 @@ class ControlNet_Module_Wrapper(nn.Module):
         self.condition_time = diffusion_network.condition_time
         self.time_noisy = time_noisy     # referenced from ControlMol [https://arxiv.org/abs/2405.06659]
 
+        # neighbour graphs for the pocket (ControlNet) and ligand-pocket (Fusion) edges: full | knn | radius
+        check_neighbor_graph('pocket', pocket_edges, pocket_knn, pocket_radius)
+        check_neighbor_graph('fusion', fusion_edges, fusion_knn, fusion_radius)
+        self.pocket_edges = pocket_edges
+        self.pocket_knn = pocket_knn
+        self.pocket_radius = pocket_radius
+        self.fusion_edges = fusion_edges
+        self.fusion_knn = fusion_knn
+        self.fusion_radius = fusion_radius
+
         # dictionary to store activations
         self.input_activations = {}
         self.output_activations = {}
@@ -793,7 +733,80 @@ class ControlNet_Module_Wrapper(nn.Module):
         return self.hook_handles
 
 
-    def _forward(self, t, xh1, xh2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context):
+    def get_condition(self, xh2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask):
+        """
+        Step-invariant inputs of _forward() for a fixed pocket batch: the graphs, the flattened masks,
+        the masked pocket (x2, h2) and the pocket edge attributes (distances_2).
+        Sampling builds it once from the encoded pocket and passes it to every reverse step as `condition`,
+        otherwise _forward() builds it per call.
+        """
+        bs_1, n_nodes_1 = node_mask_1.size(0), node_mask_1.size(1)
+        bs_2, n_nodes_2, dims_2 = xh2.shape
+        assert bs_1 == bs_2, f"Different batch size encountered! bs_1={bs_1} bs_2={bs_2}"
+
+        node_mask_1 = node_mask_1.view(bs_1*n_nodes_1, 1)    # [1600, 1]
+        edge_mask_1 = edge_mask_1.view(bs_1*n_nodes_1*n_nodes_1, 1)  # [40000, 1]
+        node_mask_2 = node_mask_2.view(bs_2*n_nodes_2, 1)    # [1600, 1]
+        edge_mask_2 = edge_mask_2.view(bs_2*n_nodes_2*n_nodes_2, 1)  # [40000, 1]
+        joint_edge_mask = joint_edge_mask.view(bs_1*n_nodes_1*n_nodes_2, 1)
+
+        xh2 = xh2.view(bs_2*n_nodes_2, -1).clone() * node_mask_2
+        x2 = xh2[:, 0:self.n_dims].clone()
+        if dims_2 == self.n_dims:
+            # ~!to ~!mp
+            h2 = torch.ones(bs_2*n_nodes_2, 1).to(self.device)
+        else:
+            h2 = xh2[:, self.n_dims:].clone()
+
+        condition = {
+            'packed': PARAM_REGISTRY.get('packed_graph', False),
+            'node_mask_1': node_mask_1,
+            'edge_mask_1': edge_mask_1,
+            'node_mask_2': node_mask_2,
+            'edge_mask_2': edge_mask_2,
+            'joint_edge_mask': joint_edge_mask,
+            'x2': x2,
+            'h2': h2
+        }
+
+        # ~!mp
+        with torch.autocast(device_type=PARAM_REGISTRY.get('device_'), dtype=PARAM_REGISTRY.get('mixed_precision_autocast_dtype', alt=torch.float16), enabled=PARAM_REGISTRY.get('mixed_precision_training')):
+            if condition['packed']:
+                # real ligand / pocket atoms only, and only valid ligand, pocket and ligand-pocket pairs
+                packed_1, packed_2 = pack_nodes(node_mask_1), pack_nodes(node_mask_2)
+                node_index_2 = packed_2[0]
+                condition.update({
+                    'node_index_1': packed_1[0],
+                    'packed_1': packed_1,
+                    'node_index_2': node_index_2,
+                    'packed_2': packed_2,
+                    # enumerated from the node counts, no nonzero over the padded dense masks
+                    'edge_index_1': get_packed_edge_index(node_mask_1, node_mask_1, bs_1, exclude_self=True),
+                    'edge_index_2': get_packed_edge_index(node_mask_2, node_mask_2, bs_2, exclude_self=True),
+                    'joint_edge_index': get_packed_edge_index(node_mask_1, node_mask_2, bs_1)
+                })
+                if self.pocket_edges != 'full':
+                    # sparse pocket neighbour graph, from the (fixed) pocket coordinates
+                    condition['edge_index_2'] = get_neighbor_edge_index(x2, x2, node_mask_2, node_mask_2, bs_2, self.pocket_edges,
+                                                                        self.pocket_knn, self.pocket_radius, exclude_self=True,
+                                                                        packed_1=packed_2, packed_2=packed_2)
+                condition['distances_2'] = self.controlnet_arch_wrapper.pocket_edge_attr(x2[node_index_2], condition['edge_index_2'])
+            else:
+                edges_2 = self.control_network.get_adj_matrix(n_nodes_2, bs_2, self.device)
+                if self.pocket_edges != 'full':
+                    # sparse pocket neighbour graph over the real pocket nodes (padded node indices)
+                    edges_2 = get_neighbor_edge_index(x2, x2, node_mask_2, node_mask_2, bs_2, self.pocket_edges,
+                                                      self.pocket_knn, self.pocket_radius, exclude_self=True)
+                condition.update({
+                    'edge_index_1': self.diffusion_network.get_adj_matrix(n_nodes_1, bs_1, self.device),
+                    'edge_index_2': edges_2,
+                    'joint_edge_index': self.fusion_network.get_adj_matrix(n_nodes_1, n_nodes_2, bs_1, self.device)
+                })
+                condition['distances_2'] = self.controlnet_arch_wrapper.pocket_edge_attr(x2, edges_2)
+        return condition
+
+
+    def _forward(self, t, xh1, xh2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context, condition=None):
         print(f"        >>> ControlNet_Module_Wrapper t:{torch.isnan(t).any()}  xh1:{torch.isnan(xh1).any()}  xh2:{torch.isnan(xh2).any()}  \
             node_mask_1:{torch.isnan(node_mask_1).any()}  node_mask_2:{torch.isnan(node_mask_2).any()}  edge_mask_1:{torch.isnan(edge_mask_1).any()}  \
                 edge_mask_2:{torch.isnan(edge_mask_2).any()}  joint_edge_mask:{torch.isnan(joint_edge_mask).any()}") if PARAM_REGISTRY.get('verbose')==True else None
@@ -803,40 +816,40 @@ class ControlNet_Module_Wrapper(nn.Module):
         
         assert bs_1 == bs_2, f"Different batch size encountered! bs_1={bs_1} bs_2={bs_2}"
         assert dims_1 == dims_2, f"Different num embeddings encountered! dims_1={dims_1} dims_2={dims_2}"
-        
+
+        if condition is None:
+            condition = self.get_condition(xh2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask)
         
         # 64, 25, 4
         h_dims = dims_1 - self.n_dims  # 4-3 = 1
         # 1
-        edges_1 = self.diffusion_network.get_adj_matrix(n_nodes_1, bs_1, self.device)
-        edges_2 = self.control_network.get_adj_matrix(n_nodes_2, bs_2, self.device)
-        edges_joint = self.fusion_network.get_adj_matrix(n_nodes_1, n_nodes_2, bs_1, self.device)
-        
-        # ~!to ~!mp
-        edges_1 = [x.to(self.device) for x in edges_1]
-        node_mask_1 = node_mask_1.view(bs_1*n_nodes_1, 1)    # [1600, 1]
-        edge_mask_1 = edge_mask_1.view(bs_1*n_nodes_1*n_nodes_1, 1)  # [40000, 1]
+        node_mask_1 = condition['node_mask_1']  # [1600, 1]
+        edge_mask_1 = condition['edge_mask_1']  # [40000, 1]
         xh1 = xh1.view(bs_1*n_nodes_1, -1).clone() * node_mask_1
         x1 = xh1[:, 0:self.n_dims].clone()
 
-        edges_2 = [x.to(self.device) for x in edges_2]
-        node_mask_2 = node_mask_2.view(bs_2*n_nodes_2, 1)    # [1600, 1]
-        edge_mask_2 = edge_mask_2.view(bs_2*n_nodes_2*n_nodes_2, 1)  # [40000, 1]
-        xh2 = xh2.view(bs_2*n_nodes_2, -1).clone() * node_mask_2
-        x2 = xh2[:, 0:self.n_dims].clone()
+        node_mask_2 = condition['node_mask_2']  # [1600, 1]
+        edge_mask_2 = condition['edge_mask_2']  # [40000, 1]
+        x2 = condition['x2']
         
-        edges_joint = [x.to(self.device) for x in edges_joint]
-        joint_edge_mask = joint_edge_mask.view(bs_1*n_nodes_1*n_nodes_2, 1)
+        joint_edge_mask = condition['joint_edge_mask']
+
+        # sparse ligand-pocket neighbour graph, rebuilt every call (i.e. every diffusion step) from the current coordinates
+        fusion_edges, fusion_edge_mask = None, joint_edge_mask
+        if self.fusion_edges != 'full':
+            fusion_edges = get_neighbor_edge_index(x1, x2, node_mask_1, node_mask_2, bs_1, self.fusion_edges,
+                                                   self.fusion_knn, self.fusion_radius,
+                                                   packed_1=condition.get('packed_1'), packed_2=condition.get('packed_2'))
+            fusion_edge_mask = None
         
         # [1600, 3]
         if h_dims == 0:
             # ~!to ~!mp
             h1 = torch.ones(bs_1*n_nodes_1, 1).to(self.device)
-            h2 = torch.ones(bs_2*n_nodes_2, 1).to(self.device)
         else:
             h1 = xh1[:, self.n_dims:].clone()
-            h2 = xh2[:, self.n_dims:].clone()
             # [1600, 1]
+        h2 = condition['h2']
         
         # t.size()
         # random time samples of shape [64, 1] : bs, values ranging from 0. - 1.
@@ -890,15 +903,33 @@ class ControlNet_Module_Wrapper(nn.Module):
 
             # ~!mp
             with torch.autocast(device_type=PARAM_REGISTRY.get('device_'), dtype=PARAM_REGISTRY.get('mixed_precision_autocast_dtype', alt=torch.float16), enabled=PARAM_REGISTRY.get('mixed_precision_training')):
-                h_final, x_final = self.controlnet_arch_wrapper(h1=h1, h2=h2, x1=x1, x2=x2,
-                                                                node_mask_1=node_mask_1,
-                                                                node_mask_2=node_mask_2,
-                                                                edge_mask_1=edge_mask_1,
-                                                                edge_mask_2=edge_mask_2,
-                                                                edge_index_1=edges_1,
-                                                                edge_index_2=edges_2,
-                                                                joint_edge_index=edges_joint,
-                                                                joint_edge_mask=joint_edge_mask)
+                if condition['packed']:
+                    node_index_1, node_index_2 = condition['node_index_1'], condition['node_index_2']
+                    h_final, x_final = self.controlnet_arch_wrapper(h1=h1[node_index_1], h2=h2[node_index_2],
+                                                                    x1=x1[node_index_1], x2=x2[node_index_2],
+                                                                    edge_index_1=condition['edge_index_1'],
+                                                                    edge_index_2=condition['edge_index_2'],
+                                                                    joint_edge_index=condition['joint_edge_index'],
+                                                                    fusion_edge_index=fusion_edges,
+                                                                    distances_2=condition['distances_2'])
+                    h_final = unpack_nodes(h_final, node_index_1, h1.size(0))
+                    x_final = unpack_nodes(x_final, node_index_1, x1.size(0))
+                else:
+                    # sparse graphs: only the neighbour edges reach the GCLs, no masks
+                    if self.pocket_edges != 'full':
+                        edge_mask_2 = None
+                    h_final, x_final = self.controlnet_arch_wrapper(h1=h1, h2=h2, x1=x1, x2=x2,
+                                                                    node_mask_1=node_mask_1,
+                                                                    node_mask_2=node_mask_2,
+                                                                    edge_mask_1=edge_mask_1,
+                                                                    edge_mask_2=edge_mask_2,
+                                                                    edge_index_1=condition['edge_index_1'],
+                                                                    edge_index_2=condition['edge_index_2'],
+                                                                    joint_edge_index=condition['joint_edge_index'],
+                                                                    joint_edge_mask=joint_edge_mask,
+                                                                    fusion_edge_index=fusion_edges,
+                                                                    fusion_edge_mask=fusion_edge_mask,
+                                                                    distances_2=condition['distances_2'])
             h_final = h_final.float()
             x_final = x_final.float()
 
@@ -930,9 +961,10 @@ class ControlNet_Module_Wrapper(nn.Module):
         vel = vel.view(bs_1, n_nodes_1, -1)
         # [64, 25, 3]
 
-        if torch.any(torch.isnan(vel)):
+        vel_nan = torch.isnan(vel).any()
+        if checks_enabled() and vel_nan:
             print('Warning: detected nan, resetting EGNN output to zero. (EGNN_dynamics_QM9)')
-            vel = torch.zeros_like(vel)
+        vel = torch.where(vel_nan, torch.zeros_like(vel), vel)
 
         if node_mask_1 is None:
             vel = remove_mean(vel)
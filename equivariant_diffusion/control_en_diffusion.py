@@ -112,15 +112,20 @@ class ControlEnLatentDiffusion(EnLatentDiffusion):
         return log_p_xh_given_z
 
 
-    def forward(self, x1, h1, x2, h2, node_mask_1=None, node_mask_2=None, edge_mask_1=None, edge_mask_2=None, joint_edge_mask=None, context=None):
+    def forward(self, x1, h1, x2, h2, node_mask_1=None, node_mask_2=None, edge_mask_1=None, edge_mask_2=None, joint_edge_mask=None, context=None,
+                z_xh_mean_2=None):
         """
         Computes the loss (type l2 or NLL) if training. And if eval then always computes NLL.
+        z_xh_mean_2: precomputed pocket encoder latent means (pocket latent cache), skips the pocket VAE encoder.
         """
 
         """ VAE Encoding """
         # Encode data to latent space.
         z_x_mu_1, z_x_sigma_1, z_h_mu_1, z_h_sigma_1 = self.ligand_vae.encode(x1, h1, node_mask_1, edge_mask_1, context)
-        z_x_mu_2, z_x_sigma_2, z_h_mu_2, z_h_sigma_2 = self.pocket_vae.encode(x2, h2, node_mask_2, edge_mask_2, context)
+        if z_xh_mean_2 is None:
+            z_x_mu_2, z_x_sigma_2, z_h_mu_2, z_h_sigma_2 = self.pocket_vae.encode(x2, h2, node_mask_2, edge_mask_2, context)
+        else:
+            assert not self.trainable_pocket_ae_encoder, "Cached pocket latents require a frozen pocket VAE encoder"
 
         # ~!fp16
         # self.gamma = self.gamma.to(x.device)
@@ -137,7 +142,8 @@ class ControlEnLatentDiffusion(EnLatentDiffusion):
 
         # Infer latent z.
         z_xh_mean_1 = torch.cat([z_x_mu_1, z_h_mu_1], dim=2)
-        z_xh_mean_2 = torch.cat([z_x_mu_2, z_h_mu_2], dim=2)
+        if z_xh_mean_2 is None:
+            z_xh_mean_2 = torch.cat([z_x_mu_2, z_h_mu_2], dim=2)
         
         # tmp
         # z_xh_mean = z_xh_mean * node_mask
@@ -350,31 +356,55 @@ class ControlEnLatentDiffusion(EnLatentDiffusion):
                 }
 
 
-    def phi(self, t, xh1, xh2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context):
-        net_out = self.dynamics._forward(t, xh1, xh2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context)
+    def phi(self, t, xh1, xh2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context, condition=None):
+        net_out = self.dynamics._forward(t, xh1, xh2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context, condition=condition)
 
         return net_out
 
 
     @torch.no_grad()
-    def sample(self, n_samples, n_nodes, x2, h2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context, fix_noise=False):
+    def encode_pocket(self, x2, h2, node_mask_2, edge_mask_2, context):
+        """Pocket latent means [bs, n_nodes_2, n_dims + latent_nf] of the (uncentered) pockets x2, h2."""
+        x2 = diffusion_utils.remove_mean_with_mask(x2, node_mask_2)
+        z_x_mu_2, z_x_sigma_2, z_h_mu_2, z_h_sigma_2 = self.pocket_vae.encode(x2, h2, node_mask_2, edge_mask_2, context)
+
+        z_xh_mean_2 = torch.cat([z_x_mu_2, z_h_mu_2], dim=2)
+        diffusion_utils.assert_correctly_masked(z_xh_mean_2, node_mask_2)
+        return z_xh_mean_2
+
+
+    @torch.no_grad()
+    def sample(self, n_samples, n_nodes, x2, h2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context, fix_noise=False,
+               num_sampling_steps=None, eta=None, solver='ddim', solver_order=2, pocket_index=None, z_xh_mean_2=None):
         """
         Draw samples from the generative model.
-        NOTE: full timesteps T.
+        NOTE: full timesteps T, unless num_sampling_steps is given, in which case a strided
+              DDIM-style sampler is used (eta=0. deterministic (default), eta=1. ancestral variance).
+              solver='dpm_solver' integrates the probability-flow ODE instead, with a
+              solver_order (2 | 3) multistep DPM-Solver++ over num_sampling_steps.
+              pocket_index [n_samples] (optional) maps every ligand slot to its pocket, in which case
+              x2, h2, node_mask_2 and edge_mask_2 only hold the unique pockets: each is encoded once
+              and its latent mean is broadcast to its ligand slots (joint_edge_mask is per slot).
+              z_xh_mean_2 (optional): encode_pocket() of the pockets, computed beforehand (x2, h2 unused).
         """
         
         """ VAE Encoding """
         # Encode data to latent space.
-        x2 = diffusion_utils.remove_mean_with_mask(x2, node_mask_2)
-        z_x_mu_2, z_x_sigma_2, z_h_mu_2, z_h_sigma_2 = self.pocket_vae.encode(x2, h2, node_mask_2, edge_mask_2, context)
+        if z_xh_mean_2 is None:
+            z_xh_mean_2 = self.encode_pocket(x2, h2, node_mask_2, edge_mask_2, context)
 
-        z_xh_mean_2 = torch.cat([z_x_mu_2, z_h_mu_2], dim=2)
-        diffusion_utils.assert_correctly_masked(z_xh_mean_2, node_mask_2)
+        if pocket_index is not None:
+            # unique pockets -> ligand slots
+            pocket_index = pocket_index.to(z_xh_mean_2.device)
+            n_nodes_2 = node_mask_2.size(1)
+            z_xh_mean_2 = z_xh_mean_2[pocket_index]
+            node_mask_2 = node_mask_2[pocket_index]
+            edge_mask_2 = edge_mask_2.view(-1, n_nodes_2 * n_nodes_2)[pocket_index].view(-1, 1)
 
         # Compute fixed sigma values.
-        t_zeros_2 = torch.zeros(size=(x2.size(0), 1), device=x2.device)
-        gamma_0_2 = self.inflate_batch_array(self.gamma(t_zeros_2), x2)
-        sigma_0_2 = self.sigma(gamma_0_2, x2)
+        t_zeros_2 = torch.zeros(size=(z_xh_mean_2.size(0), 1), device=z_xh_mean_2.device)
+        gamma_0_2 = self.inflate_batch_array(self.gamma(t_zeros_2), z_xh_mean_2)
+        sigma_0_2 = self.sigma(gamma_0_2, z_xh_mean_2)
 
         z_xh_mean_2 = self.pocket_vae.sample_normal(z_xh_mean_2, sigma_0_2, node_mask_2)
 
@@ -388,7 +418,13 @@ class ControlEnLatentDiffusion(EnLatentDiffusion):
         # Make the data structure compatible with the EnVariationalDiffusion compute_loss().
         z_h_2 = {'categorical': torch.zeros(0).to(z_h_2), 'integer': z_h_2}
         xh2 = torch.cat([z_x_2, z_h_2['categorical'], z_h_2['integer']], dim=2)  # from compute_loss, next line should be self.phi()
+        # NOTE: the pocket latent is read-only over all steps (the dynamics copy it before
+        #       any in-place update), so it is shared across steps instead of cloned per step.
         zt_2 = xh2
+        zt_2_version = zt_2._version
+
+        # Pocket-side graphs, masks and edge attributes, shared by all the reverse steps.
+        condition = self.dynamics.get_condition(zt_2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask)
 
         if fix_noise:
             # Noise is broadcasted over the batch axis, useful for visualizations.
@@ -401,23 +437,34 @@ class ControlEnLatentDiffusion(EnLatentDiffusion):
 
         diffusion_utils.assert_mean_zero_with_mask(z[:, :, :self.n_dims], node_mask_1)
 
-        # Iteratively sample p(z_s | z_t) for t = 1, ..., T, with s = t - 1.
-        for s in reversed(range(0, self.T)):
-            s_array = torch.full((n_samples, 1), fill_value=s, device=z.device)
-            t_array = s_array + 1
-            s_array = s_array / self.T
-            t_array = t_array / self.T
-
-            # from T -> t=1
-            # NOTE: xt_2 must remain unchanged: zt_2.clone()
-            z = self.sample_p_zs_given_zt(s_array, t_array, z, zt_2.clone(), node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context, fix_noise=fix_noise)
+        if solver == 'dpm_solver':
+            # from T -> t=0, deterministic
+            z = self.sample_dpm_solver(
+                z, lambda zt_1, t: self.phi(t, zt_1, zt_2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context, condition=condition),
+                n_samples, node_mask_1, num_sampling_steps, order=solver_order)
+        elif solver == 'ddim':
+            # Iteratively sample p(z_s | z_t) for t = 1, ..., T, with s = t - 1.
+            # (or over the strided timesteps if num_sampling_steps is set)
+            schedule = SamplingScheduleCache(self, self.get_sampling_timesteps(num_sampling_steps), n_samples, z.device,
+                                             eta=self.get_sampling_eta(num_sampling_steps, eta))
+            workspace = SamplerWorkspace(z, node_mask_1, self.n_dims, fix_noise=fix_noise)
+            z = workspace.zt
+            for i in reversed(range(0, len(schedule))):
+                s_array, t_array, coefficients = schedule.step(i)
+
+                # from T -> t=1
+                z = self.sample_p_zs_given_zt(s_array, t_array, z, zt_2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context, fix_noise=fix_noise,
+                                              coefficients=coefficients, workspace=workspace, condition=condition)
+        else:
+            raise ValueError(f"Unknown sampling solver: {solver}")
 
         # Final sample z0, t=0
         # Finally sample p(x, h | z_0).
-        # NOTE: xt_2 must remain unchanged: zt_2.clone()
-        z_x, z_h = self.sample_p_xh_given_z0(z, zt_2.clone(), node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context, fix_noise=fix_noise)
+        z_x, z_h = self.sample_p_xh_given_z0(z, zt_2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context, fix_noise=fix_noise,
+                                             condition=condition)
 
         diffusion_utils.assert_mean_zero_with_mask(z_x, node_mask_1)
+        assert zt_2._version == zt_2_version, "pocket latent zt_2 was modified in place during sampling"
 
         # remove velocity
         max_cog = torch.sum(z_x, dim=1, keepdim=True).abs().max().item()
@@ -440,55 +487,36 @@ class ControlEnLatentDiffusion(EnLatentDiffusion):
 
 
 
-    def sample_p_zs_given_zt(self, s, t, zt_1, zt_2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context, fix_noise=False):
+    def sample_p_zs_given_zt(self, s, t, zt_1, zt_2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context, fix_noise=False, eta=None, coefficients=None,
+                             workspace=None, condition=None):
         """
         Samples from zs ~ p(zs | zt). Only used during sampling. 
         NOTE: One sampling step. (NOT final step z0)
+              s may be any time before t when eta is given (strided DDIM-style step).
+              coefficients (from SamplingScheduleCache) skip recomputing the schedule.
+              workspace (SamplerWorkspace) computes zs in place in its preallocated buffers.
+              zt_2 (pocket latent) is only read, condition (from dynamics.get_condition()) holds its
+              step-invariant graphs and edge attributes.
         """
-        gamma_s = self.gamma(s)
-        gamma_t = self.gamma(t)
-
-        sigma2_t_given_s, sigma_t_given_s, alpha_t_given_s = \
-            self.sigma_and_alpha_t_given_s(gamma_t, gamma_s, zt_1)
-
-        sigma_s = self.sigma(gamma_s, target_tensor=zt_1)
-        sigma_t = self.sigma(gamma_t, target_tensor=zt_1)
+        if coefficients is None:
+            coefficients = self.get_step_coefficients(self.gamma(s), self.gamma(t), eta)
+            coefficients = {key: self.inflate_batch_array(value, zt_1) for key, value in coefficients.items()}
+        diffusion_utils.checks_step('sampling')
 
         # Neural net prediction.
-        eps_t = self.phi(t, zt_1, zt_2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context)
-
-        # Compute mu for p(zs | zt).
-        diffusion_utils.assert_mean_zero_with_mask(zt_1[:, :, :self.n_dims], node_mask_1)
-        diffusion_utils.assert_mean_zero_with_mask(eps_t[:, :, :self.n_dims], node_mask_1)
-        mu = zt_1 / alpha_t_given_s - (sigma2_t_given_s / alpha_t_given_s / sigma_t) * eps_t
-
-        # Compute sigma for p(zs | zt).
-        sigma = sigma_t_given_s * sigma_s / sigma_t
-
-        # Sample zs given the paramters derived from zt.
-        # z_x = utils.sample_center_gravity_zero_gaussian_with_mask(..)
-        # z_h = utils.sample_gaussian_with_mask(..)
-        # eps = torch.cat([z_x, z_h], dim=2)
-        # zs = mu + sigma * eps
-        zs = self.sample_normal(mu, sigma, node_mask_1, fix_noise)
+        eps_t = self.phi(t, zt_1, zt_2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context, condition=condition)
 
-        # Project down to avoid numerical runaway of the center of gravity.
-        zs = torch.cat(
-            [diffusion_utils.remove_mean_with_mask(zs[:, :, :self.n_dims],
-                                                   node_mask_1),
-             zs[:, :, self.n_dims:]], dim=2
-        )
-        return zs
+        return self.compute_zs(zt_1, eps_t, node_mask_1, coefficients, fix_noise, workspace=workspace)
 
 
 
-    def sample_p_xh_given_z0(self, z0, zt_2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context, fix_noise=False):
+    def sample_p_xh_given_z0(self, z0, zt_2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context, fix_noise=False, condition=None):
         """Samples x ~ p(x|z0)."""
         zeros = torch.zeros(size=(z0.size(0), 1), device=z0.device)
         gamma_0 = self.gamma(zeros)
         # Computes sqrt(sigma_0^2 / alpha_0^2)
         sigma_x = self.SNR(-0.5 * gamma_0).unsqueeze(1)
-        net_out = self.phi(zeros, z0, zt_2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context)
+        net_out = self.phi(zeros, z0, zt_2, node_mask_1, node_mask_2, edge_mask_1, edge_mask_2, joint_edge_mask, context, condition=condition)
 
         # Compute mu for p(zs | zt).
         mu_x = self.compute_x_pred(net_out, z0, gamma_0)
@@ -307,6 +307,105 @@ def cdf_standard_gaussian(x):
     return 0.5 * (1. + torch.erf(x / math.sqrt(2)))
 
 
+class SamplingScheduleCache:
+    """
+    Noise schedule lookup tables for one sampling run over the integer `timesteps`
+    (ascending, [0, ..., T]), built once so the reverse steps only index into them.
+    Per grid point k: t[k] (the [n_samples, 1] network time input), gamma, alpha, sigma, lambda_.
+    Per step i (timesteps[i+1] -> timesteps[i]): the get_step_coefficients() tensors.
+    All schedule tensors are shaped [K, 1, 1] to broadcast against [bs, n_nodes, nf].
+    """
+    def __init__(self, model, timesteps, n_samples, device, eta=None):
+        self.timesteps = timesteps
+
+        t = torch.tensor(timesteps, device=device).view(-1, 1) / model.T
+        gamma = model.gamma(t)
+
+        self.t = t.view(-1, 1, 1).expand(-1, n_samples, 1).contiguous()
+        self.gamma = gamma.view(-1, 1, 1)
+        self.alpha = model.alpha(gamma, target_tensor=gamma).view(-1, 1, 1)
+        self.sigma = model.sigma(gamma, target_tensor=gamma).view(-1, 1, 1)
+        self.lambda_ = (-0.5 * gamma).view(-1, 1, 1)
+
+        coefficients = model.get_step_coefficients(gamma[:-1], gamma[1:], eta)
+        self.coefficients = {key: value.view(-1, 1, 1) for key, value in coefficients.items()}
+
+    def __len__(self):
+        return len(self.timesteps) - 1
+
+    def step(self, i):
+        """s_array, t_array and the coefficients of the step timesteps[i+1] -> timesteps[i]."""
+        return self.t[i], self.t[i + 1], {key: value[i] for key, value in self.coefficients.items()}
+
+
+class SamplerWorkspace:
+    """
+    Preallocated buffers for the reverse-step loop of one sampling run, so that
+    zs = mu_zt * zt - mu_eps * eps_t + sigma * eps is computed in place instead of
+    allocating mu, the noise and the re-joined [x, h] tensor at every step.
+    z is ping-ponged between two buffers: the one holding zt (still read by the caller
+    and the network) is never written, the other receives zs.
+    The x / h noise is drawn into separate contiguous buffers, in the same order as
+    sample_combined_position_feature_noise(), so seeded runs give the same samples.
+    NOTE: the returned zs is overwritten two steps later, copy it if it must outlive that.
+    """
+    def __init__(self, z, node_mask, n_dims, fix_noise=False):
+        self.n_dims = n_dims
+        self.node_mask = node_mask
+        self.N = node_mask.sum(1, keepdims=True)
+
+        bs, n_nodes, nf = z.size()
+        noise_bs = 1 if fix_noise else bs
+        self.z = [z.clone(), torch.empty_like(z)]
+        self.current = 0
+        self.noise_x = torch.empty((noise_bs, n_nodes, n_dims), dtype=z.dtype, device=z.device)
+        self.noise_h = torch.empty((noise_bs, n_nodes, nf - n_dims), dtype=z.dtype, device=z.device)
+        if fix_noise:
+            # Noise is broadcasted over the batch axis, masked per sample.
+            self.eps_x = torch.empty((bs, n_nodes, n_dims), dtype=z.dtype, device=z.device)
+            self.eps_h = torch.empty((bs, n_nodes, nf - n_dims), dtype=z.dtype, device=z.device)
+        else:
+            self.eps_x, self.eps_h = self.noise_x, self.noise_h
+        self.mean = torch.empty((bs, 1, n_dims), dtype=z.dtype, device=z.device)
+
+    @property
+    def zt(self):
+        return self.z[self.current]
+
+    def remove_mean_(self, x):
+        """In place remove_mean_with_mask() of x [bs, n_nodes, n_dims]."""
+        torch.sum(x, dim=1, keepdim=True, out=self.mean)
+        self.mean.div_(self.N)
+        x.addcmul_(self.mean, self.node_mask, value=-1.)
+        return x
+
+    def compute_zs(self, zt, eps_t, coefficients):
+        zs = self.z[1 - self.current]
+        assert zs.data_ptr() != zt.data_ptr(), "zt must be the workspace's current buffer"
+
+        # mu for p(zs | zt).
+        torch.mul(zt, coefficients['mu_zt'], out=zs)
+        zs.addcmul_(eps_t, coefficients['mu_eps'], value=-1.)
+
+        # z_x = utils.sample_center_gravity_zero_gaussian_with_mask(..)
+        # z_h = utils.sample_gaussian_with_mask(..)
+        self.noise_x.normal_()
+        self.noise_h.normal_()
+        torch.mul(self.noise_x, self.node_mask, out=self.eps_x)
+        torch.mul(self.noise_h, self.node_mask, out=self.eps_h)
+        self.remove_mean_(self.eps_x)
+
+        # zs = mu + sigma * eps
+        zs[:, :, :self.n_dims].addcmul_(self.eps_x, coefficients['sigma'])
+        zs[:, :, self.n_dims:].addcmul_(self.eps_h, coefficients['sigma'])
+
+        # Project down to avoid numerical runaway of the center of gravity.
+        self.remove_mean_(zs[:, :, :self.n_dims])
+
+        self.current = 1 - self.current
+        return zs
+
+
 class EnVariationalDiffusion(torch.nn.Module):
     """
     The E(n) Diffusion Module.
@@ -810,37 +909,70 @@ class EnVariationalDiffusion(torch.nn.Module):
 
         return neg_log_pxh
 
-    def sample_p_zs_given_zt(self, s, t, zt, node_mask, edge_mask, context, fix_noise=False):
+    def get_step_coefficients(self, gamma_s, gamma_t, eta=None):
         """
-        Samples from zs ~ p(zs | zt). Only used during sampling. 
-        NOTE: One sampling step. (NOT final step z0)
+        Coefficients of one reverse step t -> s, zs = mu_zt * zt - mu_eps * eps_t + sigma * eps.
+        eta=None gives the ancestral p(zs | zt), otherwise the DDIM update with
+        stochasticity eta (eta=1. has the same variance as the ancestral step).
+        NOTE: returned with the shape of gamma, i.e. not inflated.
         """
-        gamma_s = self.gamma(s)
-        gamma_t = self.gamma(t)
-
         sigma2_t_given_s, sigma_t_given_s, alpha_t_given_s = \
-            self.sigma_and_alpha_t_given_s(gamma_t, gamma_s, zt)
+            self.sigma_and_alpha_t_given_s(gamma_t, gamma_s, gamma_t)
+
+        sigma_s = self.sigma(gamma_s, target_tensor=gamma_s)
+        sigma_t = self.sigma(gamma_t, target_tensor=gamma_t)
 
-        sigma_s = self.sigma(gamma_s, target_tensor=zt)
-        sigma_t = self.sigma(gamma_t, target_tensor=zt)
+        if eta is None:
+            # Compute mu and sigma for p(zs | zt).
+            mu_zt = 1. / alpha_t_given_s
+            mu_eps = sigma2_t_given_s / alpha_t_given_s / sigma_t
+            sigma = sigma_t_given_s * sigma_s / sigma_t
+        else:
+            # Predicted z0, re-noised to level s.
+            sigma = eta * sigma_t_given_s * sigma_s / sigma_t
+            mu_zt = 1. / alpha_t_given_s
+            mu_eps = sigma_t / alpha_t_given_s - torch.sqrt(torch.clamp(sigma_s ** 2 - sigma ** 2, min=0.))
+
+        return {'mu_zt': mu_zt, 'mu_eps': mu_eps, 'sigma': sigma}
+
+    def sample_p_zs_given_zt(self, s, t, zt, node_mask, edge_mask, context, fix_noise=False, eta=None, coefficients=None,
+                             workspace=None):
+        """
+        Samples from zs ~ p(zs | zt). Only used during sampling. 
+        NOTE: One sampling step. (NOT final step z0)
+              s may be any time before t when eta is given (strided DDIM-style step).
+              coefficients (from SamplingScheduleCache) skip recomputing the schedule.
+              workspace (SamplerWorkspace) computes zs in place in its preallocated buffers.
+        """
+        if coefficients is None:
+            coefficients = self.get_step_coefficients(self.gamma(s), self.gamma(t), eta)
+            coefficients = {key: self.inflate_batch_array(value, zt) for key, value in coefficients.items()}
+        diffusion_utils.checks_step('sampling')
 
         # Neural net prediction.
         eps_t = self.phi(zt, t, node_mask, edge_mask, context)
 
+        return self.compute_zs(zt, eps_t, node_mask, coefficients, fix_noise, workspace=workspace)
+
+    def compute_zs(self, zt, eps_t, node_mask, coefficients, fix_noise=False, workspace=None):
+        """
+        Samples zs given zt and the predicted noise eps_t, with the step coefficients
+        from get_step_coefficients().
+        """
         # Compute mu for p(zs | zt).
         diffusion_utils.assert_mean_zero_with_mask(zt[:, :, :self.n_dims], node_mask)
         diffusion_utils.assert_mean_zero_with_mask(eps_t[:, :, :self.n_dims], node_mask)
-        mu = zt / alpha_t_given_s - (sigma2_t_given_s / alpha_t_given_s / sigma_t) * eps_t
+        if workspace is not None:
+            return workspace.compute_zs(zt, eps_t, coefficients)
 
-        # Compute sigma for p(zs | zt).
-        sigma = sigma_t_given_s * sigma_s / sigma_t
+        mu = coefficients['mu_zt'] * zt - coefficients['mu_eps'] * eps_t
 
         # Sample zs given the paramters derived from zt.
         # z_x = utils.sample_center_gravity_zero_gaussian_with_mask(..)
         # z_h = utils.sample_gaussian_with_mask(..)
         # eps = torch.cat([z_x, z_h], dim=2)
         # zs = mu + sigma * eps
-        zs = self.sample_normal(mu, sigma, node_mask, fix_noise)
+        zs = self.sample_normal(mu, coefficients['sigma'], node_mask, fix_noise)
 
         # Project down to avoid numerical runaway of the center of gravity.
         zs = torch.cat(
@@ -849,6 +981,87 @@ class EnVariationalDiffusion(torch.nn.Module):
              zs[:, :, self.n_dims:]], dim=2
         )
         return zs
+
+    def sample_dpm_solver(self, z, eps_fn, n_samples, node_mask, num_sampling_steps=None, order=2):
+        """
+        Integrates the probability-flow ODE from t=1 down to t=0 with the multistep
+        DPM-Solver++ (2nd / 3rd order) on the model's gamma schedule, lambda = -gamma/2.
+        eps_fn(z, t) returns the network's noise prediction at z, t.
+        NOTE: returns z0, the final step p(x, h | z0) is left to the caller.
+        """
+        assert order in [1, 2, 3], f"DPM-Solver order must be 1, 2 or 3, got {order}"
+        schedule = SamplingScheduleCache(self, self.get_sampling_timesteps(num_sampling_steps), n_samples, z.device)
+        n_steps = len(schedule)
+
+        x0_preds = []
+        lambdas = []
+        for i in reversed(range(0, n_steps)):
+            alpha_s, alpha_t = schedule.alpha[i], schedule.alpha[i + 1]
+            sigma_s, sigma_t = schedule.sigma[i], schedule.sigma[i + 1]
+            lambda_s, lambda_t = schedule.lambda_[i], schedule.lambda_[i + 1]
+
+            # Neural net prediction, converted to a z0 (data) prediction.
+            diffusion_utils.checks_step('sampling')
+            eps_t = eps_fn(z, schedule.t[i + 1])
+            diffusion_utils.assert_mean_zero_with_mask(z[:, :, :self.n_dims], node_mask)
+            diffusion_utils.assert_mean_zero_with_mask(eps_t[:, :, :self.n_dims], node_mask)
+            x0_preds = (x0_preds + [(z - sigma_t * eps_t) / alpha_t])[-order:]
+            lambdas = (lambdas + [lambda_t])[-order:]
+
+            # Lower order while warming up, and on the last steps when few steps are used.
+            step_order = min(order, len(x0_preds))
+            if n_steps < 15:
+                step_order = min(step_order, i + 1)
+
+            h = lambda_s - lambdas[-1]
+            phi_1 = torch.expm1(-h)
+            z = (sigma_s / sigma_t) * z - alpha_s * phi_1 * x0_preds[-1]
+            if step_order == 2:
+                r0 = (lambdas[-1] - lambdas[-2]) / h
+                D1_0 = (x0_preds[-1] - x0_preds[-2]) / r0
+                z = z - 0.5 * alpha_s * phi_1 * D1_0
+            elif step_order == 3:
+                r0 = (lambdas[-1] - lambdas[-2]) / h
+                r1 = (lambdas[-2] - lambdas[-3]) / h
+                D1_0 = (x0_preds[-1] - x0_preds[-2]) / r0
+                D1_1 = (x0_preds[-2] - x0_preds[-3]) / r1
+                D1 = D1_0 + (r0 / (r0 + r1)) * (D1_0 - D1_1)
+                D2 = (D1_0 - D1_1) / (r0 + r1)
+                phi_2 = phi_1 / h + 1.
+                phi_3 = phi_2 / h - 0.5
+                z = z + alpha_s * phi_2 * D1 - alpha_s * phi_3 * D2
+
+            # Project down to avoid numerical runaway of the center of gravity.
+            z = torch.cat(
+                [diffusion_utils.remove_mean_with_mask(z[:, :, :self.n_dims],
+                                                       node_mask),
+                 z[:, :, self.n_dims:]], dim=2
+            )
+        return z
+
+    def get_sampling_timesteps(self, num_sampling_steps=None):
+        """
+        Integer timesteps [0, ..., T] visited by the sampler, in ascending order.
+        None (or num_sampling_steps >= T) walks every step.
+        """
+        if num_sampling_steps is None or num_sampling_steps >= self.T:
+            return list(range(0, self.T + 1))
+        assert num_sampling_steps > 0, f"num_sampling_steps must be positive, got {num_sampling_steps}"
+        timesteps = np.linspace(0, self.T, num_sampling_steps + 1).round().astype(int)
+        return sorted(set(timesteps.tolist()))
+
+    def get_sampling_eta(self, num_sampling_steps=None, eta=None):
+        """
+        eta of the step coefficients for get_sampling_timesteps(num_sampling_steps): full-length
+        sampling (None or >= T steps) is the original ancestral p(zs | zt) (None, i.e. eta=1.),
+        strided sampling defaults to the deterministic DDIM (eta=0.).
+        """
+        if num_sampling_steps is None or num_sampling_steps >= self.T:
+            if eta is not None and eta != 1.:
+                raise ValueError(f"Full-length sampling ({self.T} steps) is ancestral, eta={eta} needs "
+                                 f"num_sampling_steps < {self.T}.")
+            return None
+        return 0. if eta is None else eta
     
     def sample_p_xh_given_z0(self, z0, node_mask, edge_mask, context, fix_noise=False):
         """
@@ -900,10 +1113,14 @@ class EnVariationalDiffusion(torch.nn.Module):
 
 
     @torch.no_grad()
-    def sample(self, n_samples, n_nodes, node_mask, edge_mask, context, fix_noise=False):
+    def sample(self, n_samples, n_nodes, node_mask, edge_mask, context, fix_noise=False,
+               num_sampling_steps=None, eta=None, solver='ddim', solver_order=2):
         """
         Draw samples from the generative model.
-        NOTE: full timesteps T.
+        NOTE: full timesteps T, unless num_sampling_steps is given, in which case a strided
+              DDIM-style sampler is used (eta=0. deterministic (default), eta=1. ancestral variance).
+              solver='dpm_solver' integrates the probability-flow ODE instead, with a
+              solver_order (2 | 3) multistep DPM-Solver++ over num_sampling_steps.
         """
         if fix_noise:
             # Noise is broadcasted over the batch axis, useful for visualizations.
@@ -913,15 +1130,26 @@ class EnVariationalDiffusion(torch.nn.Module):
 
         diffusion_utils.assert_mean_zero_with_mask(z[:, :, :self.n_dims], node_mask)
 
-        # Iteratively sample p(z_s | z_t) for t = 1, ..., T, with s = t - 1.
-        for s in reversed(range(0, self.T)):
-            s_array = torch.full((n_samples, 1), fill_value=s, device=z.device)
-            t_array = s_array + 1
-            s_array = s_array / self.T
-            t_array = t_array / self.T
-
-            # from T -> t=1
-            z = self.sample_p_zs_given_zt(s_array, t_array, z, node_mask, edge_mask, context, fix_noise=fix_noise)
+        if solver == 'dpm_solver':
+            # from T -> t=0, deterministic
+            z = self.sample_dpm_solver(
+                z, lambda zt, t: self.phi(zt, t, node_mask, edge_mask, context),
+                n_samples, node_mask, num_sampling_steps, order=solver_order)
+        elif solver == 'ddim':
+            # Iteratively sample p(z_s | z_t) for t = 1, ..., T, with s = t - 1.
+            # (or over the strided timesteps if num_sampling_steps is set)
+            schedule = SamplingScheduleCache(self, self.get_sampling_timesteps(num_sampling_steps), n_samples, z.device,
+                                             eta=self.get_sampling_eta(num_sampling_steps, eta))
+            workspace = SamplerWorkspace(z, node_mask, self.n_dims, fix_noise=fix_noise)
+            z = workspace.zt
+            for i in reversed(range(0, len(schedule))):
+                s_array, t_array, coefficients = schedule.step(i)
+
+                # from T -> t=1
+                z = self.sample_p_zs_given_zt(s_array, t_array, z, node_mask, edge_mask, context, fix_noise=fix_noise,
+                                              coefficients=coefficients, workspace=workspace)
+        else:
+            raise ValueError(f"Unknown sampling solver: {solver}")
 
         # Final sample z0, t=0
         # Finally sample p(x, h | z_0).
@@ -941,7 +1169,8 @@ class EnVariationalDiffusion(torch.nn.Module):
 
 
     @torch.no_grad()
-    def sample_chain(self, n_samples, n_nodes, node_mask, edge_mask, context, keep_frames=None):
+    def sample_chain(self, n_samples, n_nodes, node_mask, edge_mask, context, keep_frames=None,
+                     num_sampling_steps=None, eta=None):
         """
         Draw samples from the generative model, same as sample() above,
         but keeps the intermediate states for visualization purposes.
@@ -950,26 +1179,30 @@ class EnVariationalDiffusion(torch.nn.Module):
 
         diffusion_utils.assert_mean_zero_with_mask(z[:, :, :self.n_dims], node_mask)
 
+        schedule = SamplingScheduleCache(self, self.get_sampling_timesteps(num_sampling_steps), n_samples, z.device,
+                                         eta=self.get_sampling_eta(num_sampling_steps, eta))
+        n_steps = len(schedule)
+
         if keep_frames is None:
-            keep_frames = self.T
+            keep_frames = n_steps
         else:
-            assert keep_frames <= self.T
+            assert keep_frames <= n_steps
         chain = torch.zeros((keep_frames,) + z.size(), device=z.device)
+        workspace = SamplerWorkspace(z, node_mask, self.n_dims)
+        z = workspace.zt
 
         # Iteratively sample p(z_s | z_t) for t = 1, ..., T, with s = t - 1.
-        for s in reversed(range(0, self.T)):
-            s_array = torch.full((n_samples, 1), fill_value=s, device=z.device)
-            t_array = s_array + 1
-            s_array = s_array / self.T
-            t_array = t_array / self.T
+        # (or over the strided timesteps if num_sampling_steps is set)
+        for i in reversed(range(0, n_steps)):
+            s_array, t_array, coefficients = schedule.step(i)
 
             z = self.sample_p_zs_given_zt(
-                s_array, t_array, z, node_mask, edge_mask, context)
+                s_array, t_array, z, node_mask, edge_mask, context, coefficients=coefficients, workspace=workspace)
 
             diffusion_utils.assert_mean_zero_with_mask(z[:, :, :self.n_dims], node_mask)
 
             # Write to chain tensor.
-            write_index = (s * keep_frames) // self.T
+            write_index = (i * keep_frames) // n_steps
             chain[write_index] = self.unnormalize_z(z, node_mask)
 
         # Finally sample p(x, h | z_0).
@@ -1620,14 +1853,18 @@ class EnLatentDiffusion(EnVariationalDiffusion):
 
         return log_p_xh_given_z
     
-    def forward(self, x, h, node_mask=None, edge_mask=None, context=None, loss_analysis=False):
+    def forward(self, x, h, node_mask=None, edge_mask=None, context=None, loss_analysis=False, z_xh_mean=None):
         """
         Computes the loss (type l2 or NLL) if training. And if eval then always computes NLL.
+        z_xh_mean: precomputed encoder latent means (offline latent cache), skips the VAE encoder.
         """
 
         """ VAE Encoding """
         # Encode data to latent space.
-        z_x_mu, z_x_sigma, z_h_mu, z_h_sigma = self.vae.encode(x, h, node_mask, edge_mask, context)
+        if z_xh_mean is None:
+            z_x_mu, z_x_sigma, z_h_mu, z_h_sigma = self.vae.encode(x, h, node_mask, edge_mask, context)
+        else:
+            assert not self.trainable_ae_encoder, "Cached latents require a frozen VAE encoder"
 
         # ~!fp16
         # self.gamma = self.gamma.to(x.device)
@@ -1638,7 +1875,8 @@ class EnLatentDiffusion(EnVariationalDiffusion):
         sigma_0 = self.sigma(gamma_0, x)
 
         # Infer latent z.
-        z_xh_mean = torch.cat([z_x_mu, z_h_mu], dim=2)
+        if z_xh_mean is None:
+            z_xh_mean = torch.cat([z_x_mu, z_h_mu], dim=2)
         
         # tmp
         # z_xh_mean = z_xh_mean * node_mask
@@ -1721,13 +1959,16 @@ class EnLatentDiffusion(EnVariationalDiffusion):
     
     
     @torch.no_grad()
-    def sample(self, n_samples, n_nodes, node_mask, edge_mask, context, fix_noise=False):
+    def sample(self, n_samples, n_nodes, node_mask, edge_mask, context, fix_noise=False,
+               num_sampling_steps=None, eta=None, solver='ddim', solver_order=2):
         """
         Draw samples from the generative model.
-        NOTE: full timesteps T.
+        NOTE: full timesteps T, unless num_sampling_steps is given (strided / ODE solver).
         """
         # parent, sample LDM model
-        z_x, z_h = super().sample(n_samples, n_nodes, node_mask, edge_mask, context, fix_noise)
+        z_x, z_h = super().sample(n_samples, n_nodes, node_mask, edge_mask, context, fix_noise,
+                                  num_sampling_steps=num_sampling_steps, eta=eta,
+                                  solver=solver, solver_order=solver_order)
 
         z_xh = torch.cat([z_x, z_h['categorical'], z_h['integer']], dim=2)
         diffusion_utils.assert_correctly_masked(z_xh, node_mask)
@@ -1736,11 +1977,15 @@ class EnLatentDiffusion(EnVariationalDiffusion):
         return x, h
     
     @torch.no_grad()
-    def sample_chain(self, n_samples, n_nodes, node_mask, edge_mask, context, keep_frames=None):
+    def sample_chain(self, n_samples, n_nodes, node_mask, edge_mask, context, keep_frames=None,
+                     num_sampling_steps=None, eta=None):
         """
         Draw samples from the generative model, keep the intermediate states for visualization purposes.
         """
-        chain_flat = super().sample_chain(n_samples, n_nodes, node_mask, edge_mask, context, keep_frames)
+        if keep_frames is None:
+            keep_frames = len(self.get_sampling_timesteps(num_sampling_steps)) - 1
+        chain_flat = super().sample_chain(n_samples, n_nodes, node_mask, edge_mask, context, keep_frames,
+                                          num_sampling_steps=num_sampling_steps, eta=eta)
 
         # xh = torch.cat([x, h['categorical'], h['integer']], dim=2)
         # chain[0] = xh  # Overwrite last frame with the resulting x and h.
@@ -19,6 +19,36 @@ class EMA():
         return old * self.beta + (1 - self.beta) * new
 
 
+# Invariant checks policy for the diffusion / EGNN hot paths, resolved once at model build
+# (see set_checks_policy). Each check forces a device sync and a full reduction.
+#  - always  : run every check (training / debugging)
+#  - sampled : run the checks on every `every`-th step only, counted per phase ('training',
+#              'sampling', 'eval') so that one phase never shifts the checks of another
+#  - off     : skip them (production sampling)
+CHECKS_POLICIES = ('off', 'sampled', 'always')
+_checks = {'policy': 'always', 'every': 1, 'phase': None, 'steps': {}}
+
+
+def set_checks_policy(policy='always', every=1):
+    assert policy in CHECKS_POLICIES, f"Unknown checks policy {policy}, expected one of {CHECKS_POLICIES}"
+    assert int(every) > 0, f"checks_every must be positive, got {every}"
+    _checks.update(policy=policy, every=int(every), phase=None, steps={})
+
+
+def checks_step(phase):
+    """Switches to `phase` and advances its step counter, once at the start of each step of that phase."""
+    _checks['phase'] = phase
+    _checks['steps'][phase] = _checks['steps'].get(phase, -1) + 1
+
+
+def checks_enabled():
+    if _checks['policy'] == 'always':
+        return True
+    if _checks['policy'] == 'sampled':
+        return _checks['steps'].get(_checks['phase'], 0) % _checks['every'] == 0
+    return False
+
+
 def sum_except_batch(x):
     return x.reshape(x.size(0), -1).sum(dim=-1)
 
@@ -30,8 +60,9 @@ def remove_mean(x):
 
 # ~!fp16
 def remove_mean_with_mask(x, node_mask):
-    masked_max_abs_value = (x * (1 - node_mask)).abs().sum().item()
-    assert masked_max_abs_value < 1e-5, f'Error {masked_max_abs_value} too high'
+    if checks_enabled():
+        masked_max_abs_value = (x * (1 - node_mask)).abs().sum().item()
+        assert masked_max_abs_value < 1e-5, f'Error {masked_max_abs_value} too high'
     N = node_mask.sum(1, keepdims=True)
 
     mean = torch.sum(x, dim=1, keepdim=True) / N
@@ -45,6 +76,8 @@ def assert_mean_zero(x):
 
 # ~!fp16
 def assert_mean_zero_with_mask(x, node_mask, eps=1e-10):
+    if not checks_enabled():
+        return
     assert_correctly_masked(x, node_mask)
     largest_value = x.abs().max().item()
     error = torch.sum(x, dim=1, keepdim=True).abs().max().item()
@@ -53,6 +86,8 @@ def assert_mean_zero_with_mask(x, node_mask, eps=1e-10):
 
 # ~!fp16
 def assert_correctly_masked(variable, node_mask):
+    if not checks_enabled():
+        return
     assert (variable * (1 - node_mask)).abs().max().item() < 1e-4, \
         'Variables not masked properly.'
 
@@ -293,7 +293,13 @@ def analyze_and_save_controlnet(
                     nodesxsample=nodesxsample, 
                     context=None, 
                     fix_noise=False, 
-                    pocket_dict_list=pocket_dict_list
+                    pocket_dict_list=pocket_dict_list,
+                    pocket_ids=pocket_id_lists[batch_id:batch_id + current_batch_size],
+                    num_sampling_steps=args.num_sampling_steps,
+                    eta=args.sampling_eta,
+                    solver=args.sampling_solver,
+                    solver_order=args.sampling_solver_order,
+                    n_buckets=args.sampling_n_buckets
                 )
 
             molecules['one_hot'].append(one_hot.detach().cpu())
@@ -375,6 +381,21 @@ def main():
                         help='Random seed for PyTorch, Numpy, Random & Qvina2.1')
     parser.add_argument('--cleanup_files', action='store_true',
                         help='Cleanup Qvina2.1 temporary docking files')
+    parser.add_argument('--num_sampling_steps', type=int, default=None,
+                        help='Number of strided sampling steps (default: all T steps)')
+    parser.add_argument('--sampling_eta', type=float, default=None,
+                        help='Strided sampler stochasticity, 0.: deterministic DDIM (default), 1.: ancestral. '
+                             'Full-length sampling is always ancestral')
+    parser.add_argument('--sampling_solver', type=str, default='ddim',
+                        help='Sampling solver, "ddim" (ancestral / strided) or "dpm_solver" (probability-flow ODE)')
+    parser.add_argument('--sampling_solver_order', type=int, default=2,
+                        help='DPM-Solver order, 2 or 3')
+    parser.add_argument('--sampling_n_buckets', type=int, default=1,
+                        help='Number of atom-count buckets each sampling batch is split into (1: no bucketing)')
+    parser.add_argument('--checks', type=str, default='always',
+                        help='Invariant checks during sampling: "always" | "sampled" (every --checks_every steps) | "off"')
+    parser.add_argument('--checks_every', type=int, default=1,
+                        help='Steps between invariant checks with --checks sampled')
     eval_args = parser.parse_args()
 
 
@@ -387,6 +408,9 @@ def main():
     # Load pickled Config object
     with open(os.path.join(eval_args.model_path, 'args.pickle'), 'rb') as f:
         args = pickle.load(f)
+    # configs saved before the factorized edge MLP keep the concatenated first layer they were trained with
+    if not hasattr(args, 'factorized_edge_mlp'):
+        args.factorized_edge_mlp = False
 
     # Create output dir
     output_dir = Path(eval_args.save_path, args.exp_name)
@@ -414,6 +438,14 @@ def main():
 
     # Add missing configs with default values
     args = utils.add_missing_configs_controlnet(args, args.dtype, ligand_dataset_info, pocket_dataset_info, ignore_mixed_precision=True)
+    if eval_args.num_sampling_steps is not None:
+        args.num_sampling_steps = eval_args.num_sampling_steps
+    args.sampling_eta = eval_args.sampling_eta
+    args.sampling_solver = eval_args.sampling_solver
+    args.sampling_solver_order = eval_args.sampling_solver_order
+    args.sampling_n_buckets = eval_args.sampling_n_buckets
+    args.checks = eval_args.checks
+    args.checks_every = eval_args.checks_every
 
     # Create params global registry for easy access
     PARAM_REGISTRY.update_from_config(args)
@@ -527,9 +559,10 @@ def main():
         pocket_data = pocket_data_list[i]
         pocket_filename = pocket_filename_list[i]
 
+        # apply pocket transform once, the same pocket is shared by all its samples,
+        # sample_controlnet() encodes it once per batch through its pocket id (file name)
+        transformed_pocket_data = pocket_transform(pocket_data)
         for _ in range(eval_args.num_samples_per_pocket):
-            # apply pocket transform
-            transformed_pocket_data = pocket_transform(pocket_data)
             processed_pocket_id.append(pocket_filename)
             processed_pocket_data_list.append(transformed_pocket_data)
     
@@ -47,7 +47,10 @@ def analyze_and_save(args, eval_args, device, generative_model,
         for i in range(int(n_samples/batch_size)):
             nodesxsample = nodes_dist.sample(batch_size)
             one_hot, charges, x, node_mask = sample(
-                args, device, generative_model, dataset_info, prop_dist=prop_dist, nodesxsample=nodesxsample)
+                args, device, generative_model, dataset_info, prop_dist=prop_dist, nodesxsample=nodesxsample,
+                num_sampling_steps=eval_args.num_sampling_steps, eta=eval_args.sampling_eta,
+                solver=eval_args.sampling_solver, solver_order=eval_args.sampling_solver_order,
+                n_buckets=eval_args.sampling_n_buckets)
 
             molecules['one_hot'].append(one_hot.detach().cpu())
             molecules['x'].append(x.detach().cpu())
@@ -113,6 +116,21 @@ def main():
                         help='Sampling batch size')
     parser.add_argument('--save_path', type=str, default='eval_ldm',
                         help='Path to save xyz files.')
+    parser.add_argument('--num_sampling_steps', type=int, default=None,
+                        help='Number of strided sampling steps (default: all T steps)')
+    parser.add_argument('--sampling_eta', type=float, default=None,
+                        help='Strided sampler stochasticity, 0.: deterministic DDIM (default), 1.: ancestral. '
+                             'Full-length sampling is always ancestral')
+    parser.add_argument('--sampling_solver', type=str, default='ddim',
+                        help='Sampling solver, "ddim" (ancestral / strided) or "dpm_solver" (probability-flow ODE)')
+    parser.add_argument('--sampling_solver_order', type=int, default=2,
+                        help='DPM-Solver order, 2 or 3')
+    parser.add_argument('--sampling_n_buckets', type=int, default=1,
+                        help='Number of atom-count buckets each sampling batch is split into (1: no bucketing)')
+    parser.add_argument('--checks', type=str, default='always',
+                        help='Invariant checks during sampling: "always" | "sampled" (every --checks_every steps) | "off"')
+    parser.add_argument('--checks_every', type=int, default=1,
+                        help='Steps between invariant checks with --checks sampled')
     eval_args, unparsed_args = parser.parse_known_args()
     eval_args.save_to_xyz = True
     
@@ -126,6 +144,9 @@ def main():
 
     with open(join(eval_args.model_path, 'args.pickle'), 'rb') as f:
         args = pickle.load(f)
+    # configs saved before the factorized edge MLP keep the concatenated first layer they were trained with
+    if not hasattr(args, 'factorized_edge_mlp'):
+        args.factorized_edge_mlp = False
     
     dataset_info = get_dataset_info(dataset_name=args.dataset, remove_h=args.remove_h)
 
@@ -162,19 +183,11 @@ def main():
         args.mixed_precision_autocast_dtype = dtype
 
 
-    # gradient accumulation
-    if not hasattr(args, 'grad_accumulation_steps'):
-        args.grad_accumulation_steps = 1  # call optim every step
-
-
-    # vae data mode
-    if not hasattr(args, 'vae_data_mode'):
-        args.vae_data_mode = 'all'
+    # add missing configs with default values
+    args = utils.add_missing_configs(args)
 
 
     # loss analysis
-    if not hasattr(args, 'loss_analysis'):
-        args.loss_analysis = False
     args.loss_analysis_modes = ['VAE', 'LDM']
 
 
@@ -185,27 +198,7 @@ def main():
     args.atom_decoder = atom_decoder
 
 
-    # intermediate activations analysis usage
-    args.vis_activations_instances = (torch.nn.Linear)
-    args.save_activations_path = 'vis_activations'
-    args.vis_activations_bins = 200
-    if not hasattr(args, 'vis_activations_specific_ylim'):
-        args.vis_activations_specific_ylim = [0, 40]
-    if not hasattr(args, 'vis_activations'):
-        args.vis_activations = False
-    if not hasattr(args, 'vis_activations_batch_samples'):
-        args.vis_activations_batch_samples = 0
-    if not hasattr(args, 'vis_activations_batch_size'):
-        args.vis_activations_batch_size = 1
-
-
     # class-imbalance loss reweighting
-    if not hasattr(args, 'reweight_class_loss'):  # supported: "inv_class_freq"
-        args.reweight_class_loss = None
-    if not hasattr(args, 'reweight_coords_loss'):  # supported: "inv_class_freq"
-        args.reweight_coords_loss = None
-    if not hasattr(args, 'smoothing_factor'):  # smoothing: (0. - 1.]
-        args.smoothing_factor = None
     if args.reweight_class_loss == "inv_class_freq":
         class_freq_dict = dataset_info['atom_types']
         sorted_keys = sorted(class_freq_dict.keys())
@@ -223,24 +216,9 @@ def main():
     else:
         args.class_weights = None
 
-    # coordinates loss weighting
-    if not hasattr(args, 'error_x_weight'):
-        args.error_x_weight = None
-    # atom types loss weighting
-    if not hasattr(args, 'error_h_weight'):
-        args.error_h_weight = None
-
-    # scaling of coordinates/x
-    if not hasattr(args, 'vae_normalize_x'):
-        args.vae_normalize_x = False
-    if not hasattr(args, 'vae_normalize_method'):  # supported: "scale" | "linear"
-        args.vae_normalize_method = None
-    if not hasattr(args, 'vae_normalize_fn_points'):  # [x_min, y_min, x_max, y_max]
-        args.vae_normalize_fn_points = None
-
-    # data splits
-    if not hasattr(args, 'data_splitted'):
-        args.data_splitted = False
+    # invariant checks in the sampling hot path
+    args.checks = eval_args.checks
+    args.checks_every = eval_args.checks_every
 
     # params global registry for easy access
     PARAM_REGISTRY.update_from_config(args)
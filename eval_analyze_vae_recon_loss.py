@@ -75,14 +75,12 @@ def main():
 
     with open(join(opt.model_path, 'args.pickle'), 'rb') as f:
         args = pickle.load(f)
+    # configs saved before the factorized edge MLP keep the concatenated first layer they were trained with
+    if not hasattr(args, 'factorized_edge_mlp'):
+        args.factorized_edge_mlp = False
 
     dataset_info = get_dataset_info(dataset_name=args.dataset, remove_h=args.remove_h)
 
-    # vae encoder n layers
-    if not hasattr(args, 'encoder_n_layers'):
-        args.encoder_n_layers = 1
-
-
     # additional & override settings for sparsity plots
     args.batch_size = 1 # must be 1 for this script
     args.save_samples_dir = f'recon_loss_analysis/{args.exp_name}/{args.training_mode}/'
@@ -115,19 +113,11 @@ def main():
     #     args.mixed_precision_autocast_dtype = dtype
 
 
-    # gradient accumulation
-    if not hasattr(args, 'grad_accumulation_steps'):
-        args.grad_accumulation_steps = 1  # call optim every step
-
-
-    # vae data mode
-    if not hasattr(args, 'vae_data_mode'):
-        args.vae_data_mode = 'all'
+    # add missing configs with default values
+    args = utils.add_missing_configs(args)
 
 
     # loss analysis
-    if not hasattr(args, 'loss_analysis'):
-        args.loss_analysis = False
     args.loss_analysis_modes = ['VAE']
 
 
@@ -138,23 +128,7 @@ def main():
     args.atom_decoder = atom_decoder
 
 
-    # intermediate activations analysis usage
-    args.vis_activations_instances = (nn.Linear)
-    args.save_activations_path = 'vis_activations'
-    args.vis_activations_bins = 200
-    if not hasattr(args, 'vis_activations_specific_ylim'):
-        args.vis_activations_specific_ylim = [0, 40]
-    if not hasattr(args, 'vis_activations'):
-        args.vis_activations = False
-    if not hasattr(args, 'vis_activations_batch_samples'):
-        args.vis_activations_batch_samples = 0
-    if not hasattr(args, 'vis_activations_batch_size'):
-        args.vis_activations_batch_size = 1
-
-
     # class-imbalance loss reweighting
-    if not hasattr(args, 'reweight_class_loss'):  # supported: "inv_class_freq"
-        args.reweight_class_loss = None
     if args.reweight_class_loss == "inv_class_freq":
         class_freq_dict = dataset_info['atom_types']
         sorted_keys = sorted(class_freq_dict.keys())
@@ -165,19 +139,6 @@ def main():
         [print(f"{atom_decoder[sorted_keys[i]]} freq={class_freq_dict[sorted_keys[i]]} \
             inv_freq={inverse_frequencies[i]} \weight={class_weights[i]}") for i in sorted_keys]
 
-    # scaling of coordinates/x
-    if not hasattr(args, 'vae_normalize_x'):
-        args.vae_normalize_x = False
-    if not hasattr(args, 'vae_normalize_method'):  # supported: "scale" | "linear"
-        args.vae_normalize_method = None
-    if not hasattr(args, 'vae_normalize_fn_points'):  # [x_min, y_min, x_max, y_max]
-        args.vae_normalize_fn_points = None
-
-    # data splits
-    if not hasattr(args, 'data_splitted'):
-        args.data_splitted = False
-
-
     # params global registry for easy access
     PARAM_REGISTRY.update_from_config(args)
 
@@ -193,7 +154,8 @@ def main():
                                                     dataset_name=args.dataset,
                                                     training_mode=args.training_mode,
                                                     filter_pocket_size=args.filter_pocket_size,
-                                                    data_splitted=args.data_splitted)
+                                                    data_splitted=args.data_splitted,
+                                                    split_cache_dir=args.split_cache_dir)
     # ~!to ~!mp
     # ['positions'], ['one_hot'], ['charges'], ['atonm_mask'], ['edge_mask'] are added here
     transform = build_geom_dataset.GeomDrugsTransform(dataset_info, args.include_charges, args.device, args.sequential)
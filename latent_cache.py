@@ -0,0 +1,197 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+
+import build_geom_dataset
+from equivariant_diffusion.utils import remove_mean_with_mask
+
+
+def state_dict_hash(module):
+    """sha256 over the state_dict tensors of module, identifies the checkpoint a cache was built with."""
+    sha = hashlib.sha256()
+    for key, value in sorted(module.state_dict().items()):
+        sha.update(key.encode())
+        sha.update(value.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+
+class LatentCache(object):
+    """
+    Read-only, memory-mapped per-atom latent means of one data split:
+    {path}_latents.npy [n_atoms, n_dims + latent_nf] and {path}_offsets.npy [n_molecules + 1],
+    molecule i being latents[offsets[i]:offsets[i+1]] (load_split_data order).
+    Caches built with ids ({path}_ids.npy, pair / mol ids) can also be read by id, see by_id().
+    meta: {path}_meta.json (checkpoint_hash, data_fingerprint), see check_checkpoint().
+    """
+    def __init__(self, path):
+        self.path = path
+        self.meta = read_cache_meta(path)
+        self.latents = np.load(f"{path}_latents.npy", mmap_mode='r')
+        self.offsets = np.load(f"{path}_offsets.npy")
+        if os.path.exists(f"{path}_ids.npy"):
+            self.row_of = {int(mol_id): i for i, mol_id in enumerate(np.load(f"{path}_ids.npy"))}
+        else:
+            self.row_of = None
+
+    # the memmap is reopened instead of pickled (spawned DataLoader workers)
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(np.array(self.latents[self.offsets[idx]:self.offsets[idx + 1]]))
+
+    def by_id(self, mol_id):
+        return self[self.row_of[int(mol_id)]]
+
+    def check_checkpoint(self, vae):
+        """Asserts that the cache was built with the current weights of vae (the frozen encoder)."""
+        checkpoint_hash = state_dict_hash(vae)
+        assert self.meta is not None and self.meta['checkpoint_hash'] == checkpoint_hash, \
+            f"Latent cache {self.path} was built with a different VAE checkpoint " \
+            f"({None if self.meta is None else self.meta['checkpoint_hash'][:12]} != {checkpoint_hash[:12]}), rebuild it"
+
+
+def encoding_settings(vae, dtype, include_charges, **settings):
+    """Encoder inputs besides the weights: dtype, charges, coordinate normalisation, plus caller settings (e.g. augment_noise)."""
+    norm_values = getattr(vae, 'norm_values', None)
+    return dict(settings, dtype=str(dtype), include_charges=bool(include_charges),
+                vae_normalize_x=bool(getattr(vae, 'vae_normalize_x', False)),
+                vae_normalize_method=getattr(vae, 'vae_normalize_method', None),
+                norm_values=None if norm_values is None else [float(v) for v in norm_values])
+
+
+def data_fingerprint(data_list, ids=None, data_key=None, settings=None):
+    """
+    sha256 identifying what a cache row holds: the ordered molecule lengths and mol / pair ids, the data
+    file and split (data_key, see build_geom_dataset.split_data_key) and the encoding settings.
+    """
+    sha = hashlib.sha256()
+    sha.update(np.asarray(build_geom_dataset.molecule_lengths(data_list), dtype=np.int64).tobytes())
+    if ids is None and hasattr(data_list, 'mol_ids'):
+        ids = data_list.mol_ids
+    if ids is not None:
+        sha.update(np.asarray(ids, dtype=np.int64).tobytes())
+    sha.update(json.dumps({'data_key': data_key, 'settings': settings}, sort_keys=True).encode())
+    return sha.hexdigest()
+
+
+def read_cache_meta(path):
+    if not os.path.exists(f"{path}_meta.json"):
+        return None
+    with open(f"{path}_meta.json", 'r') as f:
+        return json.load(f)
+
+
+def write_cache_meta(path, meta):
+    with open(f"{path}_meta.json.tmp", 'w') as f:
+        json.dump(meta, f)
+    os.replace(f"{path}_meta.json.tmp", f"{path}_meta.json")
+
+
+@torch.no_grad()
+def build_latent_cache(vae, data_list, transform, path, checkpoint_hash, batch_size, device, dtype,
+                       include_charges, ids=None, fingerprint=None):
+    """
+    Runs the (frozen) VAE encoder once over data_list, in order, and writes the per-atom
+    latent means [z_x_mu, z_h_mu] to the memory-mapped LatentCache files at path.
+    include_charges: whether h['integer'] carries the charges, as in the training loop.
+    """
+    lengths = np.array([molecule.shape[0] for molecule in data_list], dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    dim = vae.n_dims + vae.latent_node_nf
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    latents = np.lib.format.open_memmap(f"{path}_latents.tmp.npy", mode='w+', dtype=np.float32, shape=(int(offsets[-1]), dim))
+
+    was_training = vae.training
+    vae.eval()
+    print(f">> Building latent cache {path}: {len(data_list)} molecules, {int(offsets[-1])} atoms")
+    for start in range(0, len(data_list), batch_size):
+        batch = build_geom_dataset.collate_fn([transform(molecule) for molecule in data_list[start:start + batch_size]])
+        x = batch['positions'].to(device, dtype)
+        node_mask = batch['atom_mask'].to(device, dtype).unsqueeze(2)
+        edge_mask = batch['edge_mask'].to(device, dtype)
+        one_hot = batch['one_hot'].to(device, dtype)
+        charges = (batch['charges'] if include_charges else torch.zeros(0)).to(device, dtype)
+
+        x = remove_mean_with_mask(x, node_mask)
+        h = {'categorical': one_hot, 'integer': charges}
+        z_x_mu, _, z_h_mu, _ = vae.encode(x, h, node_mask, edge_mask.view(x.size(0), -1), None)
+        z_xh_mean = torch.cat([z_x_mu, z_h_mu], dim=2).float().cpu().numpy()
+
+        for i in range(z_xh_mean.shape[0]):
+            n = start + i
+            latents[offsets[n]:offsets[n + 1]] = z_xh_mean[i, :lengths[n]]
+    latents.flush()
+    del latents
+    vae.train(was_training)
+
+    np.save(f"{path}_offsets.npy", offsets)
+    if ids is not None:
+        np.save(f"{path}_ids.npy", np.asarray(ids, dtype=np.int64))
+    elif os.path.exists(f"{path}_ids.npy"):
+        os.remove(f"{path}_ids.npy")
+    os.replace(f"{path}_latents.tmp.npy", f"{path}_latents.npy")
+    write_cache_meta(path, {'checkpoint_hash': checkpoint_hash, 'data_fingerprint': fingerprint,
+                            'n_molecules': len(data_list), 'n_atoms': int(offsets[-1]), 'dim': dim})
+
+
+def load_or_build_latent_cache(vae, dataset, path, batch_size, device, dtype, include_charges,
+                               data_key=None, settings=None):
+    """
+    LatentCache for a GeomDrugsDataset (indexed in load_split_data order, see dataset.data_order).
+    (Re)built when missing, or when it was built with a different VAE checkpoint, data file, split
+    (data_key, molecule lengths and ids) or encoding settings.
+    """
+    checkpoint_hash = state_dict_hash(vae)
+    # undo the dataset's sort by size
+    data_list = build_geom_dataset.take_molecules(dataset.data_list, np.argsort(dataset.data_order))
+    fingerprint = data_fingerprint(data_list, data_key=data_key,
+                                   settings=encoding_settings(vae, dtype, include_charges, **(settings or {})))
+    meta = read_cache_meta(path)
+    if meta is None or meta['checkpoint_hash'] != checkpoint_hash or meta.get('data_fingerprint') != fingerprint:
+        build_latent_cache(vae, data_list, dataset.transform, path, checkpoint_hash, batch_size, device, dtype,
+                           include_charges, fingerprint=fingerprint)
+    else:
+        print(f">> Using latent cache {path} (checkpoint {checkpoint_hash[:12]})")
+    return LatentCache(path)
+
+
+def load_or_build_pocket_latent_cache(pocket_vae, datasets, path, batch_size, device, dtype, include_charges,
+                                      data_key=None, settings=None):
+    """
+    LatentCache of the pockets of ControlNet GeomDrugsDatasets (all splits), keyed by the pair ids
+    of load_split_data(return_ids=True), see match_raw_file_by_id.
+    (Re)built when missing, or when it was built with a different pocket VAE checkpoint, pair dataset
+    (data_key, pocket lengths and pair ids) or encoding settings.
+    """
+    data_list, ids, seen = [], [], set()
+    for dataset in datasets:
+        assert dataset.ids is not None, "Pocket latent cache requires match_raw_file_by_id"
+        for mol_id, pocket in zip(dataset.ids, dataset.data_list_pocket):
+            if mol_id not in seen:
+                seen.add(mol_id)
+                data_list.append(pocket)
+                ids.append(mol_id)
+
+    checkpoint_hash = state_dict_hash(pocket_vae)
+    fingerprint = data_fingerprint(data_list, ids=ids, data_key=data_key,
+                                   settings=encoding_settings(pocket_vae, dtype, include_charges, **(settings or {})))
+    meta = read_cache_meta(path)
+    if meta is not None and meta['checkpoint_hash'] == checkpoint_hash and meta.get('data_fingerprint') == fingerprint:
+        print(f">> Using pocket latent cache {path} (checkpoint {checkpoint_hash[:12]})")
+        return LatentCache(path)
+
+    pocket_transform = datasets[0].pocket_transform or datasets[0].transform
+    build_latent_cache(pocket_vae, data_list, pocket_transform, path, checkpoint_hash, batch_size,
+                       device, dtype, include_charges, ids=ids, fingerprint=fingerprint)
+    return LatentCache(path)
@@ -10,6 +10,7 @@ import utils
 import yaml
 import argparse
 import wandb
+import os
 from os.path import join
 from qm9.models import get_optim, get_model, get_autoencoder, get_latent_diffusion
 from equivariant_diffusion import en_diffusion
@@ -25,6 +26,7 @@ import math
 
 from qm9.utils import prepare_context, compute_mean_mad
 import train_test
+import latent_cache
 
 from global_registry import PARAM_REGISTRY, Config
 
@@ -76,29 +78,11 @@ def main():
         args.mixed_precision_autocast_dtype = dtype
 
 
-    # gradient accumulation
-    if not hasattr(args, 'grad_accumulation_steps'):
-        args.grad_accumulation_steps = 1  # call optim every step
-
-
-    # vae data mode
-    if not hasattr(args, 'vae_data_mode'):
-        args.vae_data_mode = 'all'
-
-
-    # vae encoder n layers
-    if not hasattr(args, 'encoder_n_layers'):
-        args.encoder_n_layers = 1
-
-
-    # grad prenalty
-    if not hasattr(args, 'grad_penalty'):
-        args.grad_penalty = False
+    # add missing configs with default values
+    args = utils.add_missing_configs(args)
 
 
     # loss analysis
-    if not hasattr(args, 'loss_analysis'):
-        args.loss_analysis = False
     # args.loss_analysis_modes = ['VAE']
     args.loss_analysis_modes = ['VAE', 'LDM']
 
@@ -110,27 +94,7 @@ def main():
     args.atom_decoder = atom_decoder
 
 
-    # intermediate activations analysis usage
-    args.vis_activations_instances = (nn.Linear)
-    args.save_activations_path = 'vis_activations'
-    args.vis_activations_bins = 200
-    if not hasattr(args, 'vis_activations_specific_ylim'):
-        args.vis_activations_specific_ylim = [0, 40]
-    if not hasattr(args, 'vis_activations'):
-        args.vis_activations = False
-    if not hasattr(args, 'vis_activations_batch_samples'):
-        args.vis_activations_batch_samples = 0
-    if not hasattr(args, 'vis_activations_batch_size'):
-        args.vis_activations_batch_size = 1
-
-
     # class-imbalance loss reweighting
-    if not hasattr(args, 'reweight_class_loss'):  # supported: "inv_class_freq"
-        args.reweight_class_loss = None
-    if not hasattr(args, 'reweight_coords_loss'):  # supported: "inv_class_freq"
-        args.reweight_coords_loss = None
-    if not hasattr(args, 'smoothing_factor'):  # smoothing: (0. - 1.]
-        args.smoothing_factor = None
     if args.reweight_class_loss == "inv_class_freq":
         class_freq_dict = dataset_info['atom_types']
         sorted_keys = sorted(class_freq_dict.keys())
@@ -148,33 +112,6 @@ def main():
     else:
         args.class_weights = None
 
-    # coordinates loss weighting
-    if not hasattr(args, 'error_x_weight'):
-        args.error_x_weight = None
-    # atom types loss weighting
-    if not hasattr(args, 'error_h_weight'):
-        args.error_h_weight = None
-
-    # scaling of coordinates/x
-    if not hasattr(args, 'vae_normalize_x'):
-        args.vae_normalize_x = False
-    if not hasattr(args, 'vae_normalize_method'):  # supported: "scale" | "linear"
-        args.vae_normalize_method = None
-    if not hasattr(args, 'vae_normalize_fn_points'):  # [x_min, y_min, x_max, y_max]
-        args.vae_normalize_fn_points = None
-
-
-    # data splits
-    if not hasattr(args, 'data_splitted'):
-        args.data_splitted = False
-
-
-    # visualise sample chain
-    if not hasattr(args, 'visualize_sample_chain'):
-        args.visualize_sample_chain = False
-    if not hasattr(args, 'visualize_sample_chain_epochs'):
-        args.visualize_sample_chain_epochs = 1
-
 
     # params global registry for easy access
     PARAM_REGISTRY.update_from_config(args)
@@ -191,7 +128,8 @@ def main():
                                                     dataset_name=args.dataset,
                                                     training_mode=args.training_mode,
                                                     filter_pocket_size=args.filter_pocket_size,
-                                                    data_splitted=args.data_splitted)
+                                                    data_splitted=args.data_splitted,
+                                                    split_cache_dir=args.split_cache_dir)
     # ~!to ~!mp
     # ['positions'], ['one_hot'], ['charges'], ['atonm_mask'], ['edge_mask'] are added here
     transform = build_geom_dataset.GeomDrugsTransform(dataset_info, args.include_charges, args.device, args.sequential)
@@ -203,10 +141,22 @@ def main():
         # shuffle = (key == 'train') and not args.sequential
         shuffle = (key == 'train')
 
+        conformer_groups, conformer_weights = None, None
+        if args.conformers_per_molecule is not None and key == 'train':
+            conformer_groups_file = args.conformer_groups_file or build_geom_dataset.default_conformer_groups_file(data_file)
+            conformer_groups, conformer_weights = build_geom_dataset.load_conformer_groups(
+                conformer_groups_file, dataset.molecule_ids(), args.conformer_weighting)
+
         # Sequential dataloading disabled for now.
         dataloaders[key] = build_geom_dataset.GeomDrugsDataLoader(
             sequential=args.sequential, dataset=dataset, batch_size=args.batch_size,
-            shuffle=shuffle, training_mode=args.training_mode, drop_last=True)
+            shuffle=shuffle, training_mode=args.training_mode, drop_last=True,
+            bucket_batches=args.bucket_batches, bucket_size_multiplier=args.bucket_size_multiplier,
+            bucket_jitter=args.bucket_jitter, edge_budget=args.edge_budget,
+            num_workers=args.num_workers, pin_memory=args.pin_memory, prefetch_factor=args.prefetch_factor,
+            fused_augmentation=args.fused_augmentation, data_augmentation=(args.data_augmentation and key == 'train'),
+            conformers_per_molecule=args.conformers_per_molecule, conformer_groups=conformer_groups,
+            conformer_weights=conformer_weights)
 
         if args.vis_activations and key == 'val':
             dataloaders['vis_activations'] = build_geom_dataset.GeomDrugsDataLoader(
@@ -297,6 +247,21 @@ def main():
         # dequantizer_state_dict = torch.load(join(args.resume, 'dequantizer.npy'))
 
 
+    # encode every split once with the frozen VAE, the LDM then trains on the cached latent means
+    if args.latent_cache_dir is not None:
+        assert args.training_mode == 'LDM' and args.train_diffusion, "Latent cache is only used to train the LDM"
+        assert not args.trainable_ae_encoder, "Latent cache requires a frozen VAE encoder"
+        data_key, _ = build_geom_dataset.split_data_key(
+            data_file, val_proportion=0.1, test_proportion=0.1, filter_size=args.filter_molecule_size,
+            permutation_file_path=args.permutation_file_path, training_mode=args.training_mode,
+            filter_pocket_size=args.filter_pocket_size, data_splitted=args.data_splitted)
+        for key in ['train', 'val', 'test']:
+            dataloaders[key].dataset.latent_cache = latent_cache.load_or_build_latent_cache(
+                model.vae, dataloaders[key].dataset, join(args.latent_cache_dir, key),
+                args.latent_cache_batch_size, device, dtype, args.include_charges,
+                data_key=f"{data_key}:{key}", settings={'augment_noise': args.augment_noise})
+
+
     # Initialize dataparallel if enabled and possible.
     if args.dp and torch.cuda.device_count() > 1 and args.cuda:
         print(f'Training using {torch.cuda.device_count()} GPUs')
@@ -18,6 +18,7 @@ from os.path import join
 
 import utils
 import train_test
+import latent_cache
 import build_geom_dataset
 from configs.dataset_configs.datasets_config import get_dataset_info
 from equivariant_diffusion import utils as diffusion_utils
@@ -86,7 +87,8 @@ def main():
                                                     training_mode=args.training_mode,
                                                     filter_pocket_size=args.filter_pocket_size,
                                                     data_splitted=args.data_splitted,
-                                                    return_ids=args.match_raw_file_by_id)
+                                                    return_ids=args.match_raw_file_by_id,
+                                                    split_cache_dir=args.split_cache_dir)
     # ~!to ~!mp
     # ['positions'], ['one_hot'], ['charges'], ['atom_mask'] are added here
     ligand_transform = build_geom_dataset.GeomDrugsTransform(ligand_dataset_info, args.include_charges, args.device, args.sequential)
@@ -109,7 +111,11 @@ def main():
         # Sequential dataloading disabled for now.
         dataloaders[key] = build_geom_dataset.GeomDrugsDataLoader(
             sequential=args.sequential, dataset=dataset, batch_size=args.batch_size,
-            shuffle=shuffle, training_mode=args.training_mode, drop_last=True)
+            shuffle=shuffle, training_mode=args.training_mode, drop_last=True,
+            bucket_batches=args.bucket_batches, bucket_size_multiplier=args.bucket_size_multiplier,
+            bucket_jitter=args.bucket_jitter, edge_budget=args.edge_budget,
+            num_workers=args.num_workers, pin_memory=args.pin_memory, prefetch_factor=args.prefetch_factor,
+            fused_augmentation=args.fused_augmentation, data_augmentation=(args.data_augmentation and key == 'train'))
         
         if args.vis_activations and key == 'val':
             dataloaders['vis_activations'] = build_geom_dataset.GeomDrugsDataLoader(
@@ -178,6 +184,23 @@ def main():
         optim.load_state_dict(torch.load(optim_state_dict))
         # dequantizer_state_dict = torch.load(join(args.resume, 'dequantizer.npy'))
 
+    # encode every pocket once with the frozen pocket VAE, the ControlNet then trains on the cached latent means
+    if args.pocket_latent_cache_dir is not None:
+        assert args.match_raw_file_by_id, "Pocket latent cache is keyed by pair id, requires match_raw_file_by_id"
+        assert not args.trainable_pocket_ae_encoder, "Pocket latent cache requires a frozen pocket VAE encoder"
+        datasets = [dataloaders[key].dataset for key in ['train', 'val', 'test']]
+        data_key, _ = build_geom_dataset.split_data_key(
+            data_file, val_proportion=0.1, test_proportion=0.1, filter_size=args.filter_molecule_size,
+            permutation_file_path=args.permutation_file_path, training_mode=args.training_mode,
+            filter_pocket_size=args.filter_pocket_size, data_splitted=args.data_splitted,
+            return_ids=args.match_raw_file_by_id)
+        pocket_cache = latent_cache.load_or_build_pocket_latent_cache(
+            model.pocket_vae, datasets, join(args.pocket_latent_cache_dir, 'pocket'),
+            args.pocket_latent_cache_batch_size, device, dtype, args.include_charges,
+            data_key=data_key, settings={'augment_noise': args.augment_noise})
+        for dataset in datasets:
+            dataset.pocket_latent_cache = pocket_cache
+
     # Initialize dataparallel if enabled and possible.
     if args.dp and torch.cuda.device_count() > 1 and args.cuda:
         print(f'Training using {torch.cuda.device_count()} GPUs')
@@ -47,13 +47,15 @@ def retrieve_dataloaders(cfg):
 
         # Retrieve QM9 dataloaders
         permutation_file_path = cfg.permutation_file_path if hasattr(cfg, 'permutation_file_path') else None
+        split_cache_dir = cfg.split_cache_dir if hasattr(cfg, 'split_cache_dir') else None
         split_data = build_geom_dataset.load_split_data(data_file,
                                                         val_proportion=0.1,
                                                         test_proportion=0.1,
                                                         filter_size=cfg.filter_molecule_size,
                                                         permutation_file_path=permutation_file_path,
                                                         dataset_name=cfg.dataset,
-                                                        data_splitted=cfg.data_splitted)
+                                                        data_splitted=cfg.data_splitted,
+                                                        split_cache_dir=split_cache_dir)
         transform = build_geom_dataset.GeomDrugsTransform(dataset_info,
                                                           cfg.include_charges,
                                                           cfg.device,
@@ -12,8 +12,11 @@ def assert_correctly_masked(variable, node_mask):
     
 
 
-def compute_loss_and_nll(args, generative_model, nodes_dist, x, h, node_mask, edge_mask, context, loss_analysis=False):
+def compute_loss_and_nll(args, generative_model, nodes_dist, x, h, node_mask, edge_mask, context, loss_analysis=False,
+                         z_xh_mean=None):
     bs, n_nodes, n_dims = x.size()
+    # precomputed (cached) VAE latent means, LDM only
+    latent_kwargs = {} if z_xh_mean is None else {'z_xh_mean': z_xh_mean}
 
 
     if args.probabilistic_model == 'diffusion':
@@ -26,11 +29,11 @@ def compute_loss_and_nll(args, generative_model, nodes_dist, x, h, node_mask, ed
         # returns neg_log_pxh / negatve log likelihood
         if PARAM_REGISTRY.get('training_mode') in PARAM_REGISTRY.get('loss_analysis_modes'):
             if loss_analysis:
-                nll, loss_dict = generative_model(x, h, node_mask, edge_mask, context, loss_analysis=loss_analysis)
+                nll, loss_dict = generative_model(x, h, node_mask, edge_mask, context, loss_analysis=loss_analysis, **latent_kwargs)
             else:
-                nll = generative_model(x, h, node_mask, edge_mask, context)
+                nll = generative_model(x, h, node_mask, edge_mask, context, **latent_kwargs)
         else:
-            nll = generative_model(x, h, node_mask, edge_mask, context)
+            nll = generative_model(x, h, node_mask, edge_mask, context, **latent_kwargs)
 
         N = node_mask.squeeze(2).sum(1).long()
 
@@ -59,9 +62,12 @@ def compute_loss_and_nll(args, generative_model, nodes_dist, x, h, node_mask, ed
 
 
 
-def compute_loss_and_nll_controlnet(args, generative_model, nodes_dist, lg_x, lg_h, pkt_x, pkt_h, lg_node_mask, pkt_node_mask, lg_edge_mask, pkt_edge_mask, joint_edge_mask, context):
+def compute_loss_and_nll_controlnet(args, generative_model, nodes_dist, lg_x, lg_h, pkt_x, pkt_h, lg_node_mask, pkt_node_mask, lg_edge_mask, pkt_edge_mask, joint_edge_mask, context,
+                                    pkt_z_xh_mean=None):
     lg_bs, lg_n_nodes, lg_n_dims = lg_x.size()
     pkt_bs, pkt_n_nodes, pkt_n_dims = pkt_x.size()
+    # precomputed (cached) pocket VAE latent means
+    latent_kwargs = {} if pkt_z_xh_mean is None else {'z_xh_mean_2': pkt_z_xh_mean}
 
     assert lg_bs == pkt_bs, f"Different batch_size encountered! lg_bs={lg_bs} pkt_bs={pkt_bs}"
     assert lg_n_dims == pkt_n_dims, f"Different num embeddings encountered! lg_n_dims={lg_n_dims} pkt_n_dims={pkt_n_dims}"
@@ -85,7 +91,8 @@ def compute_loss_and_nll_controlnet(args, generative_model, nodes_dist, lg_x, lg
             edge_mask_1=lg_edge_mask, 
             edge_mask_2=pkt_edge_mask, 
             joint_edge_mask=joint_edge_mask, 
-            context=context
+            context=context,
+            **latent_kwargs
             )
 
         N = lg_node_mask.squeeze(2).sum(1).long()
@@ -10,6 +10,12 @@ from torch.distributions.categorical import Categorical
 from egnn.models import EGNN_dynamics_QM9, EGNN_encoder_QM9, EGNN_decoder_QM9, EGNN_dynamics_fusion, ControlNet_Module_Wrapper
 from equivariant_diffusion.en_diffusion import EnVariationalDiffusion, EnHierarchicalVAE, EnLatentDiffusion
 from equivariant_diffusion.control_en_diffusion import ControlEnLatentDiffusion
+from equivariant_diffusion.utils import set_checks_policy
+
+
+def set_checks_policy_from_args(args):
+    # resolved once per model build, pickled args of older runs have no checks settings
+    set_checks_policy(getattr(args, 'checks', 'always'), getattr(args, 'checks_every', 1))
 
 
 def get_model(args, device, dataset_info, dataloader_train):
@@ -48,6 +54,7 @@ def get_model(args, device, dataset_info, dataloader_train):
             include_charges=args.include_charges
             )
 
+        set_checks_policy_from_args(args)
         return vdm, nodes_dist, prop_dist
 
     else:
@@ -126,6 +133,7 @@ def get_autoencoder(args, device, dataset_info, identifier='VAE'):
         identifier=identifier
     )
 
+    set_checks_policy_from_args(args)
     return vae, nodes_dist, prop_dist
 
 
@@ -215,6 +223,7 @@ def get_latent_diffusion(args, device, dataset_info):
             include_charges=args.include_charges # true
             )
 
+        set_checks_policy_from_args(args)
         return vdm, nodes_dist, prop_dist
 
     else:
@@ -330,7 +339,13 @@ def get_controlled_latent_diffusion(args, device, ligand_dataset_info, pocket_da
             noise_injection_weights=[float(i) for i in args.noise_injection_weights],
             noise_injection_aggregation_method=args.noise_injection_aggregation_method,
             noise_injection_normalization_factor=float(args.noise_injection_normalization_factor),
-            time_noisy=bool(args.time_noisy)
+            time_noisy=bool(args.time_noisy),
+            pocket_edges=args.pocket_edges,
+            pocket_knn=args.pocket_knn,
+            pocket_radius=args.pocket_radius,
+            fusion_edges=args.fusion_edges,
+            fusion_knn=args.fusion_knn,
+            fusion_radius=args.fusion_radius
         )
 
         # return vdm, nodes_dist, prop_dist
@@ -355,6 +370,7 @@ def get_controlled_latent_diffusion(args, device, ligand_dataset_info, pocket_da
         )
         controlldm.to(device)
 
+        set_checks_policy_from_args(args)
         return controlldm, ligand_nodes_dist, ligand_prop_dist
 
     else:
@@ -3,6 +3,7 @@ import matplotlib
 matplotlib.use('Agg')
 import torch
 import matplotlib.pyplot as plt
+from egnn.egnn_new import get_edge_index
 
 def create_folders(args):
     try:
@@ -72,29 +73,8 @@ def adjust_learning_rate(optimizer, epoch, lr_0, factor=0.5, epochs_decay=100):
     for param_group in optimizer.param_groups:
         param_group['lr'] = lr
 
-edges_dic = {}
-
-
 def get_adj_matrix(n_nodes, batch_size, device):
-    if n_nodes in edges_dic:
-        edges_dic_b = edges_dic[n_nodes]
-        if batch_size in edges_dic_b:
-            return edges_dic_b[batch_size]
-        else:
-            # get edges for a single sample
-            rows, cols = [], []
-            for batch_idx in range(batch_size):
-                for i in range(n_nodes):
-                    for j in range(n_nodes):
-                        rows.append(i + batch_idx*n_nodes)
-                        cols.append(j + batch_idx*n_nodes)
-
-    else:
-        edges_dic[n_nodes] = {}
-        return get_adj_matrix(n_nodes, batch_size, device)
-
-    edges = [torch.LongTensor(rows).to(device), torch.LongTensor(cols).to(device)]
-    return edges
+    return get_edge_index(n_nodes, n_nodes, batch_size, device)
 
 # def preprocess_input(one_hot, charges, charge_power, charge_scale, device):
 #     charge_tensor = (charges.unsqueeze(-1) / charge_scale).pow(
@@ -5,6 +5,7 @@ from equivariant_diffusion.utils import assert_mean_zero_with_mask, remove_mean_
     assert_correctly_masked
 from qm9.analyze import check_stability
 from qm9.data import collate as qm9_collate
+from build_geom_dataset import pack_edge_budget
 
 
 def rotate_chain(z):
@@ -52,7 +53,8 @@ def reverse_tensor(x):
     return x[torch.arange(x.size(0) - 1, -1, -1)]
 
 
-def sample_chain(args, device, flow, n_tries, dataset_info, prop_dist=None):
+def sample_chain(args, device, flow, n_tries, dataset_info, prop_dist=None,
+                 num_sampling_steps=None, eta=None):
     n_samples = 1
     if args.dataset == 'qm9' or args.dataset == 'qm9_second_half' or args.dataset == 'qm9_first_half':
         n_nodes = 19
@@ -77,7 +79,9 @@ def sample_chain(args, device, flow, n_tries, dataset_info, prop_dist=None):
     if args.probabilistic_model == 'diffusion':
         one_hot, charges, x = None, None, None
         for i in range(n_tries):
-            chain = flow.sample_chain(n_samples, n_nodes, node_mask, edge_mask, context, keep_frames=100)
+            keep_frames = 100 if num_sampling_steps is None else min(100, num_sampling_steps)
+            chain = flow.sample_chain(n_samples, n_nodes, node_mask, edge_mask, context, keep_frames=keep_frames,
+                                      num_sampling_steps=num_sampling_steps, eta=eta)
             chain = reverse_tensor(chain)
 
             # Repeat last frame to see final sample better.
@@ -108,15 +112,92 @@ def sample_chain(args, device, flow, n_tries, dataset_info, prop_dist=None):
     return one_hot, charges, x
 
 
+def get_size_buckets(nodesxsample, n_buckets=1):
+    """
+    Groups the requested molecules by atom count into at most n_buckets buckets, cut at size
+    boundaries (molecules of the same size share a bucket) closest to equal bucket counts.
+    Returns a list of index tensors into nodesxsample.
+    """
+    order = torch.argsort(nodesxsample, stable=True)
+    sizes = nodesxsample[order]
+    n_buckets = max(1, min(int(n_buckets), len(order)))
+    boundaries = (torch.nonzero(sizes[1:] != sizes[:-1]).flatten() + 1).tolist()  # where the size changes
+    cuts = []
+    if len(boundaries) > 0:
+        cuts = sorted(set(min(boundaries, key=lambda boundary: abs(boundary - k * len(order) / n_buckets))
+                          for k in range(1, n_buckets)))
+    return [order[start:end] for start, end in zip([0] + cuts, cuts + [len(order)])]
+
+
+def get_edge_budget_buckets(nodesxsample, max_edges, pocket_sizes=None, max_batch_size=None):
+    """
+    Groups the requested molecules by atom count (pocket size first, if given) into batches
+    within the padded edge budget and of at most max_batch_size molecules, see build_geom_dataset.pack_edge_budget.
+    Returns a list of index tensors into nodesxsample.
+    """
+    lengths = nodesxsample.cpu().numpy()
+    if pocket_sizes is None:
+        order = np.argsort(lengths, kind='stable')
+    else:
+        pocket_sizes = np.asarray(pocket_sizes)
+        order = np.lexsort((lengths, pocket_sizes))
+    return [torch.from_numpy(bucket) for bucket in pack_edge_budget(order, lengths, max_edges, pocket_sizes, max_batch_size)]
+
+
+def scatter_buckets(results, bucket, bucket_outputs, batch_size, max_n_nodes):
+    """
+    Writes one bucket's outputs back to their original positions, zero padded to max_n_nodes.
+    """
+    if results is None:
+        results = [value.new_zeros((batch_size, max_n_nodes) + value.size()[2:]) for value in bucket_outputs]
+    for result, value in zip(results, bucket_outputs):
+        result[bucket.to(value.device), :value.size(1)] = value
+    return results
+
+
 def sample(args, device, generative_model, dataset_info,
            prop_dist=None, nodesxsample=torch.tensor([10]), context=None,
-           fix_noise=False):
+           fix_noise=False, num_sampling_steps=None, eta=None, solver='ddim', solver_order=2,
+           n_buckets=1, max_edges=None, max_batch_size=None):
+    """
+    Samples len(nodesxsample) molecules. Molecules are grouped into n_buckets size buckets,
+    each sampled with n_nodes = largest molecule in the bucket instead of max_n_nodes.
+    max_edges (optional): buckets are batches within this padded edge budget instead,
+    of at most max_batch_size molecules.
+    Outputs are returned in the original order, padded to max_n_nodes.
+    """
     max_n_nodes = dataset_info['max_n_nodes']  # this is the maximum node_size in QM9
 
     assert int(torch.max(nodesxsample)) <= max_n_nodes
     batch_size = len(nodesxsample)
 
-    node_mask = torch.zeros(batch_size, max_n_nodes)
+    if args.context_node_nf > 0 and context is None:
+        context = prop_dist.sample_batch(nodesxsample)
+
+    if max_edges is not None:
+        buckets = get_edge_budget_buckets(nodesxsample, max_edges, max_batch_size=max_batch_size)
+    else:
+        buckets = get_size_buckets(nodesxsample, n_buckets)
+
+    results = None
+    for bucket in buckets:
+        bucket_outputs = _sample(args, device, generative_model,
+                                 nodesxsample=nodesxsample[bucket],
+                                 context=context[bucket.to(context.device)] if context is not None else None,
+                                 fix_noise=fix_noise, num_sampling_steps=num_sampling_steps, eta=eta,
+                                 solver=solver, solver_order=solver_order)
+        results = scatter_buckets(results, bucket, bucket_outputs, batch_size, max_n_nodes)
+
+    one_hot, charges, x, node_mask = results
+    return one_hot, charges, x, node_mask
+
+
+def _sample(args, device, generative_model, nodesxsample, context=None,
+            fix_noise=False, num_sampling_steps=None, eta=None, solver='ddim', solver_order=2):
+    n_nodes = int(torch.max(nodesxsample))  # largest molecule in this bucket
+    batch_size = len(nodesxsample)
+
+    node_mask = torch.zeros(batch_size, n_nodes)
     for i in range(batch_size):
         node_mask[i, 0:nodesxsample[i]] = 1
 
@@ -125,21 +206,21 @@ def sample(args, device, generative_model, dataset_info,
     edge_mask = node_mask.unsqueeze(1) * node_mask.unsqueeze(2)
     diag_mask = ~torch.eye(edge_mask.size(1), dtype=torch.bool).unsqueeze(0)
     edge_mask *= diag_mask
-    edge_mask = edge_mask.view(batch_size * max_n_nodes * max_n_nodes, 1).to(device)
+    edge_mask = edge_mask.view(batch_size * n_nodes * n_nodes, 1).to(device)
     node_mask = node_mask.unsqueeze(2).to(device)
 
     # TODO FIX: This conditioning just zeros.
     if args.context_node_nf > 0:
-        if context is None:
-            context = prop_dist.sample_batch(nodesxsample)
-        context = context.unsqueeze(1).repeat(1, max_n_nodes, 1).to(device) * node_mask
+        context = context.unsqueeze(1).repeat(1, n_nodes, 1).to(device) * node_mask
     else:
         context = None
 
     generative_model.eval()
     with torch.no_grad():
         if args.probabilistic_model == 'diffusion':
-            x, h = generative_model.sample(batch_size, max_n_nodes, node_mask, edge_mask, context, fix_noise=fix_noise)
+            x, h = generative_model.sample(batch_size, n_nodes, node_mask, edge_mask, context, fix_noise=fix_noise,
+                                           num_sampling_steps=num_sampling_steps, eta=eta,
+                                           solver=solver, solver_order=solver_order)
 
             assert_correctly_masked(x, node_mask)
             assert_mean_zero_with_mask(x, node_mask)
@@ -158,10 +239,67 @@ def sample(args, device, generative_model, dataset_info,
 
 
 
+def get_pocket_batch(args, device, pocket_dict_list):
+    """
+    Zero padded batch of pockets: centered positions, features, node_mask [bs, n, 1] and
+    edge_mask [bs*n*n, 1].
+    """
+    pocket_batch = {prop: qm9_collate.batch_stack([mol[prop] for mol in pocket_dict_list])
+                    for prop in pocket_dict_list[0].keys()}
+    pkt_x = pocket_batch['positions'].to(device, dtype=args.dtype)
+    pkt_h_one_hot = pocket_batch['one_hot'].to(device, dtype=args.dtype)
+    pkt_h_charges = (pocket_batch['charges'] if args.include_charges else torch.zeros(0)).to(device, dtype=args.dtype)
+    pkt_h = {'categorical': pkt_h_one_hot, 'integer': pkt_h_charges}
+
+    pkt_node_mask = pocket_batch['atom_mask'].to(device)
+    bs, pkt_n_nodes = pkt_node_mask.size()
+    pkt_edge_mask = pkt_node_mask.unsqueeze(1) * pkt_node_mask.unsqueeze(2)
+    pkt_diag_mask = ~torch.eye(pkt_edge_mask.size(1), dtype=torch.bool).unsqueeze(0).to(device)
+    pkt_edge_mask *= pkt_diag_mask
+    pkt_edge_mask = pkt_edge_mask.view(bs * pkt_n_nodes * pkt_n_nodes, 1).to(device)
+    pkt_node_mask = pkt_node_mask.unsqueeze(2).to(device)
+
+    # center pocket coordinates
+    pkt_x = remove_mean_with_mask(pkt_x, pkt_node_mask)
+    assert_mean_zero_with_mask(pkt_x, pkt_node_mask)
+    return pkt_x, pkt_h, pkt_node_mask, pkt_edge_mask
+
+
+def encode_pockets(args, device, generative_model, pocket_dict_list, max_edges=None):
+    """
+    Pocket latent means ([n_atoms, dims] each, unpadded) of pocket_dict_list, encoded in batches
+    within the padded pocket edge budget max_edges (a single batch if None).
+    """
+    sizes = np.array([int(pocket['atom_mask'].numel()) for pocket in pocket_dict_list])
+    order = np.argsort(sizes, kind='stable')
+    batches = [order] if max_edges is None else pack_edge_budget(order, sizes, max_edges)
+
+    latents = [None] * len(pocket_dict_list)
+    generative_model.eval()
+    with torch.no_grad():
+        for batch in batches:
+            pkt_x, pkt_h, pkt_node_mask, pkt_edge_mask = get_pocket_batch(args, device, [pocket_dict_list[i] for i in batch])
+            z_xh_mean = generative_model.encode_pocket(pkt_x, pkt_h, pkt_node_mask, pkt_edge_mask, None)
+            for row, i in enumerate(batch.tolist()):
+                latents[i] = z_xh_mean[row, :sizes[i]]
+    return latents
+
+
 def sample_controlnet(args, device, generative_model, dataset_info,
                       nodesxsample=torch.tensor([10]), context=None,
-                      fix_noise=False, pocket_dict_list=[]):
-
+                      fix_noise=False, pocket_dict_list=[],
+                      num_sampling_steps=None, eta=None, solver='ddim', solver_order=2,
+                      n_buckets=1, max_edges=None, max_batch_size=None, pocket_ids=None):
+    """
+    Samples one ligand per pocket in pocket_dict_list. Ligands are grouped into n_buckets
+    size buckets, each sampled with n_nodes = largest ligand in the bucket instead of
+    max_n_nodes. Outputs are returned in the original order, padded to max_n_nodes.
+    max_edges (optional): buckets are batches within this padded ligand + pocket + joint edge budget instead,
+    of at most max_batch_size ligands.
+    pocket_ids (optional): one key per entry of pocket_dict_list (e.g. the pocket file), entries with
+    the same key hold the same pocket. The unique pockets are encoded once for the whole request,
+    before bucketing, and every bucket indexes their latents.
+    """
     max_n_nodes = dataset_info['max_n_nodes']  # this is the maximum node_size
 
     # Pockets' ['positions'], ['one_hot'], ['charges'], ['atom_mask'] are already available
@@ -169,9 +307,60 @@ def sample_controlnet(args, device, generative_model, dataset_info,
     batch_size = len(nodesxsample)
 
     assert batch_size == len(pocket_dict_list), f"Different batch_size encountered! batch_size={batch_size}, len(pocket_dict_list)={len(pocket_dict_list)}"
+    if pocket_ids is not None:
+        assert len(pocket_ids) == batch_size, f"Different number of pocket ids encountered! pocket_ids={len(pocket_ids)}, batch_size={batch_size}"
+
+    if args.probabilistic_model != 'diffusion':
+        raise ValueError(args.probabilistic_model)
+
+    # Unique pockets (by pocket id, else every entry), pocket_index maps every ligand to its pocket
+    keys = pocket_ids if pocket_ids is not None else range(batch_size)
+    first = {}  # pocket id -> first entry holding it
+    for i, key in enumerate(keys):
+        first.setdefault(key, i)
+    unique_index = {key: j for j, key in enumerate(first)}
+    pocket_index = torch.tensor([unique_index[key] for key in keys])
+    unique_pockets = [pocket_dict_list[i] for i in first.values()]
+    pocket_latents = encode_pockets(args, device, generative_model, unique_pockets, max_edges)
+
+    if max_edges is not None:
+        pocket_sizes = [int(pocket['atom_mask'].numel()) for pocket in pocket_dict_list]
+        buckets = get_edge_budget_buckets(nodesxsample, max_edges, pocket_sizes, max_batch_size)
+    else:
+        buckets = get_size_buckets(nodesxsample, n_buckets)
+
+    results = None
+    for bucket in buckets:
+        # the bucket's pockets, and its ligands -> those pockets
+        bucket_pockets, bucket_pocket_index = torch.unique(pocket_index[bucket], return_inverse=True)
+        bucket_pockets = bucket_pockets.tolist()
+        bucket_outputs = _sample_controlnet(args, device, generative_model,
+                                            nodesxsample=nodesxsample[bucket],
+                                            context=context[bucket.to(context.device)] if context is not None else None,
+                                            fix_noise=fix_noise,
+                                            pocket_dict_list=[unique_pockets[j] for j in bucket_pockets],
+                                            pocket_latents=[pocket_latents[j] for j in bucket_pockets],
+                                            pocket_index=bucket_pocket_index,
+                                            num_sampling_steps=num_sampling_steps, eta=eta,
+                                            solver=solver, solver_order=solver_order)
+        results = scatter_buckets(results, bucket, bucket_outputs, batch_size, max_n_nodes)
+
+    one_hot, charges, x, lg_node_mask = results
+    return one_hot, charges, x, lg_node_mask
+
+
+def _sample_controlnet(args, device, generative_model, nodesxsample, context=None,
+                       fix_noise=False, pocket_dict_list=[], pocket_latents=[], pocket_index=None,
+                       num_sampling_steps=None, eta=None, solver='ddim', solver_order=2):
+    """
+    Samples the ligands of one bucket. pocket_dict_list / pocket_latents: the bucket's unique pockets
+    and their encode_pockets() latents, pocket_index [batch_size]: every ligand's pocket.
+    """
+    n_nodes = int(torch.max(nodesxsample))  # largest ligand in this bucket
+    batch_size = len(nodesxsample)
 
     # Ligand node_mask
-    lg_node_mask = torch.zeros(batch_size, max_n_nodes)
+    lg_node_mask = torch.zeros(batch_size, n_nodes)
     for i in range(batch_size):
         lg_node_mask[i, 0:nodesxsample[i]] = 1
 
@@ -179,37 +368,23 @@ def sample_controlnet(args, device, generative_model, dataset_info,
     lg_edge_mask = lg_node_mask.unsqueeze(1) * lg_node_mask.unsqueeze(2)
     lg_diag_mask = ~torch.eye(lg_edge_mask.size(1), dtype=torch.bool).unsqueeze(0)
     lg_edge_mask *= lg_diag_mask
-    lg_edge_mask = lg_edge_mask.view(batch_size * max_n_nodes * max_n_nodes, 1).to(device)
+    lg_edge_mask = lg_edge_mask.view(batch_size * n_nodes * n_nodes, 1).to(device)
     lg_node_mask = lg_node_mask.unsqueeze(2).to(device)
 
-    # Pocket: zero padding done here
-    pocket_batch = {prop: qm9_collate.batch_stack([mol[prop] for mol in pocket_dict_list])
-                    for prop in pocket_dict_list[0].keys()}
-    pkt_x = pocket_batch['positions'].to(device, dtype=args.dtype)
-    pkt_h_one_hot = pocket_batch['one_hot'].to(device, dtype=args.dtype)
-    pkt_h_charges = (pocket_batch['charges'] if args.include_charges else torch.zeros(0)).to(device, dtype=args.dtype)
-    pkt_h = {'categorical': pkt_h_one_hot, 'integer': pkt_h_charges}
-
-    pkt_node_mask = pocket_batch['atom_mask'].to(device)
-    bs, pkt_n_nodes = pkt_node_mask.size()
-    assert batch_size == bs, f"Different batch_size encountered! ligand={batch_size}, pocket={bs}"
-    pkt_edge_mask = pkt_node_mask.unsqueeze(1) * pkt_node_mask.unsqueeze(2)
-    pkt_diag_mask = ~torch.eye(pkt_edge_mask.size(1), dtype=torch.bool).unsqueeze(0).to(device)
-    pkt_edge_mask *= pkt_diag_mask
-    pkt_edge_mask = pkt_edge_mask.view(batch_size * pkt_n_nodes * pkt_n_nodes, 1).to(device)
-    pkt_node_mask = pkt_node_mask.unsqueeze(2).to(device)
+    # Pocket: zero padding done here, padded to the largest pocket of this bucket
+    _, _, pkt_node_mask, pkt_edge_mask = get_pocket_batch(args, device, pocket_dict_list)
+    pkt_z_xh_mean = qm9_collate.batch_stack(pocket_latents).to(device)
+    pkt_n_nodes = pkt_node_mask.size(1)
+    assert batch_size == len(pocket_index), f"Different batch_size encountered! ligand={batch_size}, pocket={len(pocket_index)}"
 
-    joint_edge_mask = pkt_node_mask.unsqueeze(1) * lg_node_mask.unsqueeze(2)
-    joint_edge_mask = joint_edge_mask.view(batch_size * max_n_nodes * pkt_n_nodes, 1).to(device)
+    pocket_index = pocket_index.to(device)
+    joint_edge_mask = pkt_node_mask[pocket_index].unsqueeze(1) * lg_node_mask.unsqueeze(2)
+    joint_edge_mask = joint_edge_mask.view(batch_size * n_nodes * pkt_n_nodes, 1).to(device)
     # ~!joint_edge_mask tested, same as:
     # edge_index = get_adj_matrix(n_nodes_1=3, n_nodes_2=2, batch_size=2)
     # n1, n2 = edge_index
     # joint_edge_mask_3 = ligand_atom_mask_batched[n1] * pocket_atom_mask_batched[n2]
 
-    # center pocket coordinates
-    pkt_x = remove_mean_with_mask(pkt_x, pkt_node_mask)
-    assert_mean_zero_with_mask(pkt_x, pkt_node_mask)
-
     if args.context_node_nf > 0:
         raise NotImplementedError()
     else:
@@ -221,16 +396,22 @@ def sample_controlnet(args, device, generative_model, dataset_info,
     with torch.no_grad():
         if args.probabilistic_model == 'diffusion':
             x, h = generative_model.sample(n_samples=batch_size, 
-                                        n_nodes=max_n_nodes, 
-                                        x2=pkt_x, 
-                                        h2=pkt_h, 
+                                        n_nodes=n_nodes, 
+                                        x2=None, 
+                                        h2=None, 
                                         node_mask_1=lg_node_mask, 
                                         node_mask_2=pkt_node_mask, 
                                         edge_mask_1=lg_edge_mask, 
                                         edge_mask_2=pkt_edge_mask, 
                                         joint_edge_mask=joint_edge_mask, 
                                         context=context, 
-                                        fix_noise=fix_noise)
+                                        fix_noise=fix_noise,
+                                        num_sampling_steps=num_sampling_steps,
+                                        eta=eta,
+                                        solver=solver,
+                                        solver_order=solver_order,
+                                        pocket_index=pocket_index,
+                                        z_xh_mean_2=pkt_z_xh_mean)
 
             assert_correctly_masked(x, lg_node_mask)
             assert_mean_zero_with_mask(x, lg_node_mask)
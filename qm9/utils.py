@@ -1,4 +1,5 @@
 import torch
+from egnn.egnn_new import get_edge_index
 
 
 def compute_mean_mad(dataloaders, properties, dataset_name):
@@ -22,28 +23,8 @@ def compute_mean_mad_from_dataloader(dataloader, properties):
         property_norms[property_key]['mad'] = mad       # mean absolute deviation
     return property_norms
 
-edges_dic = {}
 def get_adj_matrix(n_nodes, batch_size, device):
-    if n_nodes in edges_dic:
-        edges_dic_b = edges_dic[n_nodes]
-        if batch_size in edges_dic_b:
-            return edges_dic_b[batch_size]
-        else:
-            # get edges for a single sample
-            rows, cols = [], []
-            for batch_idx in range(batch_size):
-                for i in range(n_nodes):
-                    for j in range(n_nodes):
-                        rows.append(i + batch_idx*n_nodes)
-                        cols.append(j + batch_idx*n_nodes)
-
-    else:
-        edges_dic[n_nodes] = {}
-        return get_adj_matrix(n_nodes, batch_size, device)
-
-
-    edges = [torch.LongTensor(rows).to(device), torch.LongTensor(cols).to(device)]
-    return edges
+    return get_edge_index(n_nodes, n_nodes, batch_size, device)
 
 def preprocess_input(one_hot, charges, charge_power, charge_scale, device):
     charge_tensor = (charges.unsqueeze(-1) / charge_scale).pow(
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the repo is not an installed package, its modules are imported from the root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
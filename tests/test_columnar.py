@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pytest
+
+import build_geom_dataset
+import columnar_dataset
+
+
+def legacy_array(seed=0, n_molecules=6):
+    """[n_atoms, 5] (mol_id, atomic_num, x, y, z), float32 values so the columnar store is exact."""
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, 8, n_molecules)
+    mol_id = np.repeat(np.arange(10, 10 + n_molecules), lengths)
+    atomic_num = rng.choice([1, 6, 7, 8, 16], len(mol_id))
+    coords = rng.standard_normal((len(mol_id), 3)).astype(np.float32)
+    return np.concatenate([mol_id[:, None], atomic_num[:, None], coords], axis=1)
+
+
+def test_molecule_array_copy_semantics(tmp_path):
+    columnar_dataset.write_columnar(legacy_array(), str(tmp_path / 'store'))
+    molecule = columnar_dataset.load_columnar(str(tmp_path / 'store'))[2]
+    array = np.asarray(molecule)
+    assert isinstance(array, np.ndarray) and array.shape == molecule.shape
+    assert np.asarray(molecule, dtype=np.float64).dtype == np.float64
+    assert np.array(molecule, copy=True).shape == molecule.shape
+    if np.lib.NumpyVersion(np.__version__) >= '2.0.0':
+        with pytest.raises(ValueError):
+            np.asarray(molecule, copy=False)
+
+
+def assert_same_molecules(result, expected):
+    assert len(result) == len(expected)
+    for molecule, legacy in zip(result, expected):
+        assert np.array_equal(np.asarray(molecule, dtype=np.float64), np.asarray(legacy)[:, -4:])
+
+
+def test_columnar_matches_npy_splits(tmp_path):
+    npy_path, store_path = str(tmp_path / 'data.npy'), str(tmp_path / 'store')
+    np.save(npy_path, legacy_array(n_molecules=20))
+    columnar_dataset.convert(npy_path, store_path)
+    permutation_path = str(tmp_path / 'permutation.npy')
+    np.save(permutation_path, np.random.default_rng(1).permutation(20).astype('int32'))
+
+    expected = build_geom_dataset.load_split_data(npy_path, val_proportion=0.2, test_proportion=0.2,
+                                                  permutation_file_path=permutation_path)
+    result = build_geom_dataset.load_split_data(store_path, val_proportion=0.2, test_proportion=0.2,
+                                                permutation_file_path=permutation_path)
+    for result_split, expected_split in zip(result, expected):
+        assert_same_molecules(result_split, expected_split)
+
+
+def pair_arrays(seed=0):
+    """ligand_{split} / pocket_{split} arrays sharing pair ids, each of the 3 pockets used by several ligands."""
+    rng = np.random.default_rng(seed)
+    receptors = [legacy_array(seed + i, n_molecules=1)[:, 1:] for i in range(3)]
+    all_data, pair_id = {}, 100
+    for split, n_pairs in [('train', 7), ('test', 3), ('val', 4)]:
+        ligand_rows = legacy_array(seed + n_pairs, n_molecules=n_pairs)
+        ligands, pockets = [], []
+        for i in range(n_pairs):
+            rows = ligand_rows[ligand_rows[:, 0] == 10 + i, 1:]
+            pocket = receptors[rng.integers(len(receptors))]
+            ligands.append(np.concatenate([np.full((len(rows), 1), pair_id), rows], axis=1))
+            pockets.append(np.concatenate([np.full((len(pocket), 1), pair_id), pocket], axis=1))
+            pair_id += 1
+        all_data[f'ligand_{split}'], all_data[f'pocket_{split}'] = np.concatenate(ligands), np.concatenate(pockets)
+    return all_data
+
+
+def test_dedup_pocket_pair_tables(tmp_path):
+    all_data = pair_arrays()
+    npz_path, store_path = str(tmp_path / 'pairs.npz'), str(tmp_path / 'store')
+    np.savez(npz_path, **all_data)
+    columnar_dataset.convert(npz_path, store_path, dedup_pockets=True)
+
+    data = columnar_dataset.load_columnar(store_path)
+    assert len(columnar_dataset.ColumnarMolecules(os.path.join(store_path, columnar_dataset.UNIQUE_POCKETS_KEY))) <= 3
+    expected = build_geom_dataset.process_splitted_pair_data(all_data, return_mol_id=True)
+    result = build_geom_dataset.process_splitted_pair_data(data, return_mol_id=True)
+    for result_split, expected_split in zip(result[:6], expected[:6]):
+        assert_same_molecules(result_split, expected_split)
+    assert result[6:] == expected[6:]
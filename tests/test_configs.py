@@ -0,0 +1,10 @@
+import utils
+from global_registry import Config
+
+
+def test_add_missing_configs_keeps_set_options():
+    args = utils.add_missing_configs(Config(batch_size=8, grad_accumulation_steps=2, sampling_n_buckets=4))
+    assert args.sampling_n_buckets == 4
+    assert args.sampling_eta is None and args.sampling_solver == 'ddim'
+    assert args.molecules_per_step == 16
+    assert args.factorized_edge_mlp and args.split_cache_dir is None
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import torch
+
+from build_geom_dataset import pack_edge_budget
+from utils import EdgeBudgetAccumulator
+
+
+def padded_edges(batch, lengths, pocket_lengths=None):
+    n_max = int(lengths[batch].max())
+    n_pkt_max = 0 if pocket_lengths is None else int(pocket_lengths[batch].max())
+    return len(batch) * (n_max ** 2 + n_pkt_max ** 2 + n_max * n_pkt_max)
+
+
+@pytest.mark.parametrize('with_pockets', [False, True])
+@pytest.mark.parametrize('max_batch_size', [None, 7])
+def test_pack_edge_budget_bounds(with_pockets, max_batch_size):
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(5, 60, 300)
+    pocket_lengths = rng.integers(20, 120, 300) if with_pockets else None
+    max_edges = 30000
+    order = np.argsort(lengths, kind='stable')
+
+    batches = pack_edge_budget(order, lengths, max_edges, pocket_lengths, max_batch_size)
+
+    assert sorted(np.concatenate(batches).tolist()) == list(range(len(lengths)))
+    for batch in batches:
+        assert len(batch) == 1 or padded_edges(batch, lengths, pocket_lengths) <= max_edges
+        assert max_batch_size is None or len(batch) <= max_batch_size
+
+
+def test_pack_edge_budget_oversized_molecule():
+    lengths = np.array([10, 200, 10])
+    batches = pack_edge_budget(np.argsort(lengths, kind='stable'), lengths, 1000)
+    assert [batch.tolist() for batch in batches] == [[0, 2], [1]]
+
+
+def test_sampling_edge_budget_buckets():
+    sampling = pytest.importorskip('qm9.sampling')
+    nodesxsample = torch.from_numpy(np.random.default_rng(1).integers(5, 60, 100))
+    buckets = sampling.get_edge_budget_buckets(nodesxsample, 20000, max_batch_size=16)
+    assert sorted(torch.cat(buckets).tolist()) == list(range(100))
+    for bucket in buckets:
+        assert len(bucket) <= 16
+        assert len(bucket) == 1 or padded_edges(bucket.numpy(), nodesxsample.numpy()) <= 20000
+
+
+def test_edge_budget_accumulator_averages_over_the_step_molecules():
+    torch.manual_seed(0)
+    model = torch.nn.Linear(4, 1)
+    batches = [torch.randn(3, 4), torch.randn(5, 4)]
+    expected = torch.autograd.grad(model(torch.cat(batches)).pow(2).mean(), model.weight)[0]
+
+    accumulator = EdgeBudgetAccumulator(molecules_per_step=6)
+    for batch in batches:
+        accumulator.scale_loss(model(batch).pow(2).mean(), batch.size(0)).backward()
+    assert accumulator.step_ready()
+    accumulator.renormalize_grads(model)
+    assert torch.allclose(model.weight.grad, expected, atol=1e-6)
+
+    # a step without accumulated molecules leaves the grads alone
+    accumulator.renormalize_grads(model)
+    assert torch.allclose(model.weight.grad, expected, atol=1e-6)
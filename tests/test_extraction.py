@@ -0,0 +1,68 @@
+import argparse
+import os
+
+import msgpack
+import numpy as np
+import pytest
+
+import build_geom_dataset
+
+
+def write_drugs_file(path, n_chunks=4, molecules_per_chunk=3, seed=0):
+    """A GEOM-like msgpack: n_chunks top-level {smiles: {'conformers': [..]}} objects."""
+    rng = np.random.default_rng(seed)
+    with open(path, 'wb') as f:
+        for chunk in range(n_chunks):
+            drugs = {}
+            for molecule in range(molecules_per_chunk):
+                n_atoms = int(rng.integers(2, 6))
+                atomic_num = rng.choice([1., 6., 8.], n_atoms)
+                drugs[f'C{chunk}_{molecule}'] = {'conformers': [
+                    {'totalenergy': float(rng.random()), 'boltzmannweight': float(rng.random()),
+                     'xyz': np.concatenate([atomic_num[:, None], rng.standard_normal((n_atoms, 3))], axis=1).tolist()}
+                    for _ in range(int(rng.integers(1, 4)))]}
+            f.write(msgpack.packb(drugs))
+
+
+def extract(data_dir):
+    build_geom_dataset.extract_conformers(argparse.Namespace(
+        data_dir=str(data_dir), data_file='drugs.msgpack', remove_h=False, conformations=2, num_workers=0))
+    outputs = {'data': np.load(os.path.join(data_dir, 'geom_drugs_2.npy')),
+               'n_atoms': np.load(os.path.join(data_dir, 'geom_drugs_n_2.npy'))}
+    with np.load(os.path.join(data_dir, 'geom_drugs_2_conformer_groups.npz')) as groups:
+        outputs.update({key: groups[key] for key in groups.files})
+    with open(os.path.join(data_dir, 'geom_drugs_smiles.txt')) as f:
+        outputs['smiles'] = f.read()
+    return outputs
+
+
+def test_extraction_resumes_after_a_kill(tmp_path, monkeypatch):
+    for name in ['full', 'killed']:
+        os.makedirs(tmp_path / name)
+        write_drugs_file(str(tmp_path / name / 'drugs.msgpack'))
+    expected = extract(tmp_path / 'full')
+
+    process_drugs_chunk = build_geom_dataset.process_drugs_chunk
+    calls = []
+
+    def killed_on_third_chunk(*args):
+        calls.append(1)
+        if len(calls) == 3:
+            # rows of the chunk in flight reach the file, its checkpoint never does
+            with open(tmp_path / 'killed' / 'geom_drugs_2.npy', 'ab') as f:
+                f.write(np.ones((4, 5)).tobytes())
+            raise KeyboardInterrupt
+        return process_drugs_chunk(*args)
+
+    monkeypatch.setattr(build_geom_dataset, 'process_drugs_chunk', killed_on_third_chunk)
+    with pytest.raises(KeyboardInterrupt):
+        extract(tmp_path / 'killed')
+    assert os.path.exists(tmp_path / 'killed' / 'geom_drugs_2_extract_progress.json')
+    monkeypatch.setattr(build_geom_dataset, 'process_drugs_chunk', process_drugs_chunk)
+
+    result = extract(tmp_path / 'killed')
+    assert result.keys() == expected.keys()
+    assert result.pop('smiles') == expected.pop('smiles')
+    for key in expected:
+        assert np.array_equal(result[key], expected[key])
+    assert not os.path.exists(tmp_path / 'killed' / 'geom_drugs_2_extract_progress.json')
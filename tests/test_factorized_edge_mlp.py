@@ -0,0 +1,45 @@
+import pytest
+import torch
+
+from egnn import egnn_fusion, egnn_new
+
+
+def random_edges(generator, n_nodes_1, n_nodes_2, n_edges=40):
+    row = torch.randint(n_nodes_1, (n_edges,), generator=generator)
+    col = torch.randint(n_nodes_2, (n_edges,), generator=generator)
+    return row, col
+
+
+@pytest.mark.parametrize('module', [egnn_new, egnn_fusion])
+@pytest.mark.parametrize('edges_in_d', [0, 2])
+def test_factorized_edge_model_matches_concatenation(module, edges_in_d):
+    generator = torch.Generator().manual_seed(0)
+    torch.manual_seed(0)
+    hidden_nf, n_nodes_1, n_nodes_2 = 16, 11, 7
+    gcl = module.GCL(hidden_nf, hidden_nf, hidden_nf, normalization_factor=1, aggregation_method='sum',
+                     edges_in_d=edges_in_d, attention=True)
+    h_1 = torch.randn(n_nodes_1, hidden_nf, generator=generator)
+    h_2 = torch.randn(n_nodes_2, hidden_nf, generator=generator)
+    row, col = random_edges(generator, n_nodes_1, n_nodes_2)
+    edge_attr = torch.randn(row.size(0), edges_in_d, generator=generator) if edges_in_d else None
+    edge_mask = (torch.rand(row.size(0), 1, generator=generator) > 0.2).float()
+
+    # reference: edge_mlp[0] on the concatenated [E, 2 * hidden_nf + edges_in_d] input
+    expected_feat, expected_mij = gcl.edge_model(h_1[row], h_2[col], edge_attr, edge_mask)
+    feat, mij = gcl.edge_model(h_1, h_2, edge_attr, edge_mask, edge_index=(row, col))
+
+    torch.testing.assert_close(mij, expected_mij)
+    torch.testing.assert_close(feat, expected_feat)
+
+
+@pytest.mark.parametrize('edges_in_d', [1, 2])
+def test_factorized_edge_linear_matches_concatenation(edges_in_d):
+    generator = torch.Generator().manual_seed(1)
+    torch.manual_seed(1)
+    linear = torch.nn.Linear(2 * 8 + edges_in_d, 5)
+    source, target = torch.randn(6, 8, generator=generator), torch.randn(9, 8, generator=generator)
+    row, col = random_edges(generator, 6, 9)
+    edge_attr = torch.randn(row.size(0), edges_in_d, generator=generator)
+
+    expected = linear(torch.cat([source[row], target[col], edge_attr], dim=1))
+    torch.testing.assert_close(egnn_new.factorized_edge_linear(linear, source, target, row, col, edge_attr), expected)
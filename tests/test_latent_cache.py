@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+import torch
+
+from latent_cache import LatentCache, state_dict_hash, write_cache_meta
+
+
+def test_check_checkpoint_rejects_other_weights(tmp_path):
+    path = str(tmp_path / 'cache')
+    np.save(f"{path}_latents.npy", np.zeros((5, 4), dtype=np.float32))
+    np.save(f"{path}_offsets.npy", np.array([0, 2, 5]))
+    vae = torch.nn.Linear(4, 4)
+    write_cache_meta(path, {'checkpoint_hash': state_dict_hash(vae), 'data_fingerprint': ''})
+
+    cache = LatentCache(path)
+    cache.check_checkpoint(vae)
+    with torch.no_grad():
+        vae.weight[0, 0] += 1.
+    with pytest.raises(AssertionError):
+        cache.check_checkpoint(vae)
@@ -0,0 +1,78 @@
+import pytest
+import torch
+
+from egnn.egnn_new import get_neighbor_edge_index, get_packed_edge_index, pack_nodes, pack_edges
+
+
+def random_graphs(seed=0, batch_size=4, n_nodes_1=7, n_nodes_2=9):
+    generator = torch.Generator().manual_seed(seed)
+    x_1 = torch.randn(batch_size * n_nodes_1, 3, generator=generator)
+    x_2 = torch.randn(batch_size * n_nodes_2, 3, generator=generator)
+    counts_1, counts_2 = torch.tensor([7, 3, 0, 5]), torch.tensor([9, 1, 4, 6])
+    node_mask_1 = (torch.arange(n_nodes_1).unsqueeze(0) < counts_1.unsqueeze(1)).float().view(-1, 1)
+    node_mask_2 = (torch.arange(n_nodes_2).unsqueeze(0) < counts_2.unsqueeze(1)).float().view(-1, 1)
+    return x_1, x_2, node_mask_1, node_mask_2, batch_size
+
+
+def edge_mask(node_mask_1, node_mask_2, batch_size, exclude_self=False):
+    mask = node_mask_1.view(batch_size, -1, 1) * node_mask_2.view(batch_size, 1, -1)
+    if exclude_self:
+        mask = mask * (1 - torch.eye(mask.size(1), mask.size(2)))
+    return mask.view(-1, 1)
+
+
+def neighbor_mask_reference(x_1, x_2, mask, batch_size, mode, k=None, radius=None):
+    """The former dense-mask neighbour graph: full cdist, topk / cutoff, masked by the edge mask."""
+    n_nodes_1, n_nodes_2 = x_1.size(0) // batch_size, x_2.size(0) // batch_size
+    dist = torch.cdist(x_1.view(batch_size, n_nodes_1, -1), x_2.view(batch_size, n_nodes_2, -1))
+    valid = mask.view(batch_size, n_nodes_1, n_nodes_2) > 0
+    if mode == 'knn':
+        dist = dist.masked_fill(~valid, float('inf'))
+        nearest = dist.topk(min(k, n_nodes_2), dim=2, largest=False).indices
+        keep = torch.zeros_like(valid).scatter_(2, nearest, True)
+    else:
+        keep = dist <= radius
+    return (keep & valid).view(-1, 1).float()
+
+
+def edge_set(edge_index):
+    return sorted(zip(edge_index[0].tolist(), edge_index[1].tolist()))
+
+
+@pytest.mark.parametrize('packed', [False, True])
+@pytest.mark.parametrize('exclude_self', [False, True])
+@pytest.mark.parametrize('mode,k,radius', [('knn', 3, None), ('knn', 20, None), ('radius', None, 1.2)])
+def test_neighbor_edge_index_matches_dense_mask(packed, exclude_self, mode, k, radius):
+    x_1, x_2, node_mask_1, node_mask_2, batch_size = random_graphs()
+    if exclude_self:
+        x_2, node_mask_2 = x_1, node_mask_1
+    n_nodes_1, n_nodes_2 = x_1.size(0) // batch_size, x_2.size(0) // batch_size
+    packed_1 = pack_nodes(node_mask_1) if packed else None
+    packed_2 = pack_nodes(node_mask_2) if packed else None
+
+    mask = neighbor_mask_reference(x_1, x_2, edge_mask(node_mask_1, node_mask_2, batch_size, exclude_self),
+                                   batch_size, mode, k, radius)
+    expected = pack_edges(mask, n_nodes_1, n_nodes_2, packed_1, packed_2)
+    result = get_neighbor_edge_index(x_1, x_2, node_mask_1, node_mask_2, batch_size, mode, k, radius,
+                                     exclude_self=exclude_self, packed_1=packed_1, packed_2=packed_2)
+
+    assert edge_set(result) == edge_set(expected)
+    assert torch.equal(result.lengths, expected.lengths)
+    assert bool((result[0][1:] >= result[0][:-1]).all())
+
+
+@pytest.mark.parametrize('exclude_self', [False, True])
+def test_packed_edge_index_matches_pack_edges(exclude_self):
+    x_1, x_2, node_mask_1, node_mask_2, batch_size = random_graphs()
+    if exclude_self:
+        node_mask_2 = node_mask_1
+    n_nodes_1, n_nodes_2 = node_mask_1.size(0) // batch_size, node_mask_2.size(0) // batch_size
+    packed_1, packed_2 = pack_nodes(node_mask_1), pack_nodes(node_mask_2)
+
+    expected = pack_edges(edge_mask(node_mask_1, node_mask_2, batch_size, exclude_self),
+                          n_nodes_1, n_nodes_2, packed_1, packed_2)
+    result = get_packed_edge_index(node_mask_1, node_mask_2, batch_size, exclude_self=exclude_self)
+
+    assert torch.equal(result[0], expected[0])
+    assert torch.equal(result[1], expected[1])
+    assert torch.equal(result.lengths, expected.lengths)
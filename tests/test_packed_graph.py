@@ -0,0 +1,38 @@
+import pytest
+import torch
+
+from global_registry import PARAM_REGISTRY
+from egnn.models import EGNN_dynamics_QM9
+from equivariant_diffusion.utils import remove_mean_with_mask
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setitem(PARAM_REGISTRY._registry, 'device_', 'cpu')
+    monkeypatch.setitem(PARAM_REGISTRY._registry, 'mixed_precision_training', False)
+    return PARAM_REGISTRY._registry
+
+
+def dynamics_inputs(seed=0, bs=4, n_nodes=6):
+    generator = torch.Generator().manual_seed(seed)
+    node_mask = (torch.arange(n_nodes).unsqueeze(0) < torch.tensor([[6], [3], [5], [1]])).float().unsqueeze(2)
+    edge_mask = node_mask.view(bs, 1, n_nodes) * node_mask.view(bs, n_nodes, 1) * (1 - torch.eye(n_nodes))
+    x = remove_mean_with_mask(torch.randn(bs, n_nodes, 3, generator=generator) * node_mask, node_mask)
+    h = torch.randn(bs, n_nodes, 2, generator=generator) * node_mask
+    t = torch.rand(bs, 1, generator=generator)
+    return t, torch.cat([x, h], dim=2), node_mask, edge_mask.view(-1, 1)
+
+
+@pytest.mark.parametrize('edge_tile_size', [None, 7])
+def test_packed_dynamics_match_dense(registry, monkeypatch, edge_tile_size):
+    torch.manual_seed(0)
+    dynamics = EGNN_dynamics_QM9(3, 0, 3, hidden_nf=16, n_layers=2, attention=True, tanh=True, norm_constant=1,
+                                 inv_sublayers=1, normalization_factor=1)
+    t, xh, node_mask, edge_mask = dynamics_inputs()
+
+    expected = dynamics._forward(t, xh, node_mask, edge_mask, None)
+    monkeypatch.setitem(registry, 'packed_graph', True)
+    monkeypatch.setitem(registry, 'edge_tile_size', edge_tile_size)
+    result = dynamics._forward(t, xh, node_mask, edge_mask, None)
+
+    assert torch.allclose(result, expected, atol=1e-5)
@@ -0,0 +1,39 @@
+import threading
+
+import pytest
+import torch
+
+from build_geom_dataset import DevicePrefetcher
+
+
+def batches(n):
+    return [{'positions': torch.full((2, 3), float(i)), 'meta': {'i': torch.tensor(i)}} for i in range(n)]
+
+
+def test_prefetcher_yields_the_loader_batches():
+    loader = batches(7)
+    result = list(DevicePrefetcher(loader, 'cpu', depth=2))
+    assert len(result) == 7
+    assert all(torch.equal(a['positions'], b['positions']) and a['meta']['i'] == b['meta']['i']
+               for a, b in zip(result, loader))
+
+
+def test_prefetcher_early_stop_joins_the_producer():
+    n_threads = threading.active_count()
+    for i, _ in enumerate(DevicePrefetcher(batches(100), 'cpu', depth=2)):
+        if i == 3:
+            break
+    assert threading.active_count() == n_threads
+
+
+def test_prefetcher_reraises_loader_errors():
+    def loader():
+        yield from batches(2)
+        raise RuntimeError('broken batch')
+
+    class Loader(object):
+        def __iter__(self):
+            return loader()
+
+    with pytest.raises(RuntimeError, match='broken batch'):
+        list(DevicePrefetcher(Loader(), 'cpu'))
@@ -0,0 +1,137 @@
+import pytest
+import torch
+
+from global_registry import PARAM_REGISTRY
+from egnn.models import EGNN_dynamics_QM9
+from equivariant_diffusion.en_diffusion import EnVariationalDiffusion
+
+T = 20
+
+
+@pytest.fixture(scope='module')
+def model():
+    PARAM_REGISTRY.set('device_', 'cpu')
+    PARAM_REGISTRY.set('mixed_precision_training', False)
+    torch.manual_seed(0)
+    dynamics = EGNN_dynamics_QM9(3, 0, 3, hidden_nf=16, n_layers=2, attention=True, tanh=True, norm_constant=1,
+                                 inv_sublayers=1, normalization_factor=1)
+    return EnVariationalDiffusion(dynamics, in_node_nf=2, n_dims=3, timesteps=T, noise_schedule='polynomial_2',
+                                  loss_type='l2', include_charges=True).eval()
+
+
+@pytest.fixture(scope='module')
+def masks():
+    bs, n_nodes = 3, 5
+    node_mask = torch.ones(bs, n_nodes, 1)
+    node_mask[0, 3:], node_mask[1, 4:] = 0, 0
+    edge_mask = node_mask.view(bs, 1, n_nodes) * node_mask.view(bs, n_nodes, 1) * (1 - torch.eye(n_nodes))
+    return bs, n_nodes, node_mask, edge_mask.view(-1, 1)
+
+
+def draw(model, masks, seed=1, **kwargs):
+    bs, n_nodes, node_mask, edge_mask = masks
+    torch.manual_seed(seed)
+    x, h = model.sample(bs, n_nodes, node_mask, edge_mask, None, **kwargs)
+    return torch.cat([x, h['categorical'].float(), h['integer'].float()], dim=2)
+
+
+def test_sampling_eta(model):
+    for num_sampling_steps in [None, T, 2 * T]:
+        assert model.get_sampling_eta(num_sampling_steps) is None
+        assert model.get_sampling_eta(num_sampling_steps, 1.) is None
+        with pytest.raises(ValueError):
+            model.get_sampling_eta(num_sampling_steps, 0.)
+    assert model.get_sampling_eta(T // 2) == 0.
+    assert model.get_sampling_eta(T // 2, 0.5) == 0.5
+
+
+def test_full_length_sampling_is_ancestral(model, masks):
+    expected = draw(model, masks)
+    assert torch.equal(draw(model, masks, num_sampling_steps=T), expected)
+    assert torch.equal(draw(model, masks, num_sampling_steps=T, eta=1.), expected)
+
+
+def reference_sample(model, masks, seed=1, num_sampling_steps=None, eta=None, fix_noise=False):
+    """sample() through the original per-step path: schedule and coefficients recomputed, zs allocated every step."""
+    bs, n_nodes, node_mask, edge_mask = masks
+    torch.manual_seed(seed)
+    z = model.sample_combined_position_feature_noise(1 if fix_noise else bs, n_nodes, node_mask)
+    timesteps = model.get_sampling_timesteps(num_sampling_steps)
+    eta = model.get_sampling_eta(num_sampling_steps, eta)
+    for i in reversed(range(len(timesteps) - 1)):
+        s_array = torch.full((bs, 1), timesteps[i] / model.T)
+        t_array = torch.full((bs, 1), timesteps[i + 1] / model.T)
+        z = model.sample_p_zs_given_zt(s_array, t_array, z, node_mask, edge_mask, None, fix_noise=fix_noise, eta=eta)
+    x, h = model.sample_p_xh_given_z0(z, node_mask, edge_mask, None, fix_noise=fix_noise)
+    return torch.cat([x, h['categorical'].float(), h['integer'].float()], dim=2)
+
+
+@pytest.mark.parametrize('num_sampling_steps,eta,fix_noise', [
+    (None, None, False),   # ancestral
+    (None, None, True),    # ancestral, noise shared over the batch
+    (T // 4, 0., False),   # deterministic DDIM
+    (T // 4, 0.5, False),  # stochastic DDIM
+])
+def test_workspace_matches_allocating_path(model, masks, num_sampling_steps, eta, fix_noise):
+    expected = reference_sample(model, masks, num_sampling_steps=num_sampling_steps, eta=eta, fix_noise=fix_noise)
+    result = draw(model, masks, num_sampling_steps=num_sampling_steps, eta=eta, fix_noise=fix_noise)
+    assert torch.allclose(result, expected, atol=1e-5)
+
+
+def test_ddim_eta_one_matches_ancestral_coefficients(model):
+    timesteps = torch.arange(T + 1, dtype=torch.float64) / T
+    gamma = model.gamma(timesteps.view(-1, 1)).double()
+    for stride in [1, 3]:
+        gamma_s, gamma_t = gamma[:-stride], gamma[stride:]
+        ancestral = model.get_step_coefficients(gamma_s, gamma_t)
+        ddim = model.get_step_coefficients(gamma_s, gamma_t, eta=1.)
+        for key in ['mu_zt', 'mu_eps', 'sigma']:
+            torch.testing.assert_close(ddim[key], ancestral[key])
+
+
+def test_dpm_solver_first_order_is_ddim(model, masks):
+    bs, n_nodes, node_mask, edge_mask = masks
+    torch.manual_seed(1)
+    z = model.sample_combined_position_feature_noise(bs, n_nodes, node_mask)
+    num_sampling_steps = T // 4
+
+    def eps_fn(zt, t):
+        return model.phi(zt, t, node_mask, edge_mask, None)
+
+    with torch.no_grad():
+        expected = z
+        timesteps = model.get_sampling_timesteps(num_sampling_steps)
+        for i in reversed(range(len(timesteps) - 1)):
+            s_array = torch.full((bs, 1), timesteps[i] / model.T)
+            t_array = torch.full((bs, 1), timesteps[i + 1] / model.T)
+            expected = model.sample_p_zs_given_zt(s_array, t_array, expected, node_mask, edge_mask, None, eta=0.)
+        result = model.sample_dpm_solver(z, eps_fn, bs, node_mask, num_sampling_steps, order=1)
+    assert torch.allclose(result, expected, atol=1e-5)
+
+
+def test_dpm_solver_orders_converge(model, masks):
+    """Gaussian data N(0, c^2): eps is analytic and the probability-flow ODE is z_t ~ sqrt(alpha_t^2 c^2 + sigma_t^2)."""
+    bs, n_nodes, node_mask, _ = masks
+    fine = EnVariationalDiffusion(model.dynamics, in_node_nf=2, n_dims=3, timesteps=1000,
+                                  noise_schedule='polynomial_2', loss_type='l2', include_charges=True)
+    c = 0.5
+
+    def eps_fn(zt, t):
+        gamma = fine.gamma(t).view(-1, 1, 1)
+        alpha, sigma = fine.alpha(gamma, gamma), fine.sigma(gamma, gamma)
+        return sigma * zt / (alpha ** 2 * c ** 2 + sigma ** 2) * node_mask
+
+    torch.manual_seed(1)
+    z = fine.sample_combined_position_feature_noise(bs, n_nodes, node_mask)
+    gamma = fine.gamma(torch.tensor([[0.], [1.]]))
+    alpha, sigma = fine.alpha(gamma, gamma), fine.sigma(gamma, gamma)
+    exact = z * torch.sqrt((alpha[0] ** 2 * c ** 2 + sigma[0] ** 2) / (alpha[1] ** 2 * c ** 2 + sigma[1] ** 2))
+
+    errors = {(num_sampling_steps, order): (fine.sample_dpm_solver(z, eps_fn, bs, node_mask, num_sampling_steps, order)
+                                            - exact).abs().max().item()
+              for num_sampling_steps in [10, 40] for order in [1, 2, 3]}
+    for num_sampling_steps in [10, 40]:
+        assert errors[num_sampling_steps, 2] < errors[num_sampling_steps, 1]
+        assert errors[num_sampling_steps, 3] < errors[num_sampling_steps, 1]
+    for order in [1, 2, 3]:
+        assert errors[40, order] < errors[10, order]
@@ -0,0 +1,90 @@
+import pytest
+import torch
+
+from egnn.egnn_new import EdgeIndex, get_edge_index, pack_nodes, pack_edges, segment_lengths, \
+    unsorted_segment_sum, tiled_segment_sum
+
+
+def scatter_reference(data, segment_ids, num_segments, normalization_factor, aggregation_method):
+    """The original scatter_add_ implementation, in float32."""
+    data = data.float()
+    result = data.new_zeros((num_segments, data.size(1)))
+    result.scatter_add_(0, segment_ids.unsqueeze(-1).expand(-1, data.size(1)), data)
+    if aggregation_method == 'sum':
+        result = result / normalization_factor
+    if aggregation_method == 'mean':
+        norm = data.new_zeros(result.shape).scatter_add_(0, segment_ids.unsqueeze(-1).expand(-1, data.size(1)),
+                                                          data.new_ones(data.shape))
+        result = result / norm.clamp(min=1)
+    return result
+
+
+def sparse_segments(seed=0, num_segments=12, width=5):
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(0, 5, (num_segments,), generator=generator)
+    lengths[[0, 5, -1]] = 0  # empty segments, including the first and the last
+    segment_ids = torch.repeat_interleave(torch.arange(num_segments), lengths)
+    data = torch.randn(segment_ids.numel(), width, generator=generator)
+    return data, segment_ids, lengths
+
+
+TOLERANCE = {torch.float32: 1e-6, torch.float16: 1e-2, torch.bfloat16: 5e-2}
+
+
+@pytest.mark.parametrize('aggregation_method', ['sum', 'mean'])
+@pytest.mark.parametrize('dtype', [torch.float32, torch.float16, torch.bfloat16])
+def test_sparse_lengths_match_scatter(aggregation_method, dtype):
+    data, segment_ids, lengths = sparse_segments()
+    data = data.to(dtype)
+    expected = scatter_reference(data, segment_ids, len(lengths), 3., aggregation_method)
+    result = unsorted_segment_sum(data, segment_ids, len(lengths), 3., aggregation_method, lengths=lengths)
+    assert result.dtype == dtype
+    torch.testing.assert_close(result.float(), expected, rtol=TOLERANCE[dtype], atol=TOLERANCE[dtype])
+    assert torch.all(result[lengths == 0] == 0)
+
+
+@pytest.mark.parametrize('aggregation_method', ['sum', 'mean'])
+def test_dense_degree_matches_scatter(aggregation_method):
+    row, col = get_edge_index(4, 3, 2, 'cpu')
+    data = torch.randn(row.numel(), 6)
+    lengths, degree = segment_lengths(get_edge_index(4, 3, 2, 'cpu'))
+    assert degree == 3
+    expected = scatter_reference(data, row, 8, 2., aggregation_method)
+    result = unsorted_segment_sum(data, row, 8, 2., aggregation_method, lengths=lengths, degree=degree)
+    torch.testing.assert_close(result, expected)
+
+
+@pytest.mark.parametrize('aggregation_method', ['sum', 'mean'])
+def test_sparse_lengths_under_autocast(aggregation_method):
+    data, segment_ids, lengths = sparse_segments(seed=1, width=8)
+    linear = torch.nn.Linear(8, 8)
+    with torch.autocast(device_type='cpu', dtype=torch.bfloat16):
+        messages = linear(data)
+        result = unsorted_segment_sum(messages, segment_ids, len(lengths), 1., aggregation_method, lengths=lengths)
+    expected = scatter_reference(messages, segment_ids, len(lengths), 1., aggregation_method)
+    torch.testing.assert_close(result.float(), expected, rtol=5e-2, atol=5e-2)
+
+
+@pytest.mark.parametrize('aggregation_method', ['sum', 'mean'])
+def test_tiled_lengths_match_scatter(aggregation_method):
+    data, segment_ids, lengths = sparse_segments(seed=2)
+    expected = scatter_reference(data, segment_ids, len(lengths), 1., aggregation_method)
+    result = tiled_segment_sum(lambda start, end: data[start:end], segment_ids, len(lengths), 4, 1.,
+                               aggregation_method, lengths=lengths)
+    torch.testing.assert_close(result, expected)
+
+
+def test_pack_edges_lengths():
+    node_mask = torch.tensor([[1, 1, 1, 0], [1, 1, 0, 0]], dtype=torch.float32)
+    edge_mask = node_mask.unsqueeze(1) * node_mask.unsqueeze(2) * (1 - torch.eye(4)).unsqueeze(0)
+    node_mask, edge_mask = node_mask.view(-1, 1), edge_mask.view(-1, 1)
+
+    padded = pack_edges(edge_mask, 4, 4)
+    assert isinstance(padded, EdgeIndex)
+    assert torch.equal(padded.lengths, torch.bincount(padded[0], minlength=8))
+
+    packed = pack_nodes(node_mask)
+    row, col = edges = pack_edges(edge_mask, 4, 4, packed, packed)
+    assert torch.equal(edges.lengths, torch.tensor([2, 2, 2, 1, 1]))
+    assert torch.equal(edges.lengths, torch.bincount(row, minlength=5))
+    assert torch.all(row[1:] >= row[:-1])
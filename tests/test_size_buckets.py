@@ -0,0 +1,20 @@
+import pytest
+import torch
+
+sampling = pytest.importorskip('qm9.sampling')
+
+
+def test_size_buckets_cut_at_size_boundaries():
+    nodesxsample = torch.tensor([12, 5, 12, 7, 30, 5, 12, 12, 9, 30, 7, 12])
+    buckets = sampling.get_size_buckets(nodesxsample, n_buckets=3)
+    assert 1 <= len(buckets) <= 3
+    assert sorted(torch.cat(buckets).tolist()) == list(range(len(nodesxsample)))
+    for bucket, next_bucket in zip(buckets[:-1], buckets[1:]):
+        assert nodesxsample[bucket].max() < nodesxsample[next_bucket].min()
+
+
+def test_size_buckets_default_is_one_batch():
+    nodesxsample = torch.tensor([12, 5, 7, 30])
+    buckets = sampling.get_size_buckets(nodesxsample)
+    assert len(buckets) == 1 and sorted(buckets[0].tolist()) == [0, 1, 2, 3]
+    assert len(sampling.get_size_buckets(torch.full((6,), 9), n_buckets=4)) == 1
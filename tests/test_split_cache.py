@@ -0,0 +1,40 @@
+import json
+import os
+
+import numpy as np
+
+from build_geom_dataset import ArrayMolecules, data_fingerprint, load_split_cache, save_split_cache
+
+
+def test_data_fingerprint_hashes_full_content(tmp_path):
+    path = str(tmp_path / 'data.npy')
+    data = np.random.default_rng(0).random((1 << 17, 5))
+    np.save(path, data)
+    fingerprint = data_fingerprint(path)
+    with open(f'{path}.sha256.json') as f:
+        assert json.load(f)['.']['size'] == os.path.getsize(path)
+    assert data_fingerprint(path) == fingerprint  # sidecar hit
+
+    # a change anywhere in the file (same size) changes the fingerprint once the sidecar is stale
+    data[len(data) // 3, 2] += 1.
+    np.save(path, data)
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+    assert data_fingerprint(path) != fingerprint
+
+
+def test_split_cache_memory_maps_the_data(tmp_path):
+    rng = np.random.default_rng(0)
+    data = np.concatenate([np.repeat(np.arange(6), 4)[:, None], rng.random((24, 4))], axis=1)
+    npy_path, npz_path = str(tmp_path / 'data.npy'), str(tmp_path / 'data.npz')
+    np.save(npy_path, data)
+    np.savez_compressed(npz_path, ligand=data)
+
+    for conformation_file, name in [(npy_path, None), (npz_path, 'ligand')]:
+        view = ArrayMolecules(data, name=name)
+        splits = (view.take([0, 2, 4]), view.take([1]), view.take([3, 5]))
+        cache_path = str(tmp_path / f'cache_{name}')
+        save_split_cache(cache_path, conformation_file, splits, {})
+        loaded = load_split_cache(cache_path, conformation_file)
+        for split, loaded_split in zip(splits, loaded):
+            assert isinstance(loaded_split.data, np.memmap)
+            assert all(np.array_equal(a, b) for a, b in zip(split, loaded_split))
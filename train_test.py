@@ -10,6 +10,7 @@ from tqdm import tqdm
 import matplotlib.pyplot as plt
 
 import utils
+import build_geom_dataset
 from qm9 import losses
 import qm9.visualizer as vis
 import qm9.utils as qm9utils
@@ -17,7 +18,7 @@ from qm9.analyze import compute_molecule_metrics, compute_qvina2_score
 from qm9.sampling import sample_chain, sample, sample_sweep_conditional, sample_controlnet
 
 from equivariant_diffusion.utils import assert_mean_zero_with_mask, remove_mean_with_mask,\
-    assert_correctly_masked, sample_center_gravity_zero_gaussian_with_mask
+    assert_correctly_masked, sample_center_gravity_zero_gaussian_with_mask, checks_step
 
 from global_registry import PARAM_REGISTRY
 
@@ -30,12 +31,19 @@ def train_epoch_controlnet(args, loader, loader_vis_activations, epoch, model, m
     model.train()
     nll_epoch = []
     n_iterations = len(loader)
+    edge_budget_accumulator = utils.EdgeBudgetAccumulator(args.molecules_per_step) if args.edge_budget is not None else None
     optim.zero_grad()
     training_mode = PARAM_REGISTRY.get('training_mode')
     loss_analysis = PARAM_REGISTRY.get('loss_analysis')
     loss_analysis_modes = PARAM_REGISTRY.get('loss_analysis_modes')
+    if epoch == args.start_epoch and getattr(loader.dataset, 'pocket_latent_cache', None) is not None:
+        # cached pocket latents stand in for the pocket encoder, they must come from its current weights
+        loader.dataset.pocket_latent_cache.check_checkpoint(model.pocket_vae)
+    if args.prefetch_to_device:
+        loader = build_geom_dataset.DevicePrefetcher(loader, device)
     
     for i, data in enumerate(loader):
+        checks_step('training')
         lg_x = data['ligand']['positions'].to(device, dtype)
         lg_node_mask = data['ligand']['atom_mask'].to(device, dtype).unsqueeze(2)
         lg_edge_mask = data['ligand']['edge_mask'].to(device, dtype)
@@ -47,6 +55,8 @@ def train_epoch_controlnet(args, loader, loader_vis_activations, epoch, model, m
         pkt_edge_mask = data['pocket']['edge_mask'].to(device, dtype)
         pkt_one_hot = data['pocket']['one_hot'].to(device, dtype)
         pkt_charges = (data['pocket']['charges'] if args.include_charges else torch.zeros(0)).to(device, dtype)
+        # pocket latent cache (frozen pocket encoder), see latent_cache.py
+        pkt_z_xh_mean = data['pocket']['latent'].to(device, dtype) if 'latent' in data['pocket'] else None
 
         joint_edge_mask = data['joint_edge_mask'].to(device, dtype)
         
@@ -63,9 +73,17 @@ def train_epoch_controlnet(args, loader, loader_vis_activations, epoch, model, m
         lg_x = remove_mean_with_mask(lg_x, lg_node_mask)
         pkt_x = remove_mean_with_mask(pkt_x, pkt_node_mask)
         
-        if args.data_augmentation:
+        # fused_augmentation: already rotated in the DataLoader workers, see build_geom_dataset.AugmentingCollate
+        if args.data_augmentation and not args.fused_augmentation:
             lg_x = utils.random_rotation(lg_x).detach()
-            pkt_x = utils.random_rotation(pkt_x).detach()
+            if pkt_z_xh_mean is None:
+                pkt_x = utils.random_rotation(pkt_x).detach()
+            else:
+                # rotate the cached pocket latent positions with the same rotation as pkt_x
+                pkt_n_nodes = pkt_x.size(1)
+                pkt_x_rot = utils.random_rotation(torch.cat([pkt_x, pkt_z_xh_mean[:, :, :3]], dim=1)).detach()
+                pkt_x = pkt_x_rot[:, :pkt_n_nodes]
+                pkt_z_xh_mean = torch.cat([pkt_x_rot[:, pkt_n_nodes:], pkt_z_xh_mean[:, :, 3:]], dim=2)
 
         check_mask_correct([lg_x, lg_one_hot, lg_charges], lg_node_mask)
         check_mask_correct([pkt_x, pkt_one_hot, pkt_charges], pkt_node_mask)
@@ -97,7 +115,8 @@ def train_epoch_controlnet(args, loader, loader_vis_activations, epoch, model, m
             lg_edge_mask=lg_edge_mask,
             pkt_edge_mask=pkt_edge_mask,
             joint_edge_mask=joint_edge_mask,
-            context=context
+            context=context,
+            pkt_z_xh_mean=pkt_z_xh_mean
         )
 
         # standard nll from forward KL
@@ -119,7 +138,10 @@ def train_epoch_controlnet(args, loader, loader_vis_activations, epoch, model, m
                 loss = loss + grad_norm_gp
 
         # gradient accumulation loss scaling
-        if args.grad_accumulation_steps > 0:
+        if edge_budget_accumulator is not None:
+            # variable batch sizes: weigh each batch mean by its no. molecules
+            loss = edge_budget_accumulator.scale_loss(loss, lg_x.size(0))
+        elif args.grad_accumulation_steps > 0:
             loss = loss / int(args.grad_accumulation_steps)
 
         # ~!mp
@@ -137,7 +159,14 @@ def train_epoch_controlnet(args, loader, loader_vis_activations, epoch, model, m
         grad_norm = 0.
 
         # ~!mp
-        if ((i+1) % args.grad_accumulation_steps == 0) or ((i+1) == len(loader)) or args.break_train_epoch:
+        if edge_budget_accumulator is not None:
+            take_step = edge_budget_accumulator.step_ready()
+        else:
+            take_step = (i+1) % args.grad_accumulation_steps == 0
+        # n_iterations: len(loader) draws the next epoch of an EdgeBudgetBatchSampler
+        if take_step or ((i+1) == n_iterations) or args.break_train_epoch:
+            if edge_budget_accumulator is not None:
+                edge_budget_accumulator.renormalize_grads(model)  # before clipping
             if args.clip_grad:
                 grad_norm = utils.gradient_clipping(model, gradnorm_queue)
             
@@ -205,17 +234,26 @@ def train_epoch(args, loader, loader_vis_activations, epoch, model, model_dp, mo
     model.train()
     nll_epoch = []
     n_iterations = len(loader)
+    edge_budget_accumulator = utils.EdgeBudgetAccumulator(args.molecules_per_step) if args.edge_budget is not None else None
     optim.zero_grad()
     training_mode = PARAM_REGISTRY.get('training_mode')
     loss_analysis = PARAM_REGISTRY.get('loss_analysis')
     loss_analysis_modes = PARAM_REGISTRY.get('loss_analysis_modes')
+    if epoch == args.start_epoch and getattr(loader.dataset, 'latent_cache', None) is not None:
+        # cached latents stand in for the encoder, they must come from its current weights
+        loader.dataset.latent_cache.check_checkpoint(model.vae)
+    if args.prefetch_to_device:
+        loader = build_geom_dataset.DevicePrefetcher(loader, device)
     
     for i, data in enumerate(loader):
+        checks_step('training')
         x = data['positions'].to(device, dtype)
         node_mask = data['atom_mask'].to(device, dtype).unsqueeze(2)
         edge_mask = data['edge_mask'].to(device, dtype)
         one_hot = data['one_hot'].to(device, dtype)
         charges = (data['charges'] if args.include_charges else torch.zeros(0)).to(device, dtype)
+        # offline VAE latent cache (frozen encoder), see latent_cache.py
+        z_xh_mean = data['latent'].to(device, dtype) if 'latent' in data else None
         
         x = remove_mean_with_mask(x, node_mask)
 
@@ -226,8 +264,16 @@ def train_epoch(args, loader, loader_vis_activations, epoch, model, model_dp, mo
             # x = x + eps * args.augment_noise
 
         x = remove_mean_with_mask(x, node_mask)
-        if args.data_augmentation:
-            x = utils.random_rotation(x).detach()
+        # fused_augmentation: already rotated in the DataLoader workers, see build_geom_dataset.AugmentingCollate
+        if args.data_augmentation and not args.fused_augmentation:
+            if z_xh_mean is None:
+                x = utils.random_rotation(x).detach()
+            else:
+                # the encoder is E(n) equivariant: rotate the cached latent positions with the same rotation as x
+                n_nodes = x.size(1)
+                x_rot = utils.random_rotation(torch.cat([x, z_xh_mean[:, :, :3]], dim=1)).detach()
+                x = x_rot[:, :n_nodes]
+                z_xh_mean = torch.cat([x_rot[:, n_nodes:], z_xh_mean[:, :, 3:]], dim=2)
 
         check_mask_correct([x, one_hot, charges], node_mask)
         assert_mean_zero_with_mask(x, node_mask)
@@ -246,10 +292,12 @@ def train_epoch(args, loader, loader_vis_activations, epoch, model, model_dp, mo
         # transform batch through flow
         if (training_mode in loss_analysis_modes) and loss_analysis:
             nll, reg_term, mean_abs_z, loss_dict = losses.compute_loss_and_nll(args, model_dp, nodes_dist,
-                                                                    x, h, node_mask, edge_mask, context, loss_analysis)
+                                                                    x, h, node_mask, edge_mask, context, loss_analysis,
+                                                                    z_xh_mean=z_xh_mean)
         else:
             nll, reg_term, mean_abs_z = losses.compute_loss_and_nll(args, model_dp, nodes_dist,
-                                                                    x, h, node_mask, edge_mask, context)
+                                                                    x, h, node_mask, edge_mask, context,
+                                                                    z_xh_mean=z_xh_mean)
         # standard nll from forward KL
         loss = nll + args.ode_regularization * reg_term
 
@@ -269,7 +317,10 @@ def train_epoch(args, loader, loader_vis_activations, epoch, model, model_dp, mo
                 loss = loss + grad_norm_gp
 
         # gradient accumulation loss scaling
-        if args.grad_accumulation_steps > 0:
+        if edge_budget_accumulator is not None:
+            # variable batch sizes: weigh each batch mean by its no. molecules
+            loss = edge_budget_accumulator.scale_loss(loss, x.size(0))
+        elif args.grad_accumulation_steps > 0:
             loss = loss / int(args.grad_accumulation_steps)
 
         # ~!mp
@@ -288,7 +339,14 @@ def train_epoch(args, loader, loader_vis_activations, epoch, model, model_dp, mo
         grad_norm = 0.
 
         # ~!mp
-        if ((i+1) % args.grad_accumulation_steps == 0) or ((i+1) == len(loader)) or args.break_train_epoch:
+        if edge_budget_accumulator is not None:
+            take_step = edge_budget_accumulator.step_ready()
+        else:
+            take_step = (i+1) % args.grad_accumulation_steps == 0
+        # n_iterations: len(loader) draws the next epoch of an EdgeBudgetBatchSampler
+        if take_step or ((i+1) == n_iterations) or args.break_train_epoch:
+            if edge_budget_accumulator is not None:
+                edge_budget_accumulator.renormalize_grads(model)  # before clipping
             if args.clip_grad:
                 grad_norm = utils.gradient_clipping(model, gradnorm_queue)
             
@@ -517,12 +575,14 @@ def test(args, loader, epoch, eval_model, device, dtype, property_norms, nodes_d
         n_iterations = len(loader)
 
         for i, data in enumerate(loader):
+            checks_step('eval')
             x = data['positions'].to(device, dtype)
             batch_size = x.size(0)
             node_mask = data['atom_mask'].to(device, dtype).unsqueeze(2)
             edge_mask = data['edge_mask'].to(device, dtype)
             one_hot = data['one_hot'].to(device, dtype)
             charges = (data['charges'] if args.include_charges else torch.zeros(0)).to(device, dtype)
+            z_xh_mean = data['latent'].to(device, dtype) if 'latent' in data else None
 
             if args.augment_noise > 0:
                 raise NotImplementedError()
@@ -547,10 +607,12 @@ def test(args, loader, epoch, eval_model, device, dtype, property_norms, nodes_d
             # transform batch through flow
             if (training_mode in loss_analysis_modes) and loss_analysis:
                 nll, _, _, loss_dict = losses.compute_loss_and_nll(args, eval_model, nodes_dist, x, h,
-                                                                   node_mask, edge_mask, context, loss_analysis)
+                                                                   node_mask, edge_mask, context, loss_analysis,
+                                                                   z_xh_mean=z_xh_mean)
             else:
                 nll, _, _ = losses.compute_loss_and_nll(args, eval_model, nodes_dist, x, h,
-                                                        node_mask, edge_mask, context)
+                                                        node_mask, edge_mask, context,
+                                                        z_xh_mean=z_xh_mean)
             # standard nll from forward KL
 
             nll_epoch += (nll.item() * batch_size)
@@ -611,6 +673,7 @@ def test_controlnet(args, loader, epoch, eval_model, device, dtype, property_nor
         n_iterations = len(loader)
 
         for i, data in enumerate(loader):
+            checks_step('eval')
             lg_x = data['ligand']['positions'].to(device, dtype)
             lg_batch_size = lg_x.size(0)
             lg_node_mask = data['ligand']['atom_mask'].to(device, dtype).unsqueeze(2)
@@ -624,6 +687,7 @@ def test_controlnet(args, loader, epoch, eval_model, device, dtype, property_nor
             pkt_edge_mask = data['pocket']['edge_mask'].to(device, dtype)
             pkt_one_hot = data['pocket']['one_hot'].to(device, dtype)
             pkt_charges = (data['pocket']['charges'] if args.include_charges else torch.zeros(0)).to(device, dtype)
+            pkt_z_xh_mean = data['pocket']['latent'].to(device, dtype) if 'latent' in data['pocket'] else None
 
             joint_edge_mask = data['joint_edge_mask'].to(device, dtype)
 
@@ -666,7 +730,8 @@ def test_controlnet(args, loader, epoch, eval_model, device, dtype, property_nor
                 lg_edge_mask=lg_edge_mask,
                 pkt_edge_mask=pkt_edge_mask,
                 joint_edge_mask=joint_edge_mask,
-                context=context
+                context=context,
+                pkt_z_xh_mean=pkt_z_xh_mean
             )
 
             # standard nll from forward KL
@@ -691,7 +756,8 @@ def save_and_sample_chain(model, args, device, dataset_info, prop_dist,
                           epoch=0, id_from=0, batch_id=''):
     # ~!mp
     one_hot, charges, x = sample_chain(args=args, device=device, flow=model,
-                                    n_tries=1, dataset_info=dataset_info, prop_dist=prop_dist)
+                                    n_tries=1, dataset_info=dataset_info, prop_dist=prop_dist,
+                                    num_sampling_steps=args.num_sampling_steps, eta=args.sampling_eta)
 
     vis.save_xyz_file(f'outputs/{args.exp_name}/epoch_{epoch}_{batch_id}/chain/',
                       one_hot, charges, x, dataset_info, id_from, name='chain')
@@ -721,6 +787,9 @@ def sample_different_sizes_and_save(model, nodes_dist, args, device, dataset_inf
 def analyze_and_save(epoch, model_sample, nodes_dist, args, device, dataset_info, prop_dist,
                      n_samples=1000, batch_size=100):
     print(f'Analyzing molecule stability at epoch {epoch}...')
+    max_batch_size = batch_size  # upper bound on a sampling batch
+    if args.edge_budget is not None:
+        batch_size = n_samples  # sampling batches are cut by the edge budget, at most max_batch_size molecules each
     batch_size = min(batch_size, n_samples)
     assert n_samples % batch_size == 0
     molecules = {'one_hot': [], 'x': [], 'node_mask': []}
@@ -729,7 +798,11 @@ def analyze_and_save(epoch, model_sample, nodes_dist, args, device, dataset_info
         
         # ~!mp
         one_hot, charges, x, node_mask = sample(args, device, model_sample, dataset_info, prop_dist,
-                                                nodesxsample=nodesxsample)
+                                                nodesxsample=nodesxsample,
+                                                num_sampling_steps=args.num_sampling_steps, eta=args.sampling_eta,
+                                                solver=args.sampling_solver, solver_order=args.sampling_solver_order,
+                                                n_buckets=args.sampling_n_buckets, max_edges=args.edge_budget,
+                                                max_batch_size=max_batch_size)
 
         molecules['one_hot'].append(one_hot.detach().cpu())
         molecules['x'].append(x.detach().cpu())
@@ -767,6 +840,9 @@ def analyze_and_save_controlnet(epoch, model_sample, nodes_dist, args, device, d
                                 n_samples=1000, batch_size=100, pair_dict_list=[], pair_dict_list_ids=[],
                                 output_dir=""):
     print(f'Analyzing molecule stability at epoch {epoch}...')
+    max_batch_size = batch_size  # upper bound on a sampling batch
+    if args.edge_budget is not None:
+        batch_size = n_samples  # sampling batches are cut by the edge budget, at most max_batch_size molecules each
     batch_size = min(batch_size, n_samples)
     assert len(pair_dict_list) == n_samples
     assert n_samples % batch_size == 0
@@ -783,7 +859,11 @@ def analyze_and_save_controlnet(epoch, model_sample, nodes_dist, args, device, d
 
         # ~!mp
         one_hot, charges, x, node_mask = sample_controlnet(args, device, model_sample, dataset_info,
-                                                nodesxsample=nodesxsample, context=None, fix_noise=False, pocket_dict_list=pocket_dict_list)
+                                                nodesxsample=nodesxsample, context=None, fix_noise=False, pocket_dict_list=pocket_dict_list,
+                                                num_sampling_steps=args.num_sampling_steps, eta=args.sampling_eta,
+                                                solver=args.sampling_solver, solver_order=args.sampling_solver_order,
+                                                n_buckets=args.sampling_n_buckets, max_edges=args.edge_budget,
+                                                max_batch_size=max_batch_size)
 
         molecules['one_hot'].append(one_hot.detach().cpu())
         molecules['x'].append(x.detach().cpu())
@@ -6,6 +6,149 @@ from torch import nn
 from global_registry import PARAM_REGISTRY
 
 
+def add_missing_configs(args):
+    """
+    Default values of the config options shared by every entry point (training, evaluation,
+    deployment), for configs that predate them. add_missing_configs_controlnet() adds the
+    ControlNet / pocket ones on top.
+    """
+    # gradient accumulation
+    if not hasattr(args, 'grad_accumulation_steps'):
+        args.grad_accumulation_steps = 1  # call optim every step
+
+    # vae data mode
+    if not hasattr(args, 'vae_data_mode'):
+        args.vae_data_mode = 'all'
+
+    # vae encoder n layers
+    if not hasattr(args, 'encoder_n_layers'):
+        args.encoder_n_layers = 1
+
+    # grad prenalty
+    if not hasattr(args, 'grad_penalty'):
+        args.grad_penalty = False
+
+    # loss analysis
+    if not hasattr(args, 'loss_analysis'):
+        args.loss_analysis = False
+
+    # intermediate activations analysis usage
+    args.vis_activations_instances = (nn.Linear)
+    args.save_activations_path = 'vis_activations'
+    args.vis_activations_bins = 200
+    if not hasattr(args, 'vis_activations_specific_ylim'):
+        args.vis_activations_specific_ylim = [0, 40]
+    if not hasattr(args, 'vis_activations'):
+        args.vis_activations = False
+    if not hasattr(args, 'vis_activations_batch_samples'):
+        args.vis_activations_batch_samples = 0
+    if not hasattr(args, 'vis_activations_batch_size'):
+        args.vis_activations_batch_size = 1
+
+    # class-imbalance loss reweighting
+    if not hasattr(args, 'reweight_class_loss'):  # supported: "inv_class_freq"
+        args.reweight_class_loss = None
+    if not hasattr(args, 'reweight_coords_loss'):  # supported: "inv_class_freq"
+        args.reweight_coords_loss = None
+    if not hasattr(args, 'smoothing_factor'):  # smoothing: (0. - 1.]
+        args.smoothing_factor = None
+
+    # coordinates loss weighting
+    if not hasattr(args, 'error_x_weight'):
+        args.error_x_weight = None
+    # atom types loss weighting
+    if not hasattr(args, 'error_h_weight'):
+        args.error_h_weight = None
+
+    # scaling of coordinates/x
+    if not hasattr(args, 'vae_normalize_x'):
+        args.vae_normalize_x = False
+    if not hasattr(args, 'vae_normalize_method'):  # supported: "scale" | "linear"
+        args.vae_normalize_method = None
+    if not hasattr(args, 'vae_normalize_factors'):
+        args.vae_normalize_factors = [1, 1, 1]
+    if not hasattr(args, 'vae_normalize_fn_points'):  # [x_min, y_min, x_max, y_max]
+        args.vae_normalize_fn_points = None
+
+    # data splits
+    if not hasattr(args, 'data_splitted'):
+        args.data_splitted = False
+
+    # visualise sample chain
+    if not hasattr(args, 'visualize_sample_chain'):
+        args.visualize_sample_chain = False
+    if not hasattr(args, 'visualize_sample_chain_epochs'):
+        args.visualize_sample_chain_epochs = 1
+
+    # strided sampler (None: all T steps)
+    if not hasattr(args, 'num_sampling_steps'):
+        args.num_sampling_steps = None
+    if not hasattr(args, 'sampling_eta'):  # None: DDIM (0.) when strided, ancestral at full length | 0.: deterministic DDIM | 1.: ancestral
+        args.sampling_eta = None
+    if not hasattr(args, 'sampling_solver'):  # supported: "ddim" | "dpm_solver"
+        args.sampling_solver = 'ddim'
+    if not hasattr(args, 'sampling_solver_order'):  # dpm_solver: 2 | 3
+        args.sampling_solver_order = 2
+    if not hasattr(args, 'sampling_n_buckets'):  # group samples by no. atoms, pad to bucket max (1: off)
+        args.sampling_n_buckets = 1
+
+    # invariant checks in the sampling / EGNN hot paths: "always" | "sampled" (every checks_every steps) | "off"
+    if not hasattr(args, 'checks'):
+        args.checks = 'always'
+    if not hasattr(args, 'checks_every'):
+        args.checks_every = 1
+    # EGNN: first edge-MLP layer applied per node, then gathered per edge (configs loaded with a checkpoint default to off)
+    if not hasattr(args, 'factorized_edge_mlp'):
+        args.factorized_edge_mlp = True
+
+    # length-bucketed batches (similar no. atoms per batch), see build_geom_dataset.BucketBatchSampler
+    if not hasattr(args, 'bucket_batches'):
+        args.bucket_batches = False
+    if not hasattr(args, 'bucket_size_multiplier'):  # no. batches per sorted bucket
+        args.bucket_size_multiplier = 50
+    if not hasattr(args, 'bucket_jitter'):  # uniform size noise (no. atoms), mixes sizes up to ~3 atoms apart across epochs
+        args.bucket_jitter = 3.
+    # edge-budget batches: padded edges per batch (ControlNet: ligand + pocket + joint), batch_size caps the no. molecules,
+    # see build_geom_dataset.EdgeBudgetBatchSampler
+    if not hasattr(args, 'edge_budget'):
+        args.edge_budget = None
+    if not hasattr(args, 'molecules_per_step'):  # [edge_budget] optimizer step every molecules_per_step molecules
+        args.molecules_per_step = args.batch_size * max(1, int(args.grad_accumulation_steps))
+    # data pipeline: CPU batches from num_workers workers (pinned), centering + rotation fused per batch
+    # in the workers (fused_augmentation), host-to-device copies overlapped with compute (prefetch_to_device)
+    if not hasattr(args, 'num_workers'):
+        args.num_workers = 0
+    if not hasattr(args, 'pin_memory'):
+        args.pin_memory = False
+    if not hasattr(args, 'prefetch_factor'):
+        args.prefetch_factor = 2
+    if not hasattr(args, 'fused_augmentation'):
+        args.fused_augmentation = False
+    if not hasattr(args, 'prefetch_to_device'):
+        args.prefetch_to_device = False
+    # processed split cache: index arrays of the filtered, permuted splits, see build_geom_dataset.load_split_cache
+    if not hasattr(args, 'split_cache_dir'):
+        args.split_cache_dir = None
+
+    # [GEOM] conformer-aware epochs: at most conformers_per_molecule conformers per molecule per training epoch,
+    # molecules from the extract_conformers {save_file}_conformer_groups.npz (default: next to an extracted .npy data_file,
+    # required for a columnar data_file)
+    if not hasattr(args, 'conformers_per_molecule'):
+        args.conformers_per_molecule = None
+    if not hasattr(args, 'conformer_groups_file'):
+        args.conformer_groups_file = None
+    if not hasattr(args, 'conformer_weighting'):  # supported: None (uniform) | "boltzmann"
+        args.conformer_weighting = None
+
+    # offline VAE latent cache (LDM with a frozen encoder): {latent_cache_dir}/{split}_latents.npy
+    if not hasattr(args, 'latent_cache_dir'):
+        args.latent_cache_dir = None
+    if not hasattr(args, 'latent_cache_batch_size'):
+        args.latent_cache_batch_size = args.batch_size
+
+    return args
+
+
 def add_missing_configs_controlnet(args, dtype, ligand_dataset_info, pocket_dataset_info, ignore_mixed_precision=False):
 
     # mp autocast dtype
@@ -37,29 +180,18 @@ def add_missing_configs_controlnet(args, dtype, ligand_dataset_info, pocket_data
         args.pocket_vae.context_node_nf = 0
         args.pocket_vae.property_norms = 0
 
-    # gradient accumulation
-    if not hasattr(args, 'grad_accumulation_steps'):
-        args.grad_accumulation_steps = 1  # call optim every step
+    # options shared with the other entry points
+    args = add_missing_configs(args)
 
-    # vae data mode
-    if not hasattr(args, 'vae_data_mode'):
-        args.vae_data_mode = 'all'
+    # [Pocket VAE] vae data mode
     if not hasattr(args.pocket_vae, 'vae_data_mode'):
         args.pocket_vae.vae_data_mode = 'all'
 
-    # vae encoder n layers
-    if not hasattr(args, 'encoder_n_layers'):
-        args.encoder_n_layers = 1
+    # [Pocket VAE] vae encoder n layers
     if not hasattr(args.pocket_vae, 'encoder_n_layers'):
         args.pocket_vae.encoder_n_layers = 1
 
-    # grad prenalty
-    if not hasattr(args, 'grad_penalty'):
-        args.grad_penalty = False
-
     # loss analysis
-    if not hasattr(args, 'loss_analysis'):
-        args.loss_analysis = False
     args.loss_analysis_modes = ['VAE', 'LDM']
 
     # loss analysis usage
@@ -69,44 +201,7 @@ def add_missing_configs_controlnet(args, dtype, ligand_dataset_info, pocket_data
     args.pocket_vae.atom_encoder = pocket_dataset_info['atom_encoder']
     args.pocket_vae.atom_decoder = pocket_dataset_info['atom_decoder']
 
-    # intermediate activations analysis usage
-    args.vis_activations_instances = (nn.Linear)
-    args.save_activations_path = 'vis_activations'
-    args.vis_activations_bins = 200
-    if not hasattr(args, 'vis_activations_specific_ylim'):
-        args.vis_activations_specific_ylim = [0, 40]
-    if not hasattr(args, 'vis_activations'):
-        args.vis_activations = False
-    if not hasattr(args, 'vis_activations_batch_samples'):
-        args.vis_activations_batch_samples = 0
-    if not hasattr(args, 'vis_activations_batch_size'):
-        args.vis_activations_batch_size = 1
-
-    # data splits
-    if not hasattr(args, 'data_splitted'):
-        args.data_splitted = False
-
-    # visualise sample chain
-    if not hasattr(args, 'visualize_sample_chain'):
-        args.visualize_sample_chain = False
-    if not hasattr(args, 'visualize_sample_chain_epochs'):
-        args.visualize_sample_chain_epochs = 1
-
-    # [Ligand VAE] scaling of coordinates/x
-    if not hasattr(args, 'vae_normalize_x'):
-        args.vae_normalize_x = False
-    if not hasattr(args, 'vae_normalize_method'):  # supported: "scale" | "linear"
-        args.vae_normalize_method = None
-    if not hasattr(args, 'vae_normalize_factors'):
-        args.vae_normalize_factors = [1, 1, 1]
-
     # [Ligand VAE] class-imbalance loss reweighting
-    if not hasattr(args, 'reweight_class_loss'):  # supported: "inv_class_freq"
-        args.reweight_class_loss = None
-    if not hasattr(args, 'reweight_coords_loss'):  # supported: "inv_class_freq"
-        args.reweight_coords_loss = None
-    if not hasattr(args, 'smoothing_factor'):  # smoothing: (0. - 1.]
-        args.smoothing_factor = None
     if args.reweight_class_loss == "inv_class_freq":
         class_freq_dict = ligand_dataset_info['atom_types']
         sorted_keys = sorted(class_freq_dict.keys())
@@ -124,13 +219,6 @@ def add_missing_configs_controlnet(args, dtype, ligand_dataset_info, pocket_data
     else:
         args.class_weights = None
 
-    # [Ligand VAE] coordinates loss weighting
-    if not hasattr(args, 'error_x_weight'):
-        args.error_x_weight = None
-    # [Ligand VAE] atom types loss weighting
-    if not hasattr(args, 'error_h_weight'):
-        args.error_h_weight = None
-
     # [Pocket VAE] model
     if not hasattr(args.pocket_vae, 'model'):
         args.pocket_vae.model = "egnn_dynamics"
@@ -177,6 +265,20 @@ def add_missing_configs_controlnet(args, dtype, ligand_dataset_info, pocket_data
     if not hasattr(args, 'time_noisy'):
         args.time_noisy = False
 
+    # [ControlNet] neighbour graphs for pocket / fusion edges: full | knn | radius (radius in model coordinates)
+    if not hasattr(args, 'pocket_edges'):
+        args.pocket_edges = 'full'
+    if not hasattr(args, 'pocket_knn'):
+        args.pocket_knn = 16
+    if not hasattr(args, 'pocket_radius'):
+        args.pocket_radius = None
+    if not hasattr(args, 'fusion_edges'):
+        args.fusion_edges = 'full'
+    if not hasattr(args, 'fusion_knn'):
+        args.fusion_knn = 16
+    if not hasattr(args, 'fusion_radius'):
+        args.fusion_radius = None
+
 
     # [ControlNet] Qvina score computation
     if not hasattr(args, 'compute_qvina'):
@@ -204,6 +306,12 @@ def add_missing_configs_controlnet(args, dtype, ligand_dataset_info, pocket_data
     if not hasattr(args, 'pocket_remove_nonstd_resi'):
         args.pocket_remove_nonstd_resi = False
 
+    # [ControlNet] pocket latent cache (frozen pocket encoder), keyed by pair id: {pocket_latent_cache_dir}/pocket_latents.npy
+    if not hasattr(args, 'pocket_latent_cache_dir'):
+        args.pocket_latent_cache_dir = None
+    if not hasattr(args, 'pocket_latent_cache_batch_size'):
+        args.pocket_latent_cache_batch_size = args.batch_size
+
     # [Pocket VAE] trained on pockets' Alpha Carbon only
     if not hasattr(args.pocket_vae, 'ca_only'):
         args.pocket_vae.ca_only = False
@@ -311,7 +419,60 @@ def gradient_clipping(flow, gradnorm_queue):
     return grad_norm
 
 
+class EdgeBudgetAccumulator():
+    """
+    Gradient accumulation over variable-size (edge budget) batches. scale_loss weighs each batch
+    mean by its no. molecules, so that an optimizer step averages the loss over ~molecules_per_step
+    molecules. The last batch of a step overshoots molecules_per_step (and the epoch tail falls short
+    of it): renormalize_grads rescales the accumulated grads to a mean over the molecules actually seen.
+    """
+    def __init__(self, molecules_per_step):
+        self.molecules_per_step = molecules_per_step
+        self.n_molecules = 0  # molecules accumulated since the last optimizer step
+
+    def scale_loss(self, loss, n_molecules):
+        self.n_molecules += n_molecules
+        return loss * (n_molecules / self.molecules_per_step)
+
+    def step_ready(self):
+        return self.n_molecules >= self.molecules_per_step
+
+    def renormalize_grads(self, model):
+        """
+        Call once per optimizer step, BEFORE unscaling (GradScaler.unscale_) and gradient_clipping,
+        which must see the renormalized grads. model is the unwrapped module (model, not model_dp):
+        its parameters hold the accumulated grads.
+        """
+        n_molecules, self.n_molecules = self.n_molecules, 0
+        if n_molecules == 0:  # nothing accumulated since the last step
+            return
+        for p in model.parameters():
+            if p.grad is not None:
+                p.grad.mul_(self.molecules_per_step / n_molecules)
+
+
 # Rotation data augmntation
+def random_rotation_matrix(bs, device=None, dtype=torch.float32):
+    """
+    [bs, 3, 3] random rotations Rz @ Ry @ Rx (uniform angles about each axis), built in one
+    vectorized pass. random_rotation(x) == x @ R^T.
+    """
+    angle_range = np.pi * 2
+    theta = torch.stack([torch.rand(bs) for _ in range(3)], dim=0).to(device, dtype) * angle_range - np.pi
+    cos, sin = torch.cos(theta), torch.sin(theta)
+    one, zero = torch.ones_like(cos[0]), torch.zeros_like(cos[0])
+    Rx = torch.stack([one, zero, zero,
+                      zero, cos[0], sin[0],
+                      zero, -sin[0], cos[0]], dim=1).view(bs, 3, 3)
+    Ry = torch.stack([cos[1], zero, -sin[1],
+                      zero, one, zero,
+                      sin[1], zero, cos[1]], dim=1).view(bs, 3, 3)
+    Rz = torch.stack([cos[2], sin[2], zero,
+                      -sin[2], cos[2], zero,
+                      zero, zero, one], dim=1).view(bs, 3, 3)
+    return torch.matmul(Rz, torch.matmul(Ry, Rx))
+
+
 def random_rotation(x):
     bs, n_nodes, n_dims = x.size()
     device = x.device
@@ -329,45 +490,8 @@ def random_rotation(x):
         x = x.transpose(1, 2)
 
     elif n_dims == 3:
-
-        # Build Rx
-        Rx = torch.eye(3).unsqueeze(0).repeat(bs, 1, 1).to(device)
-        theta = torch.rand(bs, 1, 1).to(device) * angle_range - np.pi
-        cos = torch.cos(theta)
-        sin = torch.sin(theta)
-        Rx[:, 1:2, 1:2] = cos
-        Rx[:, 1:2, 2:3] = sin
-        Rx[:, 2:3, 1:2] = - sin
-        Rx[:, 2:3, 2:3] = cos
-
-        # Build Ry
-        Ry = torch.eye(3).unsqueeze(0).repeat(bs, 1, 1).to(device)
-        theta = torch.rand(bs, 1, 1).to(device) * angle_range - np.pi
-        cos = torch.cos(theta)
-        sin = torch.sin(theta)
-        Ry[:, 0:1, 0:1] = cos
-        Ry[:, 0:1, 2:3] = -sin
-        Ry[:, 2:3, 0:1] = sin
-        Ry[:, 2:3, 2:3] = cos
-
-        # Build Rz
-        Rz = torch.eye(3).unsqueeze(0).repeat(bs, 1, 1).to(device)
-        theta = torch.rand(bs, 1, 1).to(device) * angle_range - np.pi
-        cos = torch.cos(theta)
-        sin = torch.sin(theta)
-        Rz[:, 0:1, 0:1] = cos
-        Rz[:, 0:1, 1:2] = sin
-        Rz[:, 1:2, 0:1] = -sin
-        Rz[:, 1:2, 1:2] = cos
-
-        x = x.transpose(1, 2)
-        x = torch.matmul(Rx, x)
-        #x = torch.matmul(Rx.transpose(1, 2), x)
-        x = torch.matmul(Ry, x)
-        #x = torch.matmul(Ry.transpose(1, 2), x)
-        x = torch.matmul(Rz, x)
-        #x = torch.matmul(Rz.transpose(1, 2), x)
-        x = x.transpose(1, 2)
+        R = random_rotation_matrix(bs, device, x.dtype)
+        x = torch.matmul(x, R.transpose(1, 2))
     else:
         raise Exception("Not implemented Error")
 